@@ -13,15 +13,131 @@ description : outil de conversion d'un fichier de métadonnées (CSV) en XML.
 
 import csv                                 # lecture de fichier texte format CSV
 import xml.etree.ElementTree as ET         # gestion d'un arbre XML
-from random import randint                 # générateur de valeur aléatoire 
 import copy                                # pour faire des copies "spéciales" comme copy.deepcopy 
 import sys                                 # appel à des fonctions "système" (arguments ligne de commmande, par ex.)
 import os                                  # gestion de fichier sur disque (effacement de fichier, par ex.)
+import re                                  # expressions régulières
+from collections import namedtuple, deque, OrderedDict  # petites structures de données nommées, file d'attente, cache LRU
+import io                                  # flux en mémoire (capture des messages des processus de conversion)
+import codecs                              # vérification de l'encodage des fichiers de données
+import gzip                                # lecture en flux des fichiers CSV compressés (.gz)
+import bz2                                 # lecture en flux des fichiers CSV compressés (.bz2)
+import lzma                                # lecture en flux des fichiers CSV compressés (.xz)
+from contextlib import redirect_stdout     # redirection temporaire des messages (print)
+import multiprocessing                     # conversion en parallèle sur plusieurs processus
+import json                                # manifeste de conversion (une entrée JSON par ligne)
+import hashlib                             # empreintes des lignes de données, du mapping et de l'arbre de base
+import zipfile                             # écriture des fichiers XML dans une archive zip
+import tarfile                             # écriture des fichiers XML dans une archive tar (compressée ou non)
+import time                                # date des fichiers dans les archives
+import mmap                                # lecture d'un document du corpus sans lire le reste (voir CorpusReader)
+import stat                                # type des fichiers (socket Unix du serveur de conversion)
+import threading                           # écriture des fichiers en arrière-plan
+import queue                               # files d'attente des fichiers à écrire
+from functools import partial              # action différée après l'écriture d'un fichier (manifeste)
+import pickle                              # cache sur disque du mapping compilé
+import http.server                         # serveur de conversion (requêtes HTTP)
+import socketserver                        # serveur de conversion sur une socket Unix
+from urllib.parse import quote             # nom du fichier et messages dans les entêtes HTTP
+try:
+    from lxml import etree as lxmlET       # sérialisation XML en C (optionnelle, voir LxmlBackend)
+except ImportError:
+    lxmlET = None
+try:
+    import zstandard                       # lecture en flux des fichiers CSV compressés .zst (optionnelle)
+except ImportError:
+    zstandard = None
+try:
+    import pyarrow                         # lecture des fichiers de données Arrow/Parquet (optionnelle, voir ColumnarReader)
+    import pyarrow.compute
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 
 # Constantes
 msgFinDuJeu = '\n=> Processing stopped: please, correct.'
 
+# marqueurs (zone Unicode "usage privé") encadrant le numéro d'un '?' lors de la compilation du mapping
+slotStart = '\ue000'
+slotStop = '\ue001'
+# caractères qui, insérés dans la chaine de mapping, changeraient le résultat du parsing XML (balisage, entités,
+# guillemets, normalisation des fins de ligne et des attributs, caractères interdits)
+unsafeValue = re.compile('[<>&"\'\x00-\x1f\ufffe\uffff]')
+
+# marqueurs encadrant les numéros d'un champ et d'un de ses '?' dans les gabarits du moteur "template"
+# (voir TemplateEngine)
+templateStart = '\ue002'
+templateStop = '\ue003'
+templateMarker = re.compile(templateStart + '([0-9]+):([0-9]+)' + templateStop)
+# nombre maximum de gabarits gardés par le moteur "template" (un par combinaison de colonnes renseignées)
+templateCacheSize = 1024
+
+# nombre de mini-arbres gardés par défaut par le cache des champs (voir FragmentCache)
+fragmentCacheSize = 4096
+
+# plan d'insertion compilé pour une colonne (voir compileMapping)
+MappingPlan = namedtuple('MappingPlan', ['mapping', 'nbSlots', 'fragment', 'isPath', 'unsafe'])
+
+# arbre XML de base "figé", partagé par les arbres de chaque ligne (voir compileSkeleton et RowTree)
+Skeleton = namedtuple('Skeleton', ['root', 'frozen'])
+
+# conversion en parallèle: nombre de lignes confiées à la fois à un processus, et nombre de paquets
+# en attente par processus (pour ne pas charger tout le fichier de données en mémoire)
+jobsChunkSize = 64
+jobsQueueDepth = 4
+
+# contexte de conversion d'un processus de conversion (voir initConversionWorker)
+workerContext = None
+
+# convertisseurs d'un processus du serveur de conversion, par nom (voir initServerWorker)
+serverConverters = None
+
+# écriture en arrière-plan: nombre de fichiers en attente par processus léger d'écriture (voir ThreadedSink)
+writerQueueDepth = 16
+
+# sérialisations XML disponibles (option --backend, voir selectXMLBackend)
+xmlBackends = ['etree', 'lxml']
+
+# suivi de la conversion en cours: intervalle (s) entre deux points d'avancement (voir ConversionProgress)
+progressInterval = 10.0
+
+# statistiques de la conversion en cours (option --stats, voir ConversionStats), None si elles ne sont pas demandées
+conversionStats = None
+
+# manifeste de la conversion incrémentale, dans le dossier des fichiers créés (voir Manifest)
+manifestName = 'XMLify-manifest.jsonl'
+# manifeste d'un lot de lignes (option --shard): numéro du lot et nombre de lots (voir shardManifestName)
+shardManifestPattern = re.compile(r'^XMLify-manifest\.shard-([0-9]+)-of-([0-9]+)\.jsonl$')
+
+# rapport de validation des fichiers produits (une entrée JSON par ligne de données invalide, voir ValidationReport)
+validationReportName = 'XMLify-validation.jsonl'
+# schéma RelaxNG déclaré dans le prologue de l'arbre XML de base (voir schemaFromProlog)
+xmlModelPattern = re.compile(r'<\?xml-model\s([^?]*)\?>')
+xmlModelHref = re.compile(r'\bhref\s*=\s*["\']([^"\']+)["\']')
+relaxNGNamespace = 'http://relaxng.org/ns/structure/1.0'
+
+# formats d'archive reconnus (extension du nom de l'archive -> mode d'écriture en flux du module tarfile,
+# None pour zip), voir openOutputSink
+archiveFormats = [('.zip', None), ('.tar', 'w|'), ('.tar.gz', 'w|gz'), ('.tgz', 'w|gz'), ('.tar.bz2', 'w|bz2'), ('.tar.xz', 'w|xz')]
+
+# corpus en un seul fichier (voir CorpusSink): extension du XML délimité par des fins de ligne (sinon teiCorpus),
+# et suffixe de l'index des documents (cote -> position et longueur en octets)
+corpusLinesExtension = '.ndxml'
+corpusIndexSuffix = '.index.jsonl'
+
+# fichiers CSV compressés, lus en flux (voir openCSVFile), et erreurs de décompression d'un fichier abîmé
+compressedExtensions = ['.gz', '.bz2', '.xz', '.zst']
+compressedErrors = (EOFError, lzma.LZMAError) + ((zstandard.ZstdError,) if not(zstandard is None) else ())
+
+# fichiers de données en colonnes, lus par paquets de lignes (voir ColumnarReader): extension -> format
+columnarFormats = [('.parquet', 'parquet'), ('.pq', 'parquet'), ('.arrow', 'file'), ('.feather', 'file'), ('.ipc', 'file'), ('.arrows', 'stream')]
+columnarBatchSize = 4096
+
+# répartition des fichiers créés en sous-dossiers (voir OutputLayout), enregistrée dans le dossier des fichiers
+layoutName = 'XMLify-layout.json'
+
 
 #--------------------------------------------------------------
 def readError(filename):
@@ -36,17 +152,438 @@ def readError(filename):
 
 
 #--------------------------------------------------------------
-def writeError(filename):
+def writeError(filename, numRow=None):
     '''
     prints an error message when a file cannot be written.
     :param filename: name of the file
         :type: str
+    :param numRow: number of the data row whose file it is, if any
+        :type: int
     '''
-    print ('Failed to create file '+filename)
+    if numRow is None:
+        print ('Failed to create file '+filename)
+    else:
+        print ('Line '+str(numRow)+' -> failed to create file '+filename)
     
     return None
 
 
+#--------------------------------------------------------------
+class ConversionStats(object):
+    '''
+    Statistiques d'une conversion (option --stats): temps cumulé et nombre d'appels de chaque étape, et coût
+    cumulé de l'ajout des balises de chaque colonne dans l'arbre XML (moteur "tree"), pour repérer une entrée
+    du mapping coûteuse. Les mesures ne sont faites que si conversionStats contient un objet ConversionStats
+    (voir statsStart et statsStop): sinon, il n'en coûte qu'un test par étape.
+    '''
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.stages = {}     # étape -> [nombre d'appels, temps cumulé (s)]
+        self.columns = {}    # entête de colonne -> [nombre d'ajouts, temps cumulé (s)]
+        self.counters = {}   # compteur -> nombre (voir statsCount)
+        self.lock = threading.Lock()    # mesures ajoutées aussi par les processus légers d'écriture
+
+    def add(self, stage, seconds, column=None):
+        '''
+        Ajoute une mesure à une étape (et à une colonne, si précisée).
+        '''
+        with self.lock:
+            mesure = self.stages.setdefault(stage, [0, 0.0])
+            mesure[0] = mesure[0] + 1
+            mesure[1] = mesure[1] + seconds
+            if not(column is None):
+                mesure = self.columns.setdefault(column, [0, 0.0])
+                mesure[0] = mesure[0] + 1
+                mesure[1] = mesure[1] + seconds
+
+        return None
+
+    def count(self, counter, n=1):
+        '''
+        Ajoute n à un compteur (cache des champs, par ex.).
+        '''
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+        return None
+
+    def merge(self, other):
+        '''
+        Ajoute les mesures d'un processus de conversion (voir convertRowsChunk).
+
+        :param other: mesures (voir toDict)
+            :type: dict
+        '''
+        self.rows = self.rows + other['rows']
+        for cible, mesures in ((self.stages, other['stages']), (self.columns, other['columns'])):
+            for nom, mesure in mesures.items():
+                total = cible.setdefault(nom, [0, 0.0])
+                total[0] = total[0] + mesure['calls']
+                total[1] = total[1] + mesure['seconds']
+        for nom, nombre in other['counters'].items():
+            self.counters[nom] = self.counters.get(nom, 0) + nombre
+
+        return None
+
+    def toDict(self):
+        '''
+        Mesures, sous une forme enregistrable en JSON.
+        '''
+        duree = time.perf_counter() - self.started
+        return {'rows': self.rows,
+                'seconds': duree,
+                'rows_per_s': (self.rows / duree) if duree > 0 else 0.0,
+                'stages': dict([(nom, {'calls': mesure[0], 'seconds': mesure[1]}) for nom, mesure in self.stages.items()]),
+                'columns': dict([(nom, {'calls': mesure[0], 'seconds': mesure[1]}) for nom, mesure in self.columns.items()]),
+                'counters': dict(self.counters)}
+
+    def report(self, filename=None):
+        '''
+        Affiche les mesures, ou les enregistre en JSON.
+
+        :param filename: fichier JSON (None: affichage)
+            :type: str
+        '''
+        mesures = self.toDict()
+        if not(filename is None):
+            try:
+                with open(filename, 'w', encoding='utf-8') as fichier:
+                    json.dump(mesures, fichier, indent=2, ensure_ascii=False)
+            except EnvironmentError:
+                writeError(filename)
+            return None
+
+        print('Conversion statistics: '+str(mesures['rows'])+' rows in '+format(mesures['seconds'], '.3f')+' s ('
+              +format(mesures['rows_per_s'], '.0f')+' rows/s)')
+        print('  '+'stage'.ljust(12)+'calls'.rjust(10)+'total (s)'.rjust(12)+'mean (ms)'.rjust(12)+'share'.rjust(8))
+        for nom, mesure in sorted(mesures['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print('  '+nom.ljust(12)+str(mesure['calls']).rjust(10)+format(mesure['seconds'], '12.3f')
+                  +format(1000*mesure['seconds']/max(1, mesure['calls']), '12.3f')
+                  +format(100*mesure['seconds']/max(mesures['seconds'], 1e-9), '7.1f')+'%')
+        if len(mesures['columns']) > 0:
+            print('  merge cost per column:')
+            for nom, mesure in sorted(mesures['columns'].items(), key=lambda item: -item[1]['seconds']):
+                print('    '+nom.ljust(30)+str(mesure['calls']).rjust(10)+format(mesure['seconds'], '12.3f')
+                      +format(1000*mesure['seconds']/max(1, mesure['calls']), '12.3f'))
+        if len(mesures['counters']) > 0:
+            print('  counters:')
+            for nom, nombre in sorted(mesures['counters'].items()):
+                print('    '+nom.ljust(30)+str(nombre).rjust(10))
+
+        return None
+
+#--------------------------------------------------------------
+def statsStart():
+    '''
+    Début de la mesure d'une étape (voir ConversionStats).
+
+    :returns: instant de départ, None si les statistiques ne sont pas demandées
+        :type: float
+    '''
+    if conversionStats is None:
+        return None
+
+    return time.perf_counter()
+
+#--------------------------------------------------------------
+def statsStop(stage, debut, column=None):
+    '''
+    Fin de la mesure d'une étape (voir ConversionStats).
+
+    :param stage: nom de l'étape
+        :type: str
+    :param debut: instant de départ (voir statsStart)
+        :type: float
+    :param column: entête de la colonne dont les balises ont été ajoutées, le cas échéant
+        :type: str
+    '''
+    if not(debut is None) and not(conversionStats is None):
+        conversionStats.add(stage, time.perf_counter() - debut, column)
+
+    return None
+
+#--------------------------------------------------------------
+def statsCount(counter, n=1):
+    '''
+    Ajoute n à un compteur (voir ConversionStats), si les statistiques sont demandées.
+    '''
+    if not(conversionStats is None):
+        conversionStats.count(counter, n)
+
+    return None
+
+#--------------------------------------------------------------
+def timedRows(readerSource):
+    '''
+    Lecture des lignes de données, en mesurant le temps de lecture (étape "read", voir ConversionStats).
+
+    :param readerSource: lecteur des lignes de données
+        :type csv.reader
+    :returns: lignes de données
+        :type: generator
+    '''
+    lignes = iter(readerSource)
+    while True:
+        debut = statsStart()
+        try:
+            row = next(lignes)
+        except StopIteration:
+            return
+        statsStop('read', debut)
+        yield row
+
+#--------------------------------------------------------------
+class ConversionProgress(object):
+    '''
+    Suivi d'une longue conversion (options --progress et --metrics): à intervalle régulier, un processus léger
+    affiche l'avancement (lignes converties, débit, part du fichier de données lue et temps restant estimé,
+    octets écrits, erreurs) et l'enregistre dans un fichier de mesures, au format texte de Prometheus (".prom",
+    réécrit à chaque fois, pour le collecteur "textfile" de node_exporter) ou en JSON (une entrée par ligne).
+
+    Seuls les fichiers écrits sont comptés, là où ils sont écrits (voir ProgressSink: dans les processus légers
+    d'écriture avec --writers): la position de lecture du fichier de données est lue par le processus léger de
+    suivi, sur son descripteur, et les autres compteurs dans le manifeste et le rapport de validation.
+    '''
+
+    def __init__(self, interval=progressInterval, display=True, metrics=None, name=''):
+        '''
+        :param interval: intervalle entre deux points d'avancement (s)
+            :type: float
+        :param display: afficher l'avancement (sur la sortie d'erreur)
+            :type: bool
+        :param metrics: fichier de mesures (".prom": format Prometheus; sinon JSON, une entrée par ligne)
+            :type: str
+        :param name: nom du fichier de données (étiquette "input" des mesures Prometheus)
+            :type: str
+        '''
+        self.interval = interval
+        self.display = display
+        self.metrics = metrics
+        self.name = name
+        self.started = time.time()
+        self.rows = 0           # fichiers écrits
+        self.bytes = 0          # octets écrits
+        self.errors = 0         # fichiers qui n'ont pu être écrits
+        self.lock = threading.Lock()    # compteurs mis à jour aussi par les processus légers d'écriture
+        self.manifest = None    # lignes inchangées (voir Manifest)
+        self.report = None      # fichiers invalides (voir ValidationReport)
+        self.input = None       # descripteur du fichier de données
+        self.inputSize = None
+        self.inputDone = False
+        self.last = (self.started, 0)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def watch(self, source):
+        '''
+        Suit la lecture du fichier de données (une source sans descripteur, ou qui n'est pas un fichier, n'a
+        pas de temps restant estimé).
+
+        :param source: fichier de données ouvert, None quand sa lecture est terminée
+            :type: io.TextIOBase
+        '''
+        if source is None:
+            self.input = None
+            self.inputDone = True
+            return None
+        try:
+            descripteur = source.fileno()
+            infos = os.fstat(descripteur)
+        except (AttributeError, OSError, ValueError):
+            return None
+        self.input = descripteur
+        self.inputSize = infos.st_size if stat.S_ISREG(infos.st_mode) else None
+
+        return None
+
+    def start(self):
+        '''
+        Démarre le processus léger de suivi.
+        '''
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+        return None
+
+    def run(self):
+        '''
+        Processus léger de suivi: un point d'avancement par intervalle, jusqu'à la fin de la conversion.
+        '''
+        while not(self.stopped.wait(self.interval)):
+            self.tick(True)
+
+        return None
+
+    def snapshot(self, running):
+        '''
+        Mesures de l'avancement.
+
+        :param running: la conversion est en cours
+            :type: bool
+        :returns: mesures (None pour celles qui ne sont pas connues)
+            :type: dict
+        '''
+        maintenant = time.time()
+        duree = maintenant - self.started
+        lignes = self.rows
+        position = None
+        if self.inputDone:
+            position = self.inputSize
+        elif not(self.input is None):
+            try:
+                position = os.lseek(self.input, 0, os.SEEK_CUR)
+            except OSError:
+                position = None
+        ratio = None
+        restant = None
+        if not(position is None) and self.inputSize:
+            ratio = min(1.0, position / self.inputSize)
+            if ratio > 0:
+                restant = duree * (1 - ratio) / ratio
+        depuis, lignesAvant = self.last
+        self.last = (maintenant, lignes)
+        invalides = 0 if self.report is None else self.report.invalid
+
+        return {'time': maintenant,
+                'running': running,
+                'seconds': duree,
+                'rows': lignes,
+                'rows_per_s': (lignes / duree) if duree > 0 else 0.0,
+                'recent_rows_per_s': ((lignes - lignesAvant) / (maintenant - depuis)) if maintenant > depuis else 0.0,
+                'bytes_written': self.bytes,
+                'input_bytes_read': position,
+                'input_bytes_total': self.inputSize,
+                'progress': ratio,
+                'eta_s': restant,
+                'errors': self.errors + invalides,
+                'write_errors': self.errors,
+                'invalid_files': invalides,
+                'unchanged_rows': 0 if self.manifest is None else self.manifest.skipped}
+
+    def tick(self, running):
+        '''
+        Point d'avancement: affichage et fichier de mesures.
+        '''
+        mesures = self.snapshot(running)
+        if self.display:
+            ligne = 'Progress: '+str(mesures['rows'])+' rows, '+format(mesures['recent_rows_per_s'], '.0f')+' rows/s'
+            if not(mesures['progress'] is None):
+                ligne = ligne+', '+format(100*mesures['progress'], '.1f')+'% of input'
+            if running and not(mesures['eta_s'] is None):
+                ligne = ligne+', ETA '+str(int(mesures['eta_s'])//3600)+time.strftime(':%M:%S', time.gmtime(mesures['eta_s']))
+            ligne = ligne+', '+format(mesures['bytes_written']/1e6, '.1f')+' MB written, '+str(mesures['errors'])+' error(s)'
+            sys.stderr.write(ligne+'\n')
+            sys.stderr.flush()
+        if not(self.metrics is None):
+            self.store(mesures)
+
+        return None
+
+    def store(self, mesures):
+        '''
+        Enregistre les mesures dans le fichier de mesures.
+        '''
+        try:
+            if self.metrics.endswith('.prom'):
+                # fichier remplacé d'un coup: le collecteur ne lit jamais un fichier à moitié écrit
+                with open(self.metrics+'.tmp', 'w', encoding='utf-8') as fichier:
+                    fichier.write(self.prometheus(mesures))
+                os.replace(self.metrics+'.tmp', self.metrics)
+            else:
+                with open(self.metrics, 'a', encoding='utf-8') as fichier:
+                    fichier.write(json.dumps(mesures)+'\n')
+        except EnvironmentError:
+            writeError(self.metrics)
+
+        return None
+
+    def prometheus(self, mesures):
+        '''
+        Mesures au format texte de Prometheus.
+
+        :returns: texte du fichier de mesures
+            :type: str
+        '''
+        etiquette = '{input="'+self.name.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')+'"}'
+        definitions = [('running', 'gauge', 'Whether the conversion is running.', 1 if mesures['running'] else 0),
+                       ('elapsed_seconds', 'gauge', 'Time since the conversion started.', mesures['seconds']),
+                       ('rows_total', 'counter', 'Rows converted.', mesures['rows']),
+                       ('rows_per_second', 'gauge', 'Rows converted per second during the last interval.', mesures['recent_rows_per_s']),
+                       ('bytes_written_total', 'counter', 'Bytes of XML written.', mesures['bytes_written']),
+                       ('input_bytes_read', 'gauge', 'Position in the data file.', mesures['input_bytes_read']),
+                       ('input_bytes_total', 'gauge', 'Size of the data file.', mesures['input_bytes_total']),
+                       ('progress_ratio', 'gauge', 'Part of the data file read.', mesures['progress']),
+                       ('eta_seconds', 'gauge', 'Estimated time left.', mesures['eta_s']),
+                       ('write_errors_total', 'counter', 'Files that could not be written.', mesures['write_errors']),
+                       ('invalid_files_total', 'counter', 'Files that failed validation.', mesures['invalid_files']),
+                       ('unchanged_rows_total', 'counter', 'Rows skipped by an incremental conversion.', mesures['unchanged_rows'])]
+        lignes = []
+        for nom, sorte, aide, valeur in definitions:
+            if valeur is None:
+                continue
+            lignes.append('# HELP xmlify_'+nom+' '+aide)
+            lignes.append('# TYPE xmlify_'+nom+' '+sorte)
+            lignes.append('xmlify_'+nom+etiquette+' '+repr(float(valeur) if isinstance(valeur, float) else valeur))
+
+        return '\n'.join(lignes)+'\n'
+
+    def close(self):
+        '''
+        Arrête le suivi, avec un dernier point d'avancement.
+        '''
+        self.stopped.set()
+        if not(self.thread is None):
+            self.thread.join()
+            self.thread = None
+        self.tick(False)
+
+        return None
+
+#--------------------------------------------------------------
+class ProgressSink(object):
+    '''
+    Destination des fichiers XML qui compte, pour le suivi de la conversion (voir ConversionProgress), les
+    fichiers et les octets écrits par une autre destination, et ses échecs. Avec l'écriture en arrière-plan, elle
+    est placée sous ThreadedSink (voir openOutputSink): chaque fichier est compté une fois vraiment écrit.
+    '''
+
+    def __init__(self, sink, progress):
+        '''
+        :param sink: destination des fichiers (voir openOutputSink)
+            :type: object
+        :param progress: suivi de la conversion
+            :type: ConversionProgress
+        '''
+        self.sink = sink
+        self.progress = progress
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        (voir DirectorySink.write)
+        '''
+        try:
+            chemin = self.sink.write(cote, document, numRow, done)
+        except Exception:
+            with self.progress.lock:
+                self.progress.errors = self.progress.errors + 1
+            raise
+        with self.progress.lock:
+            if chemin is None:
+                self.progress.errors = self.progress.errors + 1
+            else:
+                self.progress.rows = self.progress.rows + 1
+                self.progress.bytes = self.progress.bytes + len(document)
+
+        return chemin
+
+    def flush(self):
+        return self.sink.flush()
+
+    def close(self):
+        return self.sink.close()
+
 #--------------------------------------------------------------
 def indent(elem, level=0):
     '''
@@ -80,154 +617,788 @@ def indent(elem, level=0):
     return None
                         
 #--------------------------------------------------------------
-def completeXMLheader(tmpfile, xmlBase):
-    """
-    créé un fichier XML en reprenant les déclarations dans le fichier XML "modèle", 
-    puis y rajoute (recopie) le contenu du fichier temporaire contenant l'arborescence 
-    XML fabriquée. A la fin, supprime le fichier temporaire.
-    
-    :param tmpfile: nom du fichier contenant l'arbre XML généré
-        :type : string
-    :param XmlBase: fichier contenant l'arbre XML de base   
-        :type: str   
-    :returns: None
-    """
-    
-    xmlTag =''  # balise pivot qui sert à repérer la fin des déclarations et le début de l'arbre XML
-    # ouvrir en écriture tmpfile+'.xml'
-    try:
-        with open(tmpfile+".xml", "w",encoding="utf-8") as result_file:            
-            try:
-                # ouvrir en lecture 'teiHeader.xml'
-                header_file = open(xmlBase, "r",encoding="utf-8")    
-                # lire chaque ligne jusqu'à tomber sur une balise type '<tei>'
-                declStart = False
-                declStop = False
-                for ligne in header_file:     
-                    if (ligne==''):
-                        break
-                    # supprimer les ' ', '\n', etc... 
-                    ligne = ligne.strip()  
-                    # a-t-on une balise de début de déclaration ou de commentaire ?
-                    if (declStart == False):
-                        declStart = (ligne.find('<!')>-1)or(ligne.find('<?')>-1)
-                    # a-t-on une balise de fin de déclaration ou de commentaire ?
-                    if (declStop == False):    
-                        declStop = ((ligne.find('-->')>-1)or(ligne.find('?>')>-1))
-                        
-                    # ni déclaration, ni commentaire et pas vide: c'est qu'on attaque l'arbre XML
-                    if (declStart == False) and (declStop == False) and (not(ligne == '')):
-                        # On a trouvé notre balise "pivot": on prend '<' et deux autres caractères
-                        xmlTag = ligne[:3]
-                        break   # on ne cherche plus, ce n'est pas la peine                
-                    # écrire cette ligne dans tmpfile+'.xml' à condition qu'elle ne soit pas vide
-                    if not(ligne==''):
-                        result_file.write(ligne+'\n')  # on remet une fin de ligne car strip() l'a supprimé
-                        # si on a copié une déclaration/commentaire complet, on remet les compteurs à zéro
-                        if (declStart == True) and (declStop == True):
-                            declStart = False
-                            declStop = False
-            except EnvironmentError:
-                readError(xmlBase)
-            finally:
-                # fermer 'teiHeader.xml'
-                header_file.close()
-                ligne=''       
-            try:
-                # ouvrir en lecture tmpfile+'.tmp'
-                tree_file = open(tmpfile+".tmp", "r",encoding="utf-8")
-                # recopier chaque ligne de l'arbre dans tmpfile+'.xml'
-                debut = 0
-                for ligne in tree_file:
-                    if (ligne == ''):
-                        break
-                    if (ligne.find(xmlTag)>-1):
-                        debut = 1
-                    if debut == 1:
-                        result_file.write(ligne)
-            except EnvironmentError :
-                readError(tmpfile+".tmp")
-            finally:
-                # fermer tmpfile+'.tmp'
-                tree_file.close()                
-                os.remove(tmpfile+'.tmp')
-    except EnvironmentError:
-        writeError(tmpfile+".xml")
-    return None
-           
+def isInlineSource(source):
+    '''
+    Indique si un fichier XML de base ou de mapping est donné par son contenu plutôt que par son chemin
+    (un contenu XML commence par "<", un contenu CSV a au moins une fin de ligne).
+
+    :param source: chemin du fichier, ou son contenu
+        :type: str
+    :returns: source est le contenu du fichier
+        :type: bool
+    '''
+
+    return ('\n' in source) or source.lstrip().startswith('<')
+
 #--------------------------------------------------------------
-def loadCSVtoTEIMapping(pathFileCSV_Map):
+def openSource(source):
+    '''
+    Ouvre en lecture un fichier XML de base ou de mapping donné par son chemin ou par son contenu
+    (voir isInlineSource).
+
+    :param source: chemin du fichier, ou son contenu
+        :type: str
+    :returns: fichier ouvert en lecture (texte)
+        :type: io.TextIOBase
+    '''
+
+    if isInlineSource(source):
+        return io.StringIO(source)
+
+    return open(source, "r", encoding="utf-8")
+
+#--------------------------------------------------------------
+def openCSVFile(filename, encoding='utf-8'):
+    '''
+    Ouvre en lecture un fichier CSV (données ou mapping), lu en flux: compressé d'après son extension (voir
+    compressedExtensions, .zst si le module zstandard est installé), ou l'entrée standard pour "-".
+
+    :param filename: chemin du fichier, ou "-"
+        :type: str
+    :param encoding: encodage du fichier
+        :type: str
+    :returns: fichier ouvert en lecture (texte)
+        :type: io.TextIOBase
+    '''
+
+    nom = filename.lower()
+    if filename == '-':
+        # l'entrée standard reste ouverte après la lecture
+        return io.TextIOWrapper(open(sys.stdin.fileno(), 'rb', closefd=False), encoding=encoding)
+    if nom.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding=encoding)
+    if nom.endswith('.bz2'):
+        return bz2.open(filename, 'rt', encoding=encoding)
+    if nom.endswith('.xz'):
+        return lzma.open(filename, 'rt', encoding=encoding)
+    if nom.endswith('.zst'):
+        if zstandard is None:
+            print('zstandard is not installed: '+filename+' cannot be read')
+            raise OSError('zstandard is not installed')
+        flux = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
+        return io.TextIOWrapper(flux, encoding=encoding)
+
+    return open(filename, 'r', encoding=encoding)
+
+#--------------------------------------------------------------
+def getXMLProlog(xmlBase):
     """
-     Charge le fichier CSV de mapping entre les champs personnalisés et les champs TEI 
-     
-     :param pathFileCSV_Mapp : le chemin vers le fichier csv contenant le mapping entre des champs de metas personnalisées et des champs normalisés contenus dans un header TEI
-         :type str
-    : returns: row
-        :type: orderedDict  
+    Récupère les déclarations et commentaires placés avant l'arbre XML dans le fichier XML "modèle"
+    (le parsing par ElementTree les supprime). A faire une seule fois: le résultat est placé en tête
+    de chaque fichier XML créé (voir TreeSerializer.serialize).
+
+    :param xmlBase: fichier contenant l'arbre XML de base (ou son contenu, voir openSource)
+        :type: str
+    :returns: les lignes de déclaration/commentaire, chacune terminée par une fin de ligne
+              (None si le fichier ne peut être lu)
+        :type: str
     """
-    
-    Dico = None
+
+    prolog = ''
     try:
-        with open(pathFileCSV_Map,encoding='utf-8') as csvfileMap:
-            readerMap = csv.DictReader(csvfileMap, delimiter=';')
-             #on obtien un dico par ligne
-            for row in readerMap:
-                Dico = row
-                break
-        # exemple: clef row['Creator'] renvoie '<teiHeader><fileDesc><titleStmt><author key=""></autor></fileDesc></titleStmt></teiHeader>'
+        # ouvrir en lecture 'teiHeader.xml'
+        with openSource(xmlBase) as header_file:
+            # lire chaque ligne jusqu'à tomber sur une balise type '<tei>'
+            declStart = False
+            declStop = False
+            for ligne in header_file:
+                if (ligne==''):
+                    break
+                # supprimer les ' ', '\n', etc...
+                ligne = ligne.strip()
+                # a-t-on une balise de début de déclaration ou de commentaire ?
+                if (declStart == False):
+                    declStart = (ligne.find('<!')>-1)or(ligne.find('<?')>-1)
+                # a-t-on une balise de fin de déclaration ou de commentaire ?
+                if (declStop == False):
+                    declStop = ((ligne.find('-->')>-1)or(ligne.find('?>')>-1))
+
+                # ni déclaration, ni commentaire et pas vide: c'est qu'on attaque l'arbre XML
+                if (declStart == False) and (declStop == False) and (not(ligne == '')):
+                    break   # on ne cherche plus, ce n'est pas la peine
+                # garder cette ligne à condition qu'elle ne soit pas vide
+                if not(ligne==''):
+                    prolog = prolog + ligne + '\n'  # on remet une fin de ligne car strip() l'a supprimé
+                    # si on a copié une déclaration/commentaire complet, on remet les compteurs à zéro
+                    if (declStart == True) and (declStop == True):
+                        declStart = False
+                        declStop = False
     except EnvironmentError:
-        readError(pathFileCSV_Map)
-        
-    finally:
-        csvfileMap.close()
-    # on renvoie la dernière ligne
-    return Dico
-    
-#--------------------------------------------------------------    
-def check_TEIMapping(TEIMapping, declarations):
-    """
-    Vérifie le mapping TEI: pas de clef ou de valeur vide. Au passage, supprime les clefs avec valeur "none".
-    
-    :param TEIMapping : dictionnaire ordonné contenant les couples "entête de colonne"->"balises"
-        :type orderedDict
-    :param decalarations: liste des balises de déclaration d'espaces de nommage (namespace, i.e. 'xmlns:')
-        :type list
-    : returns: ckecked_Ok: la vérification s'est bien passée ou il y a des choses à corriger
-        :type bool
-    """
-    
-    ckecked_Ok = True
-    # liste des clefs à supprimer du dictionnaire
-    KeystoDelete = []
-    n = 0
-    for clef in TEIMapping:
-        n = n+1
-        nkey = str(clef).strip()
-        # on vérifie que la clef est correcte
-        if (clef is None) or (nkey == ''):            
-            print('Warning: column ',n,'is empty\n')
-            # erreur à corriger: on arrêtera le traitement
-            ckecked_Ok = False
-        else:   # la clef est correcte
-            # on récupère les balises TEI correspondantes
-            value = TEIMapping.get(clef,None)
-            nvalue = str(value).strip().lower()
-            # on vérifie que la valeur existe
-            if (value is None) or (nvalue == ''):
-                print('Warning: column ',n,' ',clef,'= "No mapping string"\n')
-                # erreur à corriger: on arrêtera le traitement
-                ckecked_Ok = False
-            else:    # on a une valeur de conversion 
-                # si on a décidé de ne pas convertir ce champs    
-                if (nvalue == 'none'):
-                    # on ajoute la clef à la liste des clefs à supprimer du dictionnaire
-                    KeystoDelete.append(clef)
-                else:    
-                    # Si on a un mapping qui n'est pas sous forme de balises, le tranformer en balises
-                    if (nvalue.find('<')==-1):
-                        tmpStr = '<'+nvalue+'>?</'+nvalue+'>'
-                        TEIMapping[clef] = tmpStr
-                    '''
+        readError(xmlBase)
+        return None
+
+    return prolog
+
+#--------------------------------------------------------------
+class TreeSerializer(object):
+    '''
+    Sérialisation de l'arbre XML d'une ligne en un seul parcours de l'arbre, sans récursion: suppression des
+    feuilles vides, mise en forme (même résultat que indent) et écriture du texte XML (même résultat
+    qu'ElementTree), sans modifier l'arbre (ni textes, ni fins de ligne). Les branches du squelette restées
+    inchangées (voir RowTree) ne sont sérialisées qu'une fois, puis reprises telles quelles.
+
+    Suppression des feuilles vides (cleanEmptyLeaf):
+        - False: aucune;
+        - True: éléments sans texte ni descendant placés directement sous la racine (1er niveau);
+        - 'all': en plus, à toute profondeur, éléments sans attribut, sans descendant (une fois leurs propres
+          feuilles vides supprimées) et sans texte, ou avec des espaces seulement.
+    En mode compact (compact=True), aucune mise en forme n'est ajoutée: les espaces seuls entre deux balises
+    sont supprimés.
+    '''
+
+    name = 'etree'
+
+    def __init__(self, cleanEmptyLeaf=True, compact=False):
+        '''
+        :param cleanEmptyLeaf: suppression des feuilles vides: False, True (1er niveau) ou 'all' (toute profondeur)
+            :type: bool ou str
+        :param compact: pas de mise en forme
+            :type: bool
+        '''
+        self.clean = cleanEmptyLeaf
+        self.compact = compact
+        self.branches = {}    # (préfixes, niveau) -> branche du squelette -> texte XML (None: branche supprimée)
+        self.uris = {}        # branche du squelette -> URIs des espaces de nommage utilisés (ordre de rencontre)
+        self.names = {}       # préfixes -> tag ou nom d'attribut -> nom écrit ("préfixe:nom")
+
+    def scan(self, racine, frozen):
+        '''
+        Parcours préalable de l'arbre, dans l'ordre du document (à l'aide d'une pile):
+        - préfixes des espaces de nommage utilisés, choisis comme le fait ElementTree (préfixe déclaré par
+          ET.register_namespace, sinon "ns0", "ns1"... dans l'ordre de rencontre). Les feuilles vides du
+          1er niveau ne comptent pas; celles supprimées plus bas (cleanEmptyLeaf='all') comptent: leurs
+          espaces de nommage restent déclarés;
+        - éléments présents à plusieurs places de l'arbre (la fusion des balises peut placer un même élément
+          sous deux parents, voir mergeFragment): indent les met en forme à chaque place, la dernière l'emporte.
+          Leur mise en forme, partout, est donc celle de leur dernière place.
+
+        :param racine: racine de l'arbre
+            :type: xml.etree.ElementTree.Element
+        :param frozen: éléments du squelette (voir compileSkeleton), dont les espaces de nommage sont gardés
+            :type: frozenset
+        :returns: "URI"->"préfixe", sans l'espace de nommage "xml" (qui n'est jamais déclaré), et pour chaque
+            élément présent à plusieurs places, (niveau, dernier enfant de son parent) à sa dernière place
+            :type: tuple (dict, dict)
+        '''
+
+        uris = []
+        for nom in [racine.tag] + list(racine.keys()):
+            if nom[:1] == '{':
+                uris.append(nom[1:].rsplit('}', 1)[0])
+        enfants = [enfant for enfant in racine if not(self.clean and not(enfant.text) and (len(enfant) == 0))]
+        pile = [(enfants[n], 1, n == len(enfants)-1) for n in range(len(enfants)-1, -1, -1)]
+        places = {}
+        partages = []
+        while len(pile) > 0:
+            element, niveau, dernier = pile.pop()
+            if element in places:
+                partages.append(element)
+            places[element] = (niveau, dernier)
+            if element in frozen:
+                liste = self.uris.get(element)
+                if liste is None:
+                    liste = []
+                    for descendant in element.iter():
+                        for nom in [descendant.tag] + list(descendant.keys()):
+                            if nom[:1] == '{':
+                                liste.append(nom[1:].rsplit('}', 1)[0])
+                    self.uris[element] = liste
+                uris.extend(liste)
+                continue
+            for nom in [element.tag] + list(element.keys()):
+                if nom[:1] == '{':
+                    uris.append(nom[1:].rsplit('}', 1)[0])
+            dernier = len(element) - 1
+            pile.extend([(element[n], niveau+1, n == dernier) for n in range(dernier, -1, -1)])
+        prefixes = {}
+        for uri in uris:
+            if not(uri in prefixes):
+                prefix = ET._namespace_map.get(uri)
+                if prefix is None:
+                    prefix = 'ns' + str(len(prefixes))
+                if prefix != 'xml':
+                    prefixes[uri] = prefix
+
+        return prefixes, {element: places[element] for element in partages}
+
+    def qualifiedName(self, nom, prefixes, noms):
+        '''
+        Nom écrit d'un tag ou d'un attribut: "{URI}nom" devient "préfixe:nom".
+
+        :param nom: tag ou nom d'attribut
+            :type: str
+        :param prefixes: "URI"->"préfixe" (voir namespaces)
+            :type: dict
+        :param noms: noms déjà calculés pour ces préfixes
+            :type: dict
+        :returns: nom écrit
+            :type: str
+        '''
+
+        ecrit = noms.get(nom)
+        if ecrit is None:
+            ecrit = nom
+            if nom[:1] == '{':
+                uri, local = nom[1:].rsplit('}', 1)
+                prefix = prefixes.get(uri, 'xml')
+                ecrit = prefix + ':' + local if prefix else local
+            noms[nom] = ecrit
+
+        return ecrit
+
+    def tail(self, element, level, last, places):
+        '''
+        Texte XML qui suit un élément: son texte propre s'il en a un, sinon la mise en forme (voir indent).
+
+        :param element: élément
+            :type: xml.etree.ElementTree.Element
+        :param level: niveau d'indentation du parent de l'élément
+            :type: int
+        :param last: l'élément est le dernier enfant gardé de son parent
+            :type: bool
+        :param places: dernière place des éléments présents à plusieurs places (voir scan)
+            :type: dict
+        :returns: texte XML
+            :type: str
+        '''
+
+        if element in places:
+            level, last = places[element]
+            level = level - 1
+        texte = element.tail
+        if texte and texte.strip():
+            return ET._escape_cdata(texte)
+        if self.compact:
+            return ''
+        if last:
+            return '\n' + level*'  '
+
+        return '\n' + level*'  ' + '  '
+
+    def serializeElement(self, element, level, frozen, prefixes, morceaux, declarations='', places={}):
+        '''
+        Ajoute à une liste les morceaux du texte XML d'un élément et de ses descendants, sans le texte qui
+        le suit. Les éléments sont parcourus à l'aide d'une pile (pas de limite de profondeur). Les morceaux
+        d'une feuille vide sont retirés une fois l'élément fermé; la fin de ligne qui suit un enfant n'est
+        écrite qu'une fois connu l'enfant gardé suivant, s'il y en a un.
+
+        :param element: élément
+            :type: xml.etree.ElementTree.Element
+        :param level: niveau d'indentation de l'élément
+            :type: int
+        :param frozen: éléments du squelette (voir compileSkeleton), dont le texte XML est gardé
+            :type: frozenset
+        :param prefixes: "URI"->"préfixe" (voir namespaces)
+            :type: dict
+        :param morceaux: liste à compléter
+            :type: list
+        :param declarations: déclarations d'espaces de nommage à placer dans la balise (racine)
+            :type: str
+        :param places: dernière place des éléments présents à plusieurs places (voir scan)
+            :type: dict
+        :returns: nombre d'enfants gardés, ou -1 si l'élément est une feuille vide supprimée
+            :type: int
+        '''
+
+        noms = self.names.setdefault(tuple(prefixes.items()), {})
+        pile = []
+
+        def ouvrir(elem, niveau, decl):
+            # balise ouvrante, sans son '>': le '>' et le texte, ou ' />', ne sont connus qu'à la fermeture
+            nom = self.qualifiedName(elem.tag, prefixes, noms)
+            balise = ['<', nom, decl]
+            for clef, valeur in elem.items():
+                balise.append(' ' + self.qualifiedName(clef, prefixes, noms) + '="' + ET._escape_attrib(valeur) + '"')
+            # [élément, niveau, enfants restants, début, nom, enfants gardés, place de la fin de ligne du dernier
+            # enfant gardé, dernier enfant gardé]
+            pile.append([elem, niveau, iter(elem), len(morceaux), nom, 0, None, None])
+            morceaux.append(''.join(balise))
+            morceaux.append(None)
+
+        def garder(cadre, enfant):
+            # l'enfant qui vient d'être écrit est gardé: l'enfant gardé précédent n'est pas le dernier
+            if not(cadre[6] is None):
+                morceaux[cadre[6]] = self.tail(cadre[7], cadre[1], False, places)
+            morceaux.append(None)
+            cadre[5] = cadre[5] + 1
+            cadre[6] = len(morceaux) - 1
+            cadre[7] = enfant
+
+        ouvrir(element, level, declarations)
+        while True:
+            cadre = pile[-1]
+            elem = cadre[0]
+            niveau = cadre[1]
+            enfant = next(cadre[2], None)
+            if not(enfant is None):
+                # feuilles vides sous la racine (voir cleanEmptyLeaf)
+                if self.clean and (niveau == 0) and not(enfant.text) and (len(enfant) == 0):
+                    continue
+                niveauEnfant = places[enfant][0] if enfant in places else niveau+1
+                if enfant in frozen:
+                    texte = self.branch(enfant, niveauEnfant, prefixes)
+                    if not(texte is None):
+                        morceaux.append(texte)
+                        garder(cadre, enfant)
+                else:
+                    ouvrir(enfant, niveauEnfant, '')
+                continue
+
+            # tous les enfants sont écrits: fermeture de l'élément
+            texte = elem.text
+            vide = not(texte) or not(texte.strip())
+            garde = cadre[5]
+            if (self.clean == 'all') and (niveau > 0) and (garde == 0) and (len(elem.attrib) == 0) and vide:
+                del morceaux[cadre[3]:]
+                pile.pop()
+                if len(pile) == 0:
+                    return -1
+                continue
+            if garde > 0:
+                morceaux[cadre[6]] = self.tail(cadre[7], niveau, True, places)
+                if vide:
+                    texte = '' if self.compact else '\n' + niveau*'  ' + '  '
+            elif vide and (self.clean == 'all') and (len(elem) > 0):
+                # tous ses enfants ont été supprimés: il n'y a plus rien à mettre en forme
+                texte = ''
+            if texte or (garde > 0):
+                morceaux[cadre[3]+1] = '>' + (ET._escape_cdata(texte) if texte else '')
+                morceaux.append('</' + cadre[4] + '>')
+            else:
+                morceaux[cadre[3]+1] = ' />'
+            pile.pop()
+            if len(pile) == 0:
+                return garde
+            garder(pile[-1], elem)
+
+    def branch(self, element, level, prefixes):
+        '''
+        Texte XML d'une branche du squelette (voir serializeElement), calculé une seule fois.
+
+        :param element: élément du squelette
+            :type: xml.etree.ElementTree.Element
+        :param level: niveau d'indentation de l'élément
+            :type: int
+        :param prefixes: "URI"->"préfixe" (voir namespaces)
+            :type: dict
+        :returns: texte XML, ou None si la branche est une feuille vide supprimée
+            :type: str
+        '''
+
+        branches = self.branches.setdefault((tuple(prefixes.items()), level), {})
+        if element in branches:
+            return branches[element]
+        morceaux = []
+        texte = None
+        if self.serializeElement(element, level, frozenset(), prefixes, morceaux) >= 0:
+            texte = ''.join(morceaux)
+        branches[element] = texte
+
+        return texte
+
+    def serializeText(self, TEItree):
+        '''
+        Sérialise en mémoire un arbre XML (voir serialize), sans les déclarations du fichier XML "modèle".
+
+        :param TEItree: arbre XML
+            :type: RowTree ou ElementTree
+        :returns: texte XML
+            :type: str
+        '''
+
+        racine = ET.ElementTree.getroot(TEItree)
+        frozen = getattr(TEItree, 'frozen', frozenset())
+        prefixes, places = self.scan(racine, frozen)
+        # déclarations sur la racine, par ordre de préfixe (comme ElementTree)
+        declarations = ''
+        for uri, prefix in sorted(prefixes.items(), key=lambda x: x[1]):
+            declarations = declarations + ' xmlns' + (':' + prefix if prefix else '') + '="' + ET._escape_attrib(uri) + '"'
+        morceaux = []
+        garde = self.serializeElement(racine, 0, frozen, prefixes, morceaux, declarations, places)
+        texte = racine.tail
+        if texte and texte.strip():
+            morceaux.append(ET._escape_cdata(texte))
+        elif not(self.compact):
+            if garde > 0:
+                morceaux.append('\n')
+            elif texte:
+                morceaux.append(texte)
+
+        return ''.join(morceaux)
+
+    def serialize(self, TEItree, prolog):
+        '''
+        Sérialise en mémoire un arbre XML, précédé des déclarations du fichier XML "modèle".
+
+        :param TEItree: arbre XML
+            :type: RowTree ou ElementTree
+        :param prolog: déclarations et commentaires (voir getXMLProlog)
+            :type: str
+        :returns: contenu du fichier XML, encodé en UTF-8
+            :type: bytes
+        '''
+
+        return (prolog + self.serializeText(TEItree)).encode('utf-8')
+
+#--------------------------------------------------------------
+class LxmlBackend(TreeSerializer):
+    '''
+    Sérialisation des arbres XML par lxml (libxml2, en C) à la place de TreeSerializer (en Python).
+    L'arbre de chaque ligne reste construit par ElementTree (il partage les éléments du squelette, voir
+    RowTree, ce que lxml ne permet pas): il est recopié en éléments lxml, puis nettoyé, mis en forme
+    (lxml.etree.indent) et sérialisé par lxml. Les branches du squelette restées inchangées ne sont
+    converties qu'une fois: elles sont ensuite recopiées par lxml (en C).
+    Cette recopie (en Python) coûte ce que libxml2 fait gagner: LxmlBackend n'est pas plus rapide que
+    TreeSerializer (il l'est même un peu moins sur les gros arbres). Il n'est là que pour la compatibilité,
+    pour obtenir la sérialisation de libxml2.
+
+    Le résultat est celui de TreeSerializer (mêmes préfixes d'espaces de nommage, déclarés sur la racine,
+    balises vides "<a />"), aux différences suivantes près, dans les seules valeurs qui les contiennent:
+        - une tabulation dans un attribut est écrite "&#9;" (au lieu de "&#09;");
+        - un retour chariot dans un texte est écrit "&#13;" (au lieu du caractère lui-même).
+    Une ligne contenant des caractères que lxml refuse (caractères de contrôle interdits en XML) est
+    sérialisée par TreeSerializer, comme sans lxml.
+    '''
+
+    name = 'lxml'
+
+    def __init__(self, cleanEmptyLeaf=True, compact=False):
+        TreeSerializer.__init__(self, cleanEmptyLeaf, compact)
+        self.copies = {}    # déclarations d'espaces de nommage -> branche du squelette -> sa copie lxml
+
+    def copyElement(self, element, parent, nsmap, frozen):
+        '''
+        Recopie un élément ElementTree (et ses descendants) en élément lxml.
+
+        :param element: élément à recopier
+            :type: xml.etree.ElementTree.Element
+        :param parent: parent de la copie (None pour la racine, qui porte les déclarations nsmap)
+            :type: lxml.etree._Element
+        :param nsmap: espaces de nommage à déclarer sur la racine ("préfixe"->"URI")
+            :type: dict
+        :param frozen: éléments du squelette (voir compileSkeleton), dont la copie est gardée
+            :type: frozenset
+        :returns: copie de l'élément
+            :type: lxml.etree._Element
+        '''
+
+        if not(parent is None) and (element in frozen):
+            copies = self.copies.setdefault(tuple(nsmap.items()), {})
+            branche = copies.get(element)
+            if branche is None:
+                # branche convertie une fois pour toutes, sous une racine portant les mêmes déclarations
+                branche = self.copyElement(element, lxmlET.Element('branche', nsmap=nsmap), nsmap, frozenset())
+                copies[element] = branche
+            copie = copy.deepcopy(branche)
+            parent.append(copie)
+            return copie
+        if parent is None:
+            copie = lxmlET.Element(element.tag, nsmap=nsmap)
+        else:
+            copie = lxmlET.SubElement(parent, element.tag)
+        # attributs un par un, dans leur ordre
+        for clef, valeur in element.items():
+            copie.set(clef, valeur)
+        # un texte vide donnerait "<a></a>" avec lxml, "<a />" avec ElementTree
+        copie.text = element.text or None
+        copie.tail = element.tail or None
+        for enfant in element:
+            self.copyElement(enfant, copie, nsmap, frozen)
+
+        return copie
+
+    def cleanCopy(self, copie):
+        '''
+        Supprime les feuilles vides de la copie lxml d'un arbre (voir TreeSerializer, cleanEmptyLeaf).
+
+        :param copie: racine de la copie
+            :type: lxml.etree._Element
+        :returns: None
+        '''
+
+        if not(self.clean):
+            return None
+        if self.clean == 'all':
+            parents = [element for element in copie.iter() if len(element) > 0]
+        for enfant in list(copie):
+            if not(enfant.text) and (len(enfant) == 0):
+                copie.remove(enfant)
+        if self.clean == 'all':
+            # ordre inverse du document: les enfants d'un élément sont traités avant lui
+            for element in reversed(list(copie.iter())):
+                if (len(element) == 0) and (len(element.attrib) == 0) and not(element.text and element.text.strip()) and not(element is copie):
+                    element.getparent().remove(element)
+            for element in parents:
+                if (len(element) == 0) and element.text and not(element.text.strip()):
+                    element.text = None
+
+        return None
+
+    def serializeText(self, TEItree):
+        '''
+        Sérialise en mémoire un arbre XML, sans les déclarations du fichier XML "modèle" (voir TreeSerializer).
+
+        :param TEItree: arbre XML
+            :type: RowTree ou ElementTree
+        :returns: texte XML
+            :type: str
+        '''
+
+        racine = ET.ElementTree.getroot(TEItree)
+        frozen = getattr(TEItree, 'frozen', frozenset())
+        prefixes, places = self.scan(racine, frozen)
+        if len(places) > 0:
+            # éléments présents à plusieurs places: lxml les recopierait et les mettrait en forme à chaque place
+            return TreeSerializer.serializeText(self, TEItree)
+        nsmap = {prefix: uri for uri, prefix in sorted(prefixes.items(), key=lambda x: x[1])}
+        try:
+            copie = self.copyElement(racine, None, nsmap, frozen)
+        except ValueError:
+            return TreeSerializer.serializeText(self, TEItree)
+        self.cleanCopy(copie)
+        if self.compact:
+            for element in copie.iter():
+                if (len(element) > 0) and element.text and not(element.text.strip()):
+                    element.text = None
+                if element.tail and not(element.tail.strip()):
+                    element.tail = None
+        else:
+            lxmlET.indent(copie, space='  ')
+            if (len(copie) > 0) and not(copie.tail and copie.tail.strip()):
+                copie.tail = '\n'
+        # lxml écrit les balises vides "<a/>": '/>' ne peut apparaître ailleurs ('>' est échappé dans
+        # les textes et les attributs)
+        return lxmlET.tostring(copie, encoding='unicode').replace('/>', ' />')
+
+#--------------------------------------------------------------
+def selectXMLBackend(backend, cleanEmptyLeaf=True, compact=False):
+    '''
+    Choisit la sérialisation XML: "etree" (voir TreeSerializer) ou "lxml" (voir LxmlBackend).
+    Si lxml n'est pas installé (ou trop ancien), TreeSerializer est utilisé.
+
+    :param backend: nom de la sérialisation (voir xmlBackends)
+        :type: str
+    :param cleanEmptyLeaf: suppression des feuilles vides: False, True (1er niveau) ou 'all' (toute profondeur)
+        :type: bool ou str
+    :param compact: pas de mise en forme
+        :type: bool
+    :returns: sérialisation
+        :type: TreeSerializer ou LxmlBackend
+    '''
+
+    if backend == 'lxml':
+        if (lxmlET is None) or not(hasattr(lxmlET, 'indent')):
+            print('lxml (4.5 or later) is not installed: ElementTree is used')
+        else:
+            return LxmlBackend(cleanEmptyLeaf, compact)
+
+    return TreeSerializer(cleanEmptyLeaf, compact)
+
+#--------------------------------------------------------------
+def loadCSVtoTEIMapping(pathFileCSV_Map):
+    """
+     Charge le fichier CSV de mapping entre les champs personnalisés et les champs TEI 
+     
+     :param pathFileCSV_Mapp : le chemin vers le fichier csv contenant le mapping entre des champs de metas personnalisées et des champs normalisés contenus dans un header TEI
+         (ou son contenu, voir openSource), éventuellement compressé (voir openCSVFile)
+         :type str
+    : returns: row
+        :type: orderedDict  
+    """
+    
+    Dico = None
+    csvfileMap = None
+    try:
+        with (openSource(pathFileCSV_Map) if isInlineSource(pathFileCSV_Map) else openCSVFile(pathFileCSV_Map)) as csvfileMap:
+            readerMap = csv.DictReader(csvfileMap, delimiter=';')
+             #on obtien un dico par ligne
+            for row in readerMap:
+                Dico = row
+                break
+        # exemple: clef row['Creator'] renvoie '<teiHeader><fileDesc><titleStmt><author key=""></autor></fileDesc></titleStmt></teiHeader>'
+    except (EnvironmentError, UnicodeDecodeError) + compressedErrors:
+        readError(pathFileCSV_Map)
+        
+    finally:
+        if not(csvfileMap is None):
+            csvfileMap.close()
+    # on renvoie la dernière ligne
+    return Dico
+    
+#--------------------------------------------------------------
+def compileTemplate(chaine, slots):
+    '''
+    Découpe un texte (ou une valeur d'attribut) du mini-arbre de mapping en morceaux: texte fixe (str)
+    et numéros de '?' (int). Les numéros trouvés sont ajoutés à la liste "slots".
+
+    :param chaine: texte contenant éventuellement des marqueurs slotStart+numéro+slotStop
+        :type str (ou None)
+    :param slots: liste des numéros de '?' trouvés
+        :type list
+    :returns: chaine elle-même s'il n'y a pas de '?', sinon tuple de morceaux
+        :type str, None ou tuple
+    '''
+
+    if (chaine is None) or (chaine.find(slotStart) == -1):
+        return chaine
+    morceaux = []
+    for n, morceau in enumerate(chaine.split(slotStart)):
+        if n > 0:
+            numero, morceau = morceau.split(slotStop, 1)
+            slots.append(int(numero))
+            morceaux.append(int(numero))
+        if not(morceau == ''):
+            morceaux.append(morceau)
+
+    return tuple(morceaux)
+
+
+#--------------------------------------------------------------
+def compileNode(node, slots):
+    '''
+    Compile un élément du mini-arbre de mapping (et sa descendance) en tuple
+    (tag, attributs, texte, queue, enfants, attributs fixes), les textes et valeurs d'attributs étant découpés
+    par compileTemplate. "attributs fixes" est le dictionnaire des attributs lorsqu'ils ne contiennent aucun '?'.
+    fonction récursive.
+
+    :param node: élément du mini-arbre
+        :type: xmltree element
+    :param slots: liste des numéros de '?' trouvés
+        :type list
+    :returns: noeud compilé, ou None si un '?' se trouve dans un nom de balise ou d'attribut
+        :type tuple
+    '''
+
+    if (node.tag.find(slotStart) > -1):
+        return None
+    attributs = []
+    fixes = {}
+    for nom, valeur in node.attrib.items():
+        if (nom.find(slotStart) > -1):
+            return None
+        attributs.append((nom, compileTemplate(valeur, slots)))
+        if (fixes is not None) and (type(attributs[-1][1]) is tuple):
+            fixes = None
+        elif (fixes is not None):
+            fixes[nom] = valeur
+    enfants = []
+    for enfant in node:
+        compiled = compileNode(enfant, slots)
+        if compiled is None:
+            return None
+        enfants.append(compiled)
+
+    return (node.tag, tuple(attributs), compileTemplate(node.text, slots), compileTemplate(node.tail, slots), tuple(enfants), fixes)
+
+
+#--------------------------------------------------------------
+def compileMapping(mapping):
+    '''
+    Compile une chaine de mapping (balises XML contenant des '?') en plan d'insertion: le mini-arbre est parsé
+    une seule fois, chaque '?' étant repéré par son numéro d'ordre dans la chaine. Pour chaque ligne de données,
+    il suffira alors de remplir les "trous" (voir buildFragment), sans repasser par dispatchValues et ET.fromstring.
+
+    :param mapping: chaine de balises XML (déclarations d'espaces de nommage comprises)
+        :type str
+    :returns: plan d'insertion, ou None si la chaine ne peut pas être compilée (on utilisera alors
+              dispatchValues et AddToTree, comme avant)
+        :type MappingPlan
+    '''
+
+    if (mapping.find(slotStart) > -1) or (mapping.find(slotStop) > -1):
+        return None
+    # numéroter chaque '?' avec un marqueur qui ne peut pas se trouver dans le fichier de mapping
+    morceaux = mapping.split('?')
+    chaine = morceaux[0]
+    for n in range(1, len(morceaux)):
+        chaine = chaine + slotStart + str(n-1) + slotStop + morceaux[n]
+    try:
+        miniTree = ET.fromstring(chaine)
+    except ET.ParseError:
+        return None
+    slots = []
+    fragment = compileNode(miniTree, slots)
+    # tous les '?' doivent se retrouver, une seule fois, dans un texte ou une valeur d'attribut
+    # (un '?' dans un commentaire ou une URI d'espace de nommage, par ex., ne sera pas compilé)
+    if (fragment is None) or (not(sorted(slots) == list(range(len(morceaux)-1)))):
+        return None
+    '''
+    Le mini-arbre est-il un simple chemin (une seule balise fille à chaque niveau, jamais deux fois la même
+    balise de suite) ? Dans ce cas, la fusion dans l'arbre principal peut se faire directement depuis le plan
+    (voir mergePlan).
+    '''
+    isPath = True
+    node = fragment
+    while len(node[4]) > 0:
+        if (len(node[4]) > 1) or (node[4][0][0] == node[0]):
+            isPath = False
+            break
+        node = node[4][0]
+    '''
+    Les guillemets (simples ou doubles) ne changent le parsing que s'ils ferment une valeur d'attribut
+    contenant un '?': on vérifie, pour chacun, que la chaine remplie avec lui donne bien le mini-arbre du plan.
+    '''
+    unsafe = unsafeValue
+    for guillemet in ('"', "'"):
+        valeurs = [guillemet]*(len(morceaux)-1)
+        try:
+            miniTree = ET.fromstring(dispatchValues(mapping, '|'.join(valeurs)))
+        except ET.ParseError:
+            continue
+        if ET.tostring(miniTree) == ET.tostring(buildNode(fragment, valeurs)):
+            unsafe = re.compile(unsafe.pattern.replace(guillemet, ''))
+
+    return MappingPlan(mapping, len(morceaux)-1, fragment, isPath, unsafe)
+
+
+#--------------------------------------------------------------
+def check_TEIMapping(TEIMapping, declarations, plans=None):
+    """
+    Vérifie le mapping TEI: pas de clef ou de valeur vide. Au passage, supprime les clefs avec valeur "none".
+    Si "plans" est fourni, y range le plan d'insertion compilé de chaque colonne (voir compileMapping).
+
+    :param TEIMapping : dictionnaire ordonné contenant les couples "entête de colonne"->"balises"
+        :type orderedDict
+    :param decalarations: liste des balises de déclaration d'espaces de nommage (namespace, i.e. 'xmlns:')
+        :type list
+    :param plans: dictionnaire "entête de colonne"->plan d'insertion, complété par la fonction
+        :type dict
+    : returns: ckecked_Ok: la vérification s'est bien passée ou il y a des choses à corriger
+        :type bool
+    """
+    
+    ckecked_Ok = True
+    # liste des clefs à supprimer du dictionnaire
+    KeystoDelete = []
+    n = 0
+    for clef in TEIMapping:
+        n = n+1
+        nkey = str(clef).strip()
+        # on vérifie que la clef est correcte
+        if (clef is None) or (nkey == ''):            
+            print('Warning: column ',n,'is empty\n')
+            # erreur à corriger: on arrêtera le traitement
+            ckecked_Ok = False
+        else:   # la clef est correcte
+            # on récupère les balises TEI correspondantes
+            value = TEIMapping.get(clef,None)
+            nvalue = str(value).strip().lower()
+            # on vérifie que la valeur existe
+            if (value is None) or (nvalue == ''):
+                print('Warning: column ',n,' ',clef,'= "No mapping string"\n')
+                # erreur à corriger: on arrêtera le traitement
+                ckecked_Ok = False
+            else:    # on a une valeur de conversion 
+                # si on a décidé de ne pas convertir ce champs    
+                if (nvalue == 'none'):
+                    # on ajoute la clef à la liste des clefs à supprimer du dictionnaire
+                    KeystoDelete.append(clef)
+                else:    
+                    # Si on a un mapping qui n'est pas sous forme de balises, le tranformer en balises
+                    if (nvalue.find('<')==-1):
+                        tmpStr = '<'+nvalue+'>?</'+nvalue+'>'
+                        TEIMapping[clef] = tmpStr
+                    '''
                     Si on a un (des) espace(s) de nommage, on doit encadrer les balises avec, sinon
                     le parsing en arbre ne pourra se faire, car le parser ne pourra pas interpréter
                     les noms de balises qualifiés (ex: "dcterms:description").
@@ -242,11 +1413,14 @@ def check_TEIMapping(TEIMapping, declarations):
                             TEIMapping[clef] = tmpStr 
                             value = TEIMapping.get(clef,None)
                     try:                
-                        ET.fromstring(value)                                        
+                        ET.fromstring(value)
                     except ET.ParseError as e:
                         print('\nError in XML string on field n°'+str(n)+': "'+clef+'" <-> "'+value+'"')
                         print ('->',e.msg)
                         ckecked_Ok = False
+                    else:
+                        if not(plans is None):
+                            plans[clef] = compileMapping(TEIMapping[clef])
 
     if (ckecked_Ok == True) and  (len(KeystoDelete) > 0) :
         for idx in KeystoDelete:
@@ -257,124 +1431,299 @@ def check_TEIMapping(TEIMapping, declarations):
 
 
 #--------------------------------------------------------------
-def cleanXMLFromEmptyLeaf(TEItree):
+def compileSkeleton(XMLTree):
     '''
-    Supprime les feuilles vides de l'arbre XML, sous la racine uniquement (1er niveau d'arborescence)
-    Les éléments ayant une descendance, ne sont pas des feuilles, mais des branches...
-    :param TEItree: arbre XML à traiter
+    Prépare l'arbre XML de base pour les arbres de chaque ligne (voir RowTree): une copie, mise en forme
+    une fois pour toutes (voir indent), dont les éléments ne seront plus jamais modifiés.
+
+    :param XMLTree: arbre XML de base
         :type: ElementTree
-    :returns: None        
-    '''
-    toDelete = []
-    rootNode = ET.ElementTree.getroot(TEItree)    # insertionPoint est un Element
-    for node in rootNode:
-        # pas de texte
-        if ((node.text==None) or (node.text=='')):
-            # pas de descendant
-            if (len(list(node))==0):
-                # on met dans une liste de noeuds à supprimer
-                toDelete.append(node)            
-    for node in toDelete:
-        rootNode.remove(node)
-        
-    return None
+    :returns: racine de la copie et ensemble de ses éléments
+        :type: Skeleton
+    '''
+
+    root = copy.deepcopy(ET.ElementTree.getroot(XMLTree))
+    indent(root)
 
+    return Skeleton(root, frozenset(root.iter()))
 
 #--------------------------------------------------------------
-def AddToTree(TEItree,belleclef):
-    """
-     Ajoute les balises TEI mappées à l'arbre XML 
-     "belleclef" (mini-arborescence sous forme de texte) est convertie en arbre XML. 
-     On ajoute cet arbre à l'arbre principal(TEItree), au moins ce qu'il a et qui n'est
-     pas dans l'arbre principal.
-     
-    :param TEItree : arbre 
-        :type ElementTree
-    :param belleclef : chaine de balises TEI contenant les données d'un champ
-        :type string
-    :returns: None
-    """
-    
-    # on commence la recherche à la racine de l'arbre XML
-    insertionPoint = ET.ElementTree.getroot(TEItree)    # insertionPoint est un Element
-    # ET.dump(TEItree)    
-    oldInsertionPoint = insertionPoint
-    # on créé un petit arbre XML avec la chaine de "mapping"
-    miniTree = ET.fromstring(belleclef)
-        
-    # parcourir le mini arbre du haut vers le bas 
-    for balise in miniTree.iter():
-        found = False
+def nodeKey(tag, attrib):
+    '''
+    Clef d'index d'un élément: son tag et ses attributs (deux éléments ont la même clef si leurs tags sont
+    identiques et leurs dictionnaires d'attributs égaux).
+
+    :param tag: tag de l'élément
+        :type: str
+    :param attrib: attributs de l'élément
+        :type: dict
+    :returns: clef
+        :type: str ou tuple
+    '''
+    if len(attrib) == 0:
+        return tag
+    return (tag, frozenset(attrib.items()))
+
+#--------------------------------------------------------------
+class ChildIndex(object):
+    '''
+    Index des enfants d'un élément, pour la fusion des balises (voir mergeFragment):
+     - first: pour chaque clef (voir nodeKey), le premier enfant (dans l'ordre du document) ayant cette clef
+     - inRun: les clefs dont ce premier enfant fait partie de la 1ère suite continue d'enfants de même tag
+     - runStart, runLen: position et longueur de la 1ère suite continue d'enfants de chaque tag
+    '''
+    __slots__ = ('first', 'inRun', 'runStart', 'runLen', 'size')
+
+    def __init__(self, parent):
+        self.first = {}
+        self.inRun = set()
+        self.runStart = {}
+        self.runLen = {}
+        self.size = 0
+        for child in parent:
+            self.appended(child)
+
+    def appended(self, child):
         '''
-        Si la racine est la même pour les deux arbres, ça pose problème puisqu'on va commencer 
-        à chercher la balise "racine" du miniTree sous la racine de TEItree. Il faut donc passer son tour...
+        Mise à jour de l'index après l'ajout d'un enfant à la fin de la liste.
         '''
-        if (balise.tag == insertionPoint.tag):
-            pass
-        else:    
-            for candidat in insertionPoint.findall(balise.tag):           
-                # si on a trouvé la même balise avec le même attribut (attribut est du type "dict")          
-                if (candidat is not None) and (candidat.attrib == balise.attrib) and (found==False):
-                    ''' 
-                    on retraite les champs "texte" de la balise et de la balise courante de l'arbre (dans des variables
-                    temporaires) pour qu'elle contienne du texte (type str) nettoyé des espaces, retour chariot et autres 
-                    caractères indésirables que l'on peut trouver avant et après le texte. Le champ texte peut être de 
-                    type None et pas str (chaine vide).
-                    '''
-                    if candidat.text==None:
-                        contenuC = ''
-                    else:
-                        contenuC=candidat.text    
-                    if balise.text==None:
-                        contenuB = ''
-                    else:
-                        contenuB=balise.text
-                    contenuC=contenuC.strip()
-                    contenuB=contenuB.strip()
-                    found = True
-               
-                    oldInsertionPoint = insertionPoint
-                    insertionPoint = candidat
-                    # s'il n'y a pas de contenu dans la balise "courante" de l'arbre ("candidat")    
-                    if (contenuC==''):   
-                        # et on a un nouveau texte
-                        if not(contenuC==contenuB):  
-                            # alors, on insere le texte dans la balise de l'arbre
-                            insertionPoint.text=balise.text                                                         
-                    else:        # on a du texte dans "candidat"
-                        # on a aussi du contenu (différente) dans la balise, au même niveau    
-                        if (not(contenuC==contenuB)) and (not(contenuB=='')):   
-                            # On va forcer la répétition de la balise au même niveau, mais avec un autre texte
-                            # on recherche le "numéro" de noeud du dernier "Candidat"
-                            idx = 0
-                            gotIt = False
-                            for node in oldInsertionPoint:
-                                if not(node.tag == candidat.tag):
-                                     # rechercher le 1er "candidat" dans les nodes
-                                    if gotIt ==False:
-                                        idx = idx + 1                                    
-                                    else:   # on a dépassé la liste des noeuds correspondants à la recherche
-                                        break  # on arrête la recherche, car on atrouvé l'emplacement d'insertion
-                                
-                                else:   # on a trouvé le 1er noeud correspondant à la recherche
-                                    if gotIt==False:
-                                        gotIt = True
-                                    # compter les candidats
-                                    idx = idx + 1
-                            # element.insert(index,element): inserts subelement at the given position in this element.
-                            oldInsertionPoint.insert(idx,balise)
-                            insertionPoint = oldInsertionPoint
-            # la balise n'est trouvée dans l'arbre
-            if (found == False):    
-                # on insère la balise après le point courant dans l'arbre
-                insertionPoint.append(balise)
-                # le nouveau point d'insertion est la balise que l'on vient d'insérer
-                insertionPoint = balise
-                found = True
-                  
-    return None
+        tag = child.tag
+        key = nodeKey(tag, child.attrib)
+        start = self.runStart.get(tag, None)
+        if start is None:
+            self.runStart[tag] = self.size
+            self.runLen[tag] = 1
+            inRun = True
+        elif start + self.runLen[tag] == self.size:
+            # l'enfant prolonge la 1ère suite de son tag
+            self.runLen[tag] = self.runLen[tag] + 1
+            inRun = True
+        else:
+            inRun = False
+        if not(key in self.first):
+            self.first[key] = child
+            if inRun:
+                self.inRun.add(key)
+        self.size = self.size + 1
 
-#--------------------------------------------------------------
+    def insertedAfterRun(self, child):
+        '''
+        Mise à jour de l'index après l'insertion d'un enfant à la fin de la 1ère suite d'enfants de son tag
+        (voir runEnd).
+        '''
+        tag = child.tag
+        key = nodeKey(tag, child.attrib)
+        idx = self.runStart[tag] + self.runLen[tag]
+        self.runLen[tag] = self.runLen[tag] + 1
+        # les suites des autres tags placées après sont décalées d'un cran
+        for autre, start in self.runStart.items():
+            if start >= idx and not(autre == tag):
+                self.runStart[autre] = start + 1
+        # les enfants de même clef hors de la 1ère suite sont forcément placés après le nouvel enfant
+        if not(key in self.inRun):
+            self.first[key] = child
+            self.inRun.add(key)
+        self.size = self.size + 1
+
+    def runEnd(self, tag):
+        '''
+        Position qui suit la 1ère suite continue d'enfants de ce tag.
+        '''
+        return self.runStart[tag] + self.runLen[tag]
+
+#--------------------------------------------------------------
+class TreeIndex(object):
+    '''
+    Index des éléments d'un arbre XML, par parent, tag et attributs (voir ChildIndex), construit au fur
+    et à mesure des recherches. Remplace, pendant la fusion des balises d'une ligne, les recherches
+    "findall" et les parcours de la liste des enfants: chaque recherche ou ajout se fait en temps constant.
+    Toutes les modifications de l'arbre, pendant la fusion, doivent passer par cet index.
+    '''
+
+    def __init__(self):
+        self.children = {}    # parent -> ChildIndex
+
+    def childIndex(self, parent):
+        index = self.children.get(parent, None)
+        if index is None:
+            index = ChildIndex(parent)
+            self.children[parent] = index
+        return index
+
+    def find(self, parent, tag, attrib):
+        '''
+        Premier enfant de "parent" ayant ce tag et ces attributs (None s'il n'y en a pas).
+        '''
+        return self.childIndex(parent).first.get(nodeKey(tag, attrib), None)
+
+    def append(self, parent, child):
+        '''
+        Ajoute "child" à la fin des enfants de "parent".
+        '''
+        self.childIndex(parent).appended(child)
+        parent.append(child)
+
+    def insertAfterRun(self, parent, child):
+        '''
+        Insère "child" à la suite du premier groupe d'enfants de "parent" ayant le même tag
+        (répétition d'une balise au même niveau).
+        '''
+        index = self.childIndex(parent)
+        parent.insert(index.runEnd(child.tag), child)
+        index.insertedAfterRun(child)
+
+    def replace(self, parent, old, new):
+        '''
+        Remplace l'enfant "old" de "parent" par "new", de mêmes tag et attributs, à la même place.
+        '''
+        parent[list(parent).index(old)] = new
+        index = self.children.get(parent, None)
+        if not(index is None):
+            key = nodeKey(old.tag, old.attrib)
+            if index.first.get(key, None) is old:
+                index.first[key] = new
+
+#--------------------------------------------------------------
+class RowTree(ET.ElementTree):
+    '''
+    Arbre XML d'une ligne de données, construit à partir du squelette de l'arbre de base (voir compileSkeleton)
+    sans le recopier entièrement: seule la racine est copiée au départ. Les éléments du squelette sont partagés
+    et ne sont copiés ("matérialisés", voir materialize) que lorsque l'ajout des balises d'un champ les modifie.
+    L'arbre tient aussi l'index de ses éléments (voir TreeIndex) pendant la fusion des balises.
+    '''
+
+    def __init__(self, skeleton):
+        '''
+        :param skeleton: squelette de l'arbre XML de base
+            :type: Skeleton
+        '''
+        ET.ElementTree.__init__(self, copy.copy(skeleton.root))
+        self.frozen = skeleton.frozen
+        self.index = TreeIndex()
+        # nombre de balises répétées au même niveau (voir mergeFragment)
+        self.repeated = 0
+
+    def materialize(self, parent, child):
+        '''
+        Remplace, dans son parent, un élément du squelette par une copie propre à cette ligne (les éléments
+        fils restent partagés).
+
+        :param parent: élément parent, propre à cette ligne
+            :type: xmltree element
+        :param child: élément fils
+            :type: xmltree element
+        :returns: l'élément fils, modifiable
+            :type: xmltree element
+        '''
+        if child in self.frozen:
+            copie = copy.copy(child)
+            self.index.replace(parent, child, copie)
+            return copie
+        return child
+
+#--------------------------------------------------------------
+def AddToTree(TEItree,belleclef):
+    """
+     Ajoute les balises TEI mappées à l'arbre XML 
+     "belleclef" (mini-arborescence sous forme de texte) est convertie en arbre XML. 
+     On ajoute cet arbre à l'arbre principal(TEItree), au moins ce qu'il a et qui n'est
+     pas dans l'arbre principal.
+     
+    :param TEItree : arbre
+        :type ElementTree
+    :param belleclef : chaine de balises TEI contenant les données d'un champ
+        :type string
+    :returns: None
+    """
+
+    # on créé un petit arbre XML avec la chaine de "mapping"
+    miniTree = ET.fromstring(belleclef)
+    mergeFragment(TEItree, miniTree)
+
+    return None
+
+#--------------------------------------------------------------
+def mergeFragment(TEItree, miniTree):
+    """
+     Ajoute un mini-arbre XML (déjà construit) à l'arbre principal (TEItree), au moins ce qu'il a et qui n'est
+     pas dans l'arbre principal. Les éléments du mini-arbre sont réutilisés tels quels dans l'arbre principal.
+
+    :param TEItree : arbre
+        :type ElementTree
+    :param miniTree : mini-arbre contenant les données d'un champ
+        :type xmltree element
+    :returns: None
+    """
+
+    # on commence la recherche à la racine de l'arbre XML
+    insertionPoint = ET.ElementTree.getroot(TEItree)    # insertionPoint est un Element
+    # ET.dump(TEItree)
+    oldInsertionPoint = insertionPoint
+    # index des éléments de l'arbre: celui de la ligne, ou un index temporaire pour un arbre quelconque
+    index = TEItree.index if isinstance(TEItree, RowTree) else TreeIndex()
+
+    # parcourir le mini arbre du haut vers le bas
+    for balise in miniTree.iter():
+        found = False
+        '''
+        Si la racine est la même pour les deux arbres, ça pose problème puisqu'on va commencer 
+        à chercher la balise "racine" du miniTree sous la racine de TEItree. Il faut donc passer son tour...
+        '''
+        if (balise.tag == insertionPoint.tag):
+            pass
+        else:
+            # premier élément de l'arbre avec la même balise et les mêmes attributs (attribut est du type "dict")
+            candidat = index.find(insertionPoint, balise.tag, balise.attrib)
+            if (candidat is not None):
+                ''' 
+                on retraite les champs "texte" de la balise et de la balise courante de l'arbre (dans des variables
+                temporaires) pour qu'elle contienne du texte (type str) nettoyé des espaces, retour chariot et autres 
+                caractères indésirables que l'on peut trouver avant et après le texte. Le champ texte peut être de 
+                type None et pas str (chaine vide).
+                '''
+                if candidat.text==None:
+                    contenuC = ''
+                else:
+                    contenuC=candidat.text    
+                if balise.text==None:
+                    contenuB = ''
+                else:
+                    contenuB=balise.text
+                contenuC=contenuC.strip()
+                contenuB=contenuB.strip()
+                found = True
+                # on va modifier la balise de l'arbre: elle doit être propre à cette ligne (voir RowTree)
+                if isinstance(TEItree, RowTree):
+                    candidat = TEItree.materialize(insertionPoint, candidat)
+
+                oldInsertionPoint = insertionPoint
+                insertionPoint = candidat
+                # s'il n'y a pas de contenu dans la balise "courante" de l'arbre ("candidat")    
+                if (contenuC==''):   
+                    # et on a un nouveau texte
+                    if not(contenuC==contenuB):  
+                        # alors, on insere le texte dans la balise de l'arbre
+                        insertionPoint.text=balise.text                                                         
+                else:        # on a du texte dans "candidat"
+                    # on a aussi du contenu (différente) dans la balise, au même niveau    
+                    if (not(contenuC==contenuB)) and (not(contenuB=='')):   
+                        # On va forcer la répétition de la balise au même niveau, mais avec un autre texte,
+                        # à la suite du premier groupe de noeuds "candidat" (position donnée par l'index)
+                        index.insertAfterRun(oldInsertionPoint, balise)
+                        insertionPoint = oldInsertionPoint
+                        if isinstance(TEItree, RowTree):
+                            TEItree.repeated = TEItree.repeated + 1
+            # la balise n'est trouvée dans l'arbre
+            if (found == False):    
+                # on insère la balise après le point courant dans l'arbre
+                index.append(insertionPoint, balise)
+                # le nouveau point d'insertion est la balise que l'on vient d'insérer
+                insertionPoint = balise
+                found = True
+                  
+    return None
+
+#--------------------------------------------------------------
 def dispatchValues(clef, valeurs):
     """
     Ventile les morceaux de texte séparés par '|' (contenus dans "valeurs") à la place des '?' 
@@ -402,78 +1751,2350 @@ def dispatchValues(clef, valeurs):
                 chaine =listeValeurs[cpt]
             # un seul remplacement d'un seul '?' à la fois    
             clef = str(clef).replace('?',chaine,1)
-        cpt = cpt + 1 
-        
+        cpt = cpt + 1
+
     return clef
 
 #--------------------------------------------------------------
-def doMap_aRow(XMLTree, row, numRow, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf):
+def isPlainValue(plan, valeurs):
     """
-    Applique le mapping TEI sur une ligne de données.
-    
-    :param XMLTree: arbre XML de base
-        :type xml.elementree
-    :param row : dictionnaire ordonné contenant les couples "entête de colonne"->"données"
-        :type orderedDict
+    Indique si le plan d'insertion compilé peut être utilisé pour ces valeurs, c'est-à-dire si l'insertion
+    des valeurs dans la chaine de mapping puis son parsing (dispatchValues + AddToTree) ne feraient rien
+    de plus que remplir les '?': pas de balisage, d'entité ou de guillemet fermant une valeur d'attribut
+    dans les valeurs (voir compileMapping), et pas de '?' qui serait lui-même remplacé par la valeur suivante.
+
+    :param plan: plan d'insertion compilé
+        :type MappingPlan
+    :param valeurs: contenu du champ "texte"
+        :type string
+    : returns: le plan est utilisable ou non
+        :type bool
+    """
+
+    if not(plan.unsafe.search(valeurs) is None):
+        return False
+    if (plan.nbSlots > 1) and (valeurs.find('?') > -1):
+        return False
+
+    return True
+
+#--------------------------------------------------------------
+def fillTemplate(template, valeurs):
+    '''
+    Remplit un texte compilé (voir compileTemplate) avec les valeurs ventilées.
+
+    :param template: texte compilé
+        :type str, None ou tuple
+    :param valeurs: valeur de chaque '?'
+        :type list
+    :returns: texte rempli
+        :type str (ou None)
+    '''
+
+    if not(type(template) is tuple):
+        return template
+    chaine = ''.join([valeurs[morceau] if type(morceau) is int else morceau for morceau in template])
+    # comme le parser XML: un texte vide est None
+    if chaine == '':
+        return None
+    return chaine
+
+#--------------------------------------------------------------
+def fillAttributes(attributs, valeurs):
+    '''
+    Remplit les valeurs d'attributs compilées d'un noeud.
+
+    :param attributs: couples (nom, valeur compilée)
+        :type tuple
+    :param valeurs: valeur de chaque '?'
+        :type list
+    :returns: attributs remplis
+        :type dict
+    '''
+
+    attrib = {}
+    for nom, valeur in attributs:
+        valeur = fillTemplate(valeur, valeurs)
+        # une valeur d'attribut vide reste une chaine vide
+        attrib[nom] = '' if valeur is None else valeur
+
+    return attrib
+
+#--------------------------------------------------------------
+def buildNode(node, valeurs):
+    '''
+    Construit un élément XML (et sa descendance) à partir d'un noeud compilé (voir compileNode).
+    fonction récursive.
+
+    :param node: noeud compilé
+        :type tuple
+    :param valeurs: valeur de chaque '?'
+        :type list
+    :returns: élément XML
+        :type xmltree element
+    '''
+
+    tag, attributs, texte, queue, enfants, fixes = node
+    elem = ET.Element(tag, fillAttributes(attributs, valeurs) if fixes is None else fixes)
+    elem.text = fillTemplate(texte, valeurs)
+    elem.tail = fillTemplate(queue, valeurs)
+    for enfant in enfants:
+        elem.append(buildNode(enfant, valeurs))
+
+    return elem
+
+#--------------------------------------------------------------
+def dispatchPlanValues(plan, valeurs):
+    """
+    Ventile les morceaux de texte séparés par '|' à la place des '?' d'un plan d'insertion compilé,
+    terme à terme (même règle que dispatchValues).
+
+    :param plan: plan d'insertion compilé
+        :type MappingPlan
+    :param valeurs: contenu du champ "texte"
+        :type string
+    : returns: valeur de chaque '?'
+        :type list
+    """
+
+    listeValeurs = str(valeurs).split('|')
+    nbValeurs = len(listeValeurs)
+    nbInterrogations = plan.nbSlots
+    remplissage = []
+    cpt = 0
+    while cpt < nbInterrogations:
+        if cpt < nbValeurs:
+            if ( ((cpt+1)==nbInterrogations) and (nbValeurs > nbInterrogations) ):
+                # le dernier '?' reçoit le reste, s'il y a plus de valeurs que de points d'interrogation
+                remplissage.append(('|').join(listeValeurs[cpt:]))
+            else:
+                remplissage.append(listeValeurs[cpt])
+        else:
+            # pas assez de valeurs: le '?' reste tel quel
+            remplissage.append('?')
+        cpt = cpt + 1
+
+    return remplissage
+
+#--------------------------------------------------------------
+def buildFragment(plan, valeurs):
+    """
+    Construit le mini-arbre XML d'un champ à partir de son plan d'insertion compilé
+    (l'équivalent de ET.fromstring(dispatchValues(mapping, valeurs))).
+
+    :param plan: plan d'insertion compilé
+        :type MappingPlan
+    :param valeurs: contenu du champ "texte"
+        :type string
+    : returns: mini-arbre
+        :type xmltree element
+    """
+
+    return buildNode(plan.fragment, dispatchPlanValues(plan, valeurs))
+
+#--------------------------------------------------------------
+def mergePlan(TEItree, plan, valeurs):
+    """
+    Ajoute à l'arbre XML les balises d'un champ, à partir de son plan d'insertion compilé.
+    Même résultat que mergeFragment(TEItree, buildFragment(plan, valeurs)), mais lorsque le mini-arbre est
+    un simple chemin, on le suit directement dans l'arbre principal: seules les balises réellement ajoutées
+    sont construites. Dès que la répétition d'une balise est nécessaire, on laisse faire mergeFragment,
+    qui repasse sans effet sur le début du chemin déjà fusionné.
+
+    :param TEItree : arbre
+        :type ElementTree
+    :param plan: plan d'insertion compilé
+        :type MappingPlan
+    :param valeurs: contenu du champ "texte"
+        :type string
+    :returns: None
+    """
+
+    remplissage = dispatchPlanValues(plan, valeurs)
+    if not(plan.isPath):
+        mergeFragment(TEItree, buildNode(plan.fragment, remplissage))
+        return None
+
+    insertionPoint = ET.ElementTree.getroot(TEItree)
+    index = TEItree.index if isinstance(TEItree, RowTree) else TreeIndex()
+    node = plan.fragment
+    while not(node is None):
+        tag, attributs, texte, queue, enfants, fixes = node
+        # même racine: on passe son tour (voir mergeFragment)
+        if not(tag == insertionPoint.tag):
+            attrib = fillAttributes(attributs, remplissage) if fixes is None else fixes
+            candidat = index.find(insertionPoint, tag, attrib)
+            if candidat is None:
+                # la balise n'est pas dans l'arbre: on l'ajoute, avec sa descendance, et c'est fini
+                index.append(insertionPoint, buildNode(node, remplissage))
+                return None
+            # on va modifier la balise de l'arbre: elle doit être propre à cette ligne (voir RowTree)
+            if isinstance(TEItree, RowTree):
+                candidat = TEItree.materialize(insertionPoint, candidat)
+            texteB = fillTemplate(texte, remplissage)
+            contenuC = '' if candidat.text is None else candidat.text.strip()
+            contenuB = '' if texteB is None else texteB.strip()
+            if (contenuC == ''):
+                if not(contenuC == contenuB):
+                    candidat.text = texteB
+            elif (not(contenuC == contenuB)) and (not(contenuB == '')):
+                # répétition de la balise au même niveau
+                mergeFragment(TEItree, buildNode(plan.fragment, remplissage))
+                return None
+            insertionPoint = candidat
+        node = enfants[0] if len(enfants) > 0 else None
+
+    return None
+
+#--------------------------------------------------------------
+def mergeFragmentPath(TEItree, fragment):
+    """
+    Ajoute à l'arbre XML un mini-arbre en simple chemin, déjà construit et partagé entre les lignes (voir
+    FragmentCache). Même résultat que mergeFragment(TEItree, copy.deepcopy(fragment)), mais on suit le chemin
+    dans l'arbre principal (comme mergePlan): seules les balises réellement ajoutées sont recopiées.
+
+    :param TEItree : arbre
+        :type ElementTree
+    :param fragment: mini-arbre d'un champ, qui ne doit pas être modifié
+        :type xmltree element
+    :returns: None
+    """
+
+    insertionPoint = ET.ElementTree.getroot(TEItree)
+    index = TEItree.index if isinstance(TEItree, RowTree) else TreeIndex()
+    balise = fragment
+    while not(balise is None):
+        # même racine: on passe son tour (voir mergeFragment)
+        if not(balise.tag == insertionPoint.tag):
+            candidat = index.find(insertionPoint, balise.tag, balise.attrib)
+            if candidat is None:
+                # la balise n'est pas dans l'arbre: on en ajoute une copie, avec sa descendance, et c'est fini
+                index.append(insertionPoint, copy.deepcopy(balise))
+                return None
+            # on va modifier la balise de l'arbre: elle doit être propre à cette ligne (voir RowTree)
+            if isinstance(TEItree, RowTree):
+                candidat = TEItree.materialize(insertionPoint, candidat)
+            contenuC = '' if candidat.text is None else candidat.text.strip()
+            contenuB = '' if balise.text is None else balise.text.strip()
+            if (contenuC == ''):
+                if not(contenuC == contenuB):
+                    candidat.text = balise.text
+            elif (not(contenuC == contenuB)) and (not(contenuB == '')):
+                # répétition de la balise au même niveau
+                mergeFragment(TEItree, copy.deepcopy(fragment))
+                return None
+            insertionPoint = candidat
+        balise = balise[0] if len(balise) > 0 else None
+
+    return None
+
+#--------------------------------------------------------------
+class FragmentCache(object):
+    '''
+    Cache LRU des mini-arbres XML des champs: dans les fichiers de données, beaucoup de colonnes répètent les
+    mêmes valeurs (droits, institution, langue...). Le mini-arbre d'un champ n'est construit (dispatchValues et
+    ET.fromstring, ou plan compilé) qu'une fois par couple colonne-valeur, puis recopié (copy.deepcopy, ou
+    seulement les balises ajoutées, voir mergeFragmentPath) à chaque ligne qui le fusionne.
+
+    La clef est la chaine de balises TEI de la colonne (elle ne dépend que de la colonne dans un mapping, et
+    reste juste quand plusieurs mappings sont chargés, voir serveConversions) et la valeur du champ. Les
+    compteurs hits et misses (et ceux de --stats) mesurent l'efficacité du cache.
+    '''
+
+    def __init__(self, size=fragmentCacheSize):
+        '''
+        :param size: nombre maximum de mini-arbres gardés (0: pas de cache)
+            :type: int
+        '''
+        self.size = size
+        self.entries = OrderedDict()    # (balises TEI, valeur) -> (mini-arbre, simple chemin)
+        self.hits = 0
+        self.misses = 0
+
+    def resize(self, size):
+        '''
+        Change le nombre maximum de mini-arbres gardés (les plus anciens sont oubliés).
+        '''
+        self.size = size
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return None
+
+    def get(self, newclef, valeur, plan):
+        '''
+        Mini-arbre d'un champ, construit s'il n'est pas dans le cache.
+
+        :param newclef: balises TEI de la colonne
+            :type: str
+        :param valeur: contenu du champ "texte"
+            :type: str
+        :param plan: plan d'insertion compilé de la colonne (None: pas de plan)
+            :type: MappingPlan
+        :returns: mini-arbre, à ne pas modifier, et indication que le plan compilé est un simple chemin
+            utilisable pour cette valeur (voir mergeFragmentPath)
+            :type: tuple (xmltree element, bool)
+        '''
+
+        clef = (newclef, valeur)
+        entree = self.entries.get(clef, None)
+        if not(entree is None):
+            self.entries.move_to_end(clef)
+            self.hits = self.hits + 1
+            statsCount('fragment-cache-hits')
+            return entree
+
+        self.misses = self.misses + 1
+        statsCount('fragment-cache-misses')
+        if not(plan is None) and isPlainValue(plan, valeur):
+            entree = (buildFragment(plan, valeur), plan.isPath)
+        else:
+            entree = (ET.fromstring(dispatchValues(newclef, valeur)), False)
+        if self.size > 0:
+            self.entries[clef] = entree
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return entree
+
+# cache des mini-arbres des champs de ce processus
+fragmentCache = FragmentCache()
+
+#--------------------------------------------------------------
+def buildRowTree(XMLTree, champs, plans):
+    """
+    Construit l'arbre XML d'une ligne de données: les balises de chaque champ renseigné et mappé sont ajoutées,
+    dans l'ordre des colonnes, à l'arbre bâti sur le squelette de l'arbre XML de base.
+
+    :param XMLTree: squelette de l'arbre XML de base
+        :type Skeleton
+    :param champs: triplets ("entête de colonne", "données", "balises TEI") des champs à ajouter
+        :type list
+    :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+        :type: dict
+    :returns: arbre de la ligne
+        :type: RowTree
+    """
+
+    TEItree = RowTree(XMLTree)
+    for colonne, valeur, newclef in champs:
+        debut = statsStart()
+        plan = None if plans is None else plans.get(colonne,None)
+        if fragmentCache.size > 0:
+            # mini-arbre déjà construit pour la même valeur de la colonne (voir FragmentCache)
+            fragment, chemin = fragmentCache.get(newclef, valeur, plan)
+            if chemin:
+                mergeFragmentPath(TEItree, fragment)
+            else:
+                mergeFragment(TEItree, copy.deepcopy(fragment))
+        elif not(plan is None) and isPlainValue(plan, valeur):
+            # ajouter à l'arbre XML directement à partir du plan compilé
+            mergePlan(TEItree, plan, valeur)
+        else:
+            # remplacer les "?" par les morceaux de valeur
+            belleclef = dispatchValues(newclef, valeur)
+            # ajouter à l'arbre XML
+            AddToTree(TEItree,belleclef)
+        statsStop('merge', debut, colonne)
+
+    return TEItree
+
+#--------------------------------------------------------------
+class TemplateEngine(object):
+    '''
+    Moteur de conversion "template": le document XML d'une ligne est produit par simple concaténation de
+    chaines, sans construire d'arbre. Pour chaque combinaison de colonnes renseignées (dans l'ordre des
+    colonnes), le document est construit une seule fois par le moteur "tree" (buildRowTree), avec des
+    marqueurs à la place des '?', puis découpé en gabarit: morceaux de texte XML déjà sérialisés et
+    références aux '?' des champs.
+
+    Le gabarit donne le même document que le moteur "tree" tant que la forme de l'arbre ne dépend pas des
+    valeurs. Sinon, render renvoie None et la ligne est laissée au moteur "tree":
+    - valeur qui ne passe pas par le plan compilé (voir isPlainValue), ou mini-arbre qui n'est pas un chemin;
+    - '?' rempli par une valeur vide ou faite d'espaces (texte vide, feuille supprimée, mise en forme);
+    - combinaison où une balise est répétée au même niveau (textes différents, voir mergeFragment);
+    - combinaison où une balise dont un attribut vient d'un '?' a une balise soeur de même nom (la valeur
+      de l'attribut déciderait alors de la fusion des deux balises).
+    '''
+
+    def __init__(self, skeleton, plans, serializer):
+        '''
+        :param skeleton: squelette de l'arbre XML de base
+            :type: Skeleton
+        :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+            :type: dict
+        :param serializer: sérialisation des arbres XML, celle du moteur "tree" (voir selectXMLBackend)
+            :type: TreeSerializer ou LxmlBackend
+        '''
+        self.skeleton = skeleton
+        self.plans = plans
+        self.serializer = serializer
+        # combinaison de colonnes -> gabarit (None: combinaison laissée au moteur "tree")
+        self.templates = {}
+
+    def render(self, champs):
+        '''
+        Produit le document XML d'une ligne (sans les déclarations du fichier XML de base).
+
+        :param champs: triplets ("entête de colonne", "données", "balises TEI") des champs à ajouter
+            :type: list
+        :returns: document XML, ou None si la ligne doit passer par le moteur "tree"
+            :type: str
+        '''
+        colonnes = []
+        remplissages = []
+        for colonne, valeur, newclef in champs:
+            plan = self.plans.get(colonne,None)
+            if (plan is None) or not(plan.isPath) or not(isPlainValue(plan, valeur)):
+                return None
+            remplissage = dispatchPlanValues(plan, valeur)
+            for morceau in remplissage:
+                if morceau.strip() == '':
+                    return None
+            colonnes.append(colonne)
+            remplissages.append(remplissage)
+
+        combinaison = tuple(colonnes)
+        gabarit = self.templates.get(combinaison, False)
+        if gabarit is False:
+            if len(self.templates) >= templateCacheSize:
+                return None
+            gabarit = self.compile(combinaison)
+            self.templates[combinaison] = gabarit
+        if gabarit is None:
+            return None
+
+        document = []
+        for morceau in gabarit:
+            if isinstance(morceau, str):
+                document.append(morceau)
+            elif morceau[2]:
+                # valeur d'attribut: même échappement que ElementTree (seul '"' peut rester, voir isPlainValue)
+                document.append(remplissages[morceau[0]][morceau[1]].replace('"', '&quot;'))
+            else:
+                document.append(remplissages[morceau[0]][morceau[1]])
+
+        return ''.join(document)
+
+    def compile(self, combinaison):
+        '''
+        Construit le gabarit d'une combinaison de colonnes renseignées.
+
+        :param combinaison: entêtes des colonnes renseignées, dans l'ordre des colonnes
+            :type: tuple
+        :returns: morceaux de texte XML et triplets (numéro du champ, numéro du '?', dans une valeur d'attribut),
+            ou None si la combinaison doit passer par le moteur "tree"
+            :type: list
+        '''
+        champs = []
+        for numChamp, colonne in enumerate(combinaison):
+            plan = self.plans[colonne]
+            marqueurs = [templateStart+str(numChamp)+':'+str(numSlot)+templateStop for numSlot in range(plan.nbSlots)]
+            champs.append((colonne, '|'.join(marqueurs), plan.mapping))
+        TEItree = buildRowTree(self.skeleton, champs, self.plans)
+        if TEItree.repeated > 0:
+            return None
+        # une balise dont un attribut dépend des valeurs ne doit pas avoir de soeur de même nom
+        for elem in TEItree.iter():
+            vues = set()
+            doubles = set()
+            variables = set()
+            for child in elem:
+                if child.tag in vues:
+                    doubles.add(child.tag)
+                vues.add(child.tag)
+                for attribut in child.attrib.values():
+                    if attribut.find(templateStart) > -1:
+                        variables.add(child.tag)
+            if not(doubles.isdisjoint(variables)):
+                return None
+        morceaux = templateMarker.split(self.serializer.serializeText(TEItree))
+        gabarit = []
+        dansBalise = False
+        for cpt in range(0, len(morceaux), 3):
+            texte = morceaux[cpt]
+            # marqueur déjà présent dans l'arbre XML de base ou le mapping: pas de gabarit
+            if (texte.find(templateStart) > -1) or (texte.find(templateStop) > -1):
+                return None
+            if not(texte == ''):
+                gabarit.append(texte)
+            # '<' et '>' sont échappés ailleurs que dans le balisage: le '?' suivant est-il dans une balise ?
+            if not(texte.rfind('<') == texte.rfind('>')):
+                dansBalise = texte.rfind('<') > texte.rfind('>')
+            if cpt+2 < len(morceaux):
+                gabarit.append((int(morceaux[cpt+1]), int(morceaux[cpt+2]), dansBalise))
+
+        return gabarit
+
+#--------------------------------------------------------------
+def buildXMLDocument(XMLTree, row, numRow, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates=None, backend=None, columns=None):
+    """
+    Applique le mapping TEI sur une ligne de données et produit le fichier XML correspondant, en mémoire.
+
+    :param XMLTree: arbre XML de base, de préférence déjà préparé par compileSkeleton
+        :type xml.elementree ou Skeleton
+    :param row : dictionnaire ordonné contenant les couples "entête de colonne"->"données", ou liste des données
+        dans l'ordre des colonnes du fichier de données si "columns" est fourni
+        :type orderedDict ou list
     :param numRow: numéro de la ligne
-        :type int        
+        :type int
     :param TEIMapping : dictionnaire ordonné contenant les couples "entête de colonne"->"balises TEI"
         :type orderedDict
     :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
         : type: str
-    :param outPath: dossier pour stocker le fichiers créés
-        :type: str    
-    :returns: chemin d'accès (outPath+cote)
+    :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+        :type: dict
+    :param prolog: déclarations et commentaires du fichier XML de base (voir getXMLProlog)
         :type: str
+    :param templates: moteur "template" à essayer avant l'arbre XML (None: moteur "tree" seul)
+        :type: TemplateEngine
+    :param backend: sérialisation de l'arbre XML, avec suppression des feuilles vides et mise en forme
+        (voir selectXMLBackend; None: TreeSerializer, d'après cleanEmptyLeaf)
+        :type: TreeSerializer ou LxmlBackend
+    :param columns: colonnes du fichier de données, résolues une fois pour toutes d'après le mapping (les
+        colonnes sans mapping sont signalées par l'appelant, une fois pour tout le fichier)
+        :type: ColumnPlan
+    :returns: nom du fichier, sans extension (cote) et contenu du fichier
+        :type: tuple (str, bytes)
     """
 
-    # on démarre avec un bel arbre tout propre, une copie de l'abre XML "minimal" de base
-    TEItree = copy.deepcopy(XMLTree)
+    # l'arbre de base, s'il n'a pas déjà été préparé (voir compileSkeleton)
+    if not(isinstance(XMLTree, Skeleton)):
+        XMLTree = compileSkeleton(XMLTree)
     cote = ''
-    # on traite chaque ligne, colonne par colonne 
-    for colonne in row:
-        # pour chaque entête de colonne, récupérer la cellule contenant la valeur
-        valeur = row.get(colonne,None)
-        # on ne recherche que pour des champs ayant une valeur
-        if not(((valeur).strip()).lower() == 'none'):
-            if colonne == nameColumn:
-                cote = valeur
-            # chercher les balises TEI correspondant à l'entête de colonne dans TEIMapping
-            newclef = TEIMapping.get(colonne,None)
-            # si on trouve la correspondance
-            if not(newclef is None):              
-                # remplacer les "?" par les morceaux de valeur
-                belleclef = dispatchValues(newclef, valeur)
-                # ajouter à l'arbre XML
-                AddToTree(TEItree,belleclef)  
-            else:
-                if verbose:
-                    print('Line',str(numRow),'-> no mapping for "',colonne,'"') 
-    
-    # nettoyage des feuilles vides de l'arbre
-    if cleanEmptyLeaf==True:
-        cleanXMLFromEmptyLeaf(TEItree)
-        
-    # mise en forme de l'arbre
-    indent(ET.ElementTree.getroot(TEItree))            
+    champs = []
+    if not(columns is None):
+        # seules les colonnes mappées sont lues
+        cote, champs = columns.fields(row)
+    else:
+        # on traite chaque ligne, colonne par colonne 
+        for colonne in row:
+            # pour chaque entête de colonne, récupérer la cellule contenant la valeur
+            valeur = row.get(colonne,None)
+            # on ne recherche que pour des champs ayant une valeur
+            if not(((valeur).strip()).lower() == 'none'):
+                if colonne == nameColumn:
+                    cote = valeur
+                # chercher les balises TEI correspondant à l'entête de colonne dans TEIMapping
+                newclef = TEIMapping.get(colonne,None)
+                # si on trouve la correspondance
+                if not(newclef is None):
+                    champs.append((colonne, valeur, newclef))
+                else:
+                    if verbose:
+                        print('Line',str(numRow),'-> no mapping for "',colonne,'"') 
+
+    # moteur "template": simple concaténation du gabarit de cette combinaison de colonnes, s'il y en a un
+    texte = None
+    if not(templates is None):
+        debut = statsStart()
+        texte = templates.render(champs)
+        statsStop('template' if not(texte is None) else 'template-miss', debut)
+    if texte is None:
+        # on démarre avec un bel arbre tout propre, bâti sur le squelette de l'abre XML "minimal" de base (voir RowTree)
+        TEItree = buildRowTree(XMLTree, champs, plans)
+        if backend is None:
+            backend = TreeSerializer(cleanEmptyLeaf)
+        # suppression des feuilles vides, mise en forme et écriture en un seul parcours de l'arbre
+        debut = statsStart()
+        document = backend.serialize(TEItree, prolog)
+        statsStop('serialize', debut)
+    else:
+        document = (prolog + texte).encode('utf-8')
+    if not(conversionStats is None):
+        conversionStats.rows = conversionStats.rows + 1
+
     # exporter le fichier XML
     if cote == '':
-         # au cas où on n'aurait pas de nom pour le fichier à écrire
-        cote = 'line_'+str(numRow)+'_' + str(randint(0,65535))
+         # au cas où on n'aurait pas de nom pour le fichier à écrire (numéro tiré du contenu du fichier: une
+         # conversion, ou un lot de lignes, refait donne le même nom)
+        cote = 'line_'+str(numRow)+'_' + str(int.from_bytes(hashlib.blake2b(document, digest_size=2).digest(), 'big'))
         # lever un warning, donner le numéro de ligne et le nom de fichier 
         print('!!! No filename found for line '+str(numRow)+'. Outpu file will be named: '+cote+'.xml')    
-    # création d'un fichier temporaire (sera complété par la suite)    
-    try:    
-        TEItree.write(outPath+cote+'.tmp', encoding="UTF-8")
-    except EnvironmentError:
-        writeError(outPath+cote+'.tmp')
-        return None
-    
-    # renvoie le chemin d'accès du fichier, sans extension
-    return outPath+cote
+
+    return cote, document
+
+#--------------------------------------------------------------
+def doMap_aRow(XMLTree, row, numRow, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf, plans=None, prolog='', templates=None, sink=None, backend=None, columns=None, report=None):
+    """
+    Applique le mapping TEI sur une ligne de données et écrit le fichier XML correspondant,
+    en une seule écriture.
+
+    :param XMLTree: arbre XML de base
+        :type xml.elementree
+    :param row : dictionnaire ordonné contenant les couples "entête de colonne"->"données"
+        :type orderedDict
+    :param numRow: numéro de la ligne
+        :type int
+    :param TEIMapping : dictionnaire ordonné contenant les couples "entête de colonne"->"balises TEI"
+        :type orderedDict
+    :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
+        : type: str
+    :param outPath: dossier pour stocker le fichiers créés
+        :type: str
+    :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+        :type: dict
+    :param prolog: déclarations et commentaires du fichier XML de base (voir getXMLProlog)
+        :type: str
+    :param templates: moteur "template" à essayer avant l'arbre XML (None: moteur "tree" seul)
+        :type: TemplateEngine
+    :param sink: destination du fichier (voir openOutputSink; None: un fichier dans outPath)
+        :type: DirectorySink, ZipSink, TarSink ou ThreadedSink
+    :param backend: sérialisation de l'arbre XML (voir buildXMLDocument)
+        :type: TreeSerializer ou LxmlBackend
+    :param columns: colonnes du fichier de données, si la ligne est une liste de données (voir buildXMLDocument)
+        :type: ColumnPlan
+    :param report: validation du fichier avant son écriture (None: pas de validation)
+        :type: ValidationReport
+    :returns: chemin d'accès (outPath+cote), sans extension, ou nom de l'entrée dans l'archive
+        :type: str
+    """
+
+    cote, document = buildXMLDocument(XMLTree, row, numRow, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates, backend, columns)
+    if not(report is None):
+        report.check(numRow, cote, document)
+    if sink is None:
+        return writeXMLDocument(outPath, cote, document, numRow)
+
+    return sink.write(cote, document, numRow)
+
+#--------------------------------------------------------------
+def writeXMLDocument(outPath, cote, document, numRow=None):
+    """
+    Ecrit un fichier XML produit par buildXMLDocument, en une seule écriture.
+
+    :param outPath: dossier pour stocker le fichiers créés
+        :type: str
+    :param cote: nom du fichier, sans extension
+        :type: str
+    :param document: contenu du fichier
+        :type: bytes
+    :param numRow: numéro de la ligne de données (pour le message d'erreur)
+        :type: int
+    :returns: chemin d'accès (outPath+cote), sans extension, None si le fichier n'a pu être écrit
+        :type: str
+    """
+
+    debut = statsStart()
+    try:
+        with open(outPath+cote+'.xml', 'wb') as result_file:
+            result_file.write(document)
+    except EnvironmentError:
+        writeError(outPath+cote+'.xml', numRow)
+        return None
+    statsStop('write', debut)
+
+    # renvoie le chemin d'accès du fichier, sans extension
+    return outPath+cote
+
+#--------------------------------------------------------------
+class OutputLayout(object):
+    '''
+    Répartition des fichiers créés en sous-dossiers du dossier outPath, d'après leur nom (cote), pour ne pas mettre
+    des centaines de milliers de fichiers dans un seul dossier:
+        "flat": pas de sous-dossier (par défaut);
+        "hash:2/2": empreinte du nom, en hexadécimal, 2 caractères par niveau ("3f/a0/JMG-AA1-1924-01-00.xml");
+        "prefix:7": premiers caractères du nom, 7 par niveau ("JMG-AA1/JMG-AA1-1924-01-00.xml");
+        "pattern:REGEX": groupes de l'expression régulière trouvés au début du nom, un niveau par groupe
+            ("pattern:([^-]+-[^-]+)-([0-9]{4})" donne "JMG-AA1/1924/JMG-AA1-1924-01-00.xml"); un nom qui ne
+            correspond pas reste dans outPath.
+
+    La répartition est enregistrée dans le dossier outPath (layoutName, voir readOutputLayout): les conversions
+    suivantes (incrémentales en particulier) et les autres outils retrouvent un fichier sans parcourir les dossiers.
+    '''
+
+    def __init__(self, spec='flat'):
+        '''
+        :param spec: répartition, "flat", "hash:...", "prefix:..." ou "pattern:..."
+            :type: str
+        :raises ValueError: répartition inconnue ou invalide
+        '''
+        self.spec = spec
+        self.kind, sep, parametre = spec.partition(':')
+        self.widths = []
+        self.pattern = None
+        if self.kind in ('hash', 'prefix'):
+            morceaux = parametre.split('/')
+            if not(all(morceau.isdigit() and (int(morceau) > 0) for morceau in morceaux)):
+                raise ValueError('"'+spec+'": expected widths such as "'+self.kind+':2/2"')
+            self.widths = [int(morceau) for morceau in morceaux]
+            if (self.kind == 'hash') and (sum(self.widths) > 32):
+                raise ValueError('"'+spec+'": no more than 32 hexadecimal characters')
+        elif self.kind == 'pattern':
+            try:
+                self.pattern = re.compile(parametre)
+            except re.error as e:
+                raise ValueError('"'+spec+'": '+str(e))
+        elif not(spec == 'flat'):
+            raise ValueError('"'+spec+'": expected "flat", "hash:...", "prefix:..." or "pattern:..."')
+
+    def directory(self, cote):
+        '''
+        Sous-dossier d'un fichier.
+
+        :param cote: nom du fichier, sans extension
+            :type: str
+        :returns: chemin du sous-dossier dans outPath, terminé par "/" ('' pour outPath lui-même)
+            :type: str
+        '''
+        if self.kind in ('hash', 'prefix'):
+            texte = cote
+            if self.kind == 'hash':
+                texte = hashlib.blake2b(cote.encode('utf-8'), digest_size=16).hexdigest()
+            niveaux = []
+            debut = 0
+            for largeur in self.widths:
+                niveaux.append(texte[debut:debut+largeur])
+                debut = debut + largeur
+        elif self.kind == 'pattern':
+            trouve = self.pattern.match(cote)
+            if trouve is None:
+                return ''
+            niveaux = list(trouve.groups()) if self.pattern.groups > 0 else [trouve.group(0)]
+        else:
+            return ''
+        # pas de niveau vide, ni de séparateur ou de "." et ".." venus du nom du fichier
+        niveaux = [niveau.replace('/', '_').replace('\\', '_') for niveau in niveaux if niveau]
+        niveaux = ['_' if niveau in ('.', '..') else niveau for niveau in niveaux]
+
+        return ''.join(niveau+'/' for niveau in niveaux)
+
+    def path(self, cote):
+        '''
+        Chemin d'un fichier dans outPath, sans extension (sous-dossier et nom).
+        '''
+        return self.directory(cote) + cote
+
+    def store(self, outPath):
+        '''
+        Enregistre la répartition dans le dossier outPath (voir readOutputLayout).
+
+        :returns: True si elle a été enregistrée
+            :type: bool
+        '''
+        try:
+            with open(outPath+layoutName, 'w', encoding='utf-8') as fichier:
+                json.dump({'layout': self.spec}, fichier, ensure_ascii=False)
+        except EnvironmentError:
+            writeError(outPath+layoutName)
+            return False
+
+        return True
+
+#--------------------------------------------------------------
+def readOutputLayout(outPath):
+    """
+    Lit la répartition des fichiers enregistrée dans le dossier outPath (voir OutputLayout).
+
+    :param outPath: dossier des fichiers créés
+        :type: str
+    :returns: répartition enregistrée, None s'il n'y en a pas (ou si elle est illisible: l'erreur est affichée)
+        :type: OutputLayout
+    """
+
+    if not(os.path.isfile(outPath+layoutName)):
+        return None
+    try:
+        with open(outPath+layoutName, encoding='utf-8') as fichier:
+            return OutputLayout(json.load(fichier)['layout'])
+    except EnvironmentError:
+        readError(outPath+layoutName)
+    except (ValueError, KeyError, TypeError) as e:
+        print('File '+outPath+layoutName+' has a mistake: '+str(e))
+
+    return None
+
+#--------------------------------------------------------------
+class DirectorySink(object):
+    '''
+    Destination des fichiers XML créés: un fichier par ligne de données dans le dossier outPath
+    (destination par défaut), éventuellement réparti en sous-dossiers (voir OutputLayout), créés au besoin.
+    Les autres destinations (voir ZipSink, TarSink) ont les mêmes méthodes.
+    '''
+
+    def __init__(self, outPath, layout=None):
+        '''
+        :param outPath: dossier pour stocker le fichiers créés
+            :type: str
+        :param layout: répartition des fichiers en sous-dossiers (None: pas de sous-dossier)
+            :type: OutputLayout
+        '''
+        self.outPath = outPath
+        self.layout = layout
+        self.directories = set()    # sous-dossiers déjà créés (ou existants)
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        Ecrit un fichier XML produit par buildXMLDocument.
+
+        :param cote: nom du fichier, sans extension
+            :type: str
+        :param document: contenu du fichier
+            :type: bytes
+        :param numRow: numéro de la ligne de données (pour le message d'erreur)
+            :type: int
+        :param done: action à faire une fois le fichier écrit (enregistrement dans le manifeste, par ex.)
+            :type: callable
+        :returns: chemin d'accès (outPath+cote, ou outPath+sous-dossier+cote), sans extension, None si le fichier
+            n'a pu être écrit
+            :type: str
+        '''
+        if not(self.layout is None):
+            dossier = self.layout.directory(cote)
+            if not(dossier in self.directories):
+                try:
+                    os.makedirs(self.outPath+dossier, exist_ok=True)
+                except EnvironmentError:
+                    writeError(self.outPath+dossier, numRow)
+                    return None
+                self.directories.add(dossier)
+            cote = dossier + cote
+        chemin = writeXMLDocument(self.outPath, cote, document, numRow)
+        if not(chemin is None) and not(done is None):
+            done()
+
+        return chemin
+
+    def flush(self):
+        '''
+        Attend que tous les fichiers soient écrits (rien à attendre ici, voir ThreadedSink).
+        '''
+        return None
+
+    def close(self):
+        '''
+        Termine l'écriture (rien à faire pour un dossier).
+        '''
+        return None
+
+#--------------------------------------------------------------
+class StreamFile(object):
+    '''
+    Fichier ouvert en écriture seule, sans retour en arrière possible (ni tell, ni seek): zipfile écrit alors
+    l'archive en un seul flux, la taille et l'empreinte de chaque fichier venant après ses données (voir ZipSink).
+    '''
+
+    def __init__(self, filename):
+        '''
+        :param filename: chemin du fichier
+            :type: str
+        '''
+        self.file = open(filename, 'wb')
+
+    def write(self, data):
+        return self.file.write(data)
+
+    def flush(self):
+        return self.file.flush()
+
+    def close(self):
+        return self.file.close()
+
+#--------------------------------------------------------------
+class ZipSink(object):
+    '''
+    Destination des fichiers XML créés: une archive zip, écrite en un seul flux séquentiel (voir StreamFile).
+    Chaque fichier est compressé et écrit dès qu'il est produit; seule la liste des entrées (écrite à la fin de
+    l'archive) reste en mémoire. Une cote en double donne deux entrées de même nom.
+    '''
+
+    def __init__(self, filename):
+        '''
+        :param filename: chemin de l'archive
+            :type: str
+        '''
+        self.filename = filename
+        self.stream = StreamFile(filename)
+        self.archive = zipfile.ZipFile(self.stream, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.dateTime = time.localtime()[:6]
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        Ajoute un fichier XML produit par buildXMLDocument à l'archive.
+
+        :param cote: nom du fichier, sans extension
+            :type: str
+        :param document: contenu du fichier
+            :type: bytes
+        :param numRow: numéro de la ligne de données (pour le message d'erreur)
+            :type: int
+        :param done: action à faire une fois le fichier écrit (enregistrement dans le manifeste, par ex.)
+            :type: callable
+        :returns: nom de l'entrée, sans extension, None si elle n'a pu être écrite
+            :type: str
+        '''
+        entree = zipfile.ZipInfo(cote+'.xml', date_time=self.dateTime)
+        entree.compress_type = zipfile.ZIP_DEFLATED
+        entree.external_attr = 0o644 << 16
+        debut = statsStart()
+        try:
+            self.archive.writestr(entree, document)
+        except EnvironmentError:
+            writeError(self.filename, numRow)
+            return None
+        statsStop('write', debut)
+        if not(done is None):
+            done()
+
+        return cote
+
+    def flush(self):
+        '''
+        Attend que tous les fichiers soient écrits (rien à attendre ici, voir ThreadedSink).
+        '''
+        return None
+
+    def close(self):
+        '''
+        Termine l'archive (liste des entrées) et ferme le fichier.
+        '''
+        try:
+            self.archive.close()
+            self.stream.close()
+        except EnvironmentError:
+            writeError(self.filename)
+
+        return None
+
+#--------------------------------------------------------------
+class TarSink(object):
+    '''
+    Destination des fichiers XML créés: une archive tar, compressée ou non, écrite en un seul flux séquentiel
+    (mode "flux" du module tarfile). Chaque fichier est écrit dès qu'il est produit et rien n'est gardé en
+    mémoire. Une cote en double donne deux entrées de même nom (la dernière l'emporte à l'extraction).
+    '''
+
+    def __init__(self, filename, mode):
+        '''
+        :param filename: chemin de l'archive
+            :type: str
+        :param mode: mode d'écriture en flux ("w|", "w|gz", "w|bz2", "w|xz")
+            :type: str
+        '''
+        self.filename = filename
+        self.stream = open(filename, 'wb')
+        self.archive = tarfile.open(fileobj=self.stream, mode=mode)
+        self.mtime = int(time.time())
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        Ajoute un fichier XML produit par buildXMLDocument à l'archive.
+
+        :param cote: nom du fichier, sans extension
+            :type: str
+        :param document: contenu du fichier
+            :type: bytes
+        :param numRow: numéro de la ligne de données (pour le message d'erreur)
+            :type: int
+        :param done: action à faire une fois le fichier écrit (enregistrement dans le manifeste, par ex.)
+            :type: callable
+        :returns: nom de l'entrée, sans extension, None si elle n'a pu être écrite
+            :type: str
+        '''
+        entree = tarfile.TarInfo(cote+'.xml')
+        entree.size = len(document)
+        entree.mtime = self.mtime
+        entree.mode = 0o644
+        debut = statsStart()
+        try:
+            self.archive.addfile(entree, io.BytesIO(document))
+        except EnvironmentError:
+            writeError(self.filename, numRow)
+            return None
+        statsStop('write', debut)
+        # tarfile garde chaque entrée ajoutée, inutile ici: on ne relit pas l'archive
+        self.archive.members = []
+        if not(done is None):
+            done()
+
+        return cote
+
+    def flush(self):
+        '''
+        Attend que tous les fichiers soient écrits (rien à attendre ici, voir ThreadedSink).
+        '''
+        return None
+
+    def close(self):
+        '''
+        Termine l'archive et ferme le fichier.
+        '''
+        try:
+            self.archive.close()
+            self.stream.close()
+        except EnvironmentError:
+            writeError(self.filename)
+
+        return None
+
+#--------------------------------------------------------------
+class CorpusSink(object):
+    '''
+    Destination des fichiers XML créés: un seul fichier, écrit en un seul flux séquentiel. Par défaut un
+    teiCorpus: le prologue de l'arbre XML de base une seule fois, puis chaque document (sans son prologue) dans
+    un élément teiCorpus. Avec l'extension corpusLinesExtension, un document par ligne (XML délimité par des fins
+    de ligne, sans prologue): les fins de ligne d'un document y sont écrites en appels de caractère (&#10;),
+    l'option --compact évite celles de la mise en forme.
+
+    Un index (nom du corpus + corpusIndexSuffix) donne, pour chaque document, sa position et sa longueur en
+    octets dans le corpus (une entrée JSON par ligne, la dernière entrée d'une cote l'emporte): voir CorpusReader.
+    '''
+
+    def __init__(self, filename, prolog='', rootTag=None):
+        '''
+        :param filename: chemin du corpus
+            :type: str
+        :param prolog: déclarations et commentaires du fichier XML de base (voir getXMLProlog), placés en tête
+            du teiCorpus et retirés de chaque document
+            :type: str
+        :param rootTag: balise de la racine de l'arbre XML de base: teiCorpus reprend l'espace de nommage d'une
+            racine TEI ("{URI}TEI")
+            :type: str
+        '''
+        self.filename = filename
+        self.lines = filename.lower().endswith(corpusLinesExtension)
+        self.prolog = prolog.encode('utf-8')
+        self.stream = open(filename, 'wb')
+        try:
+            self.index = open(filename+corpusIndexSuffix, 'w', encoding='utf-8')
+        except EnvironmentError:
+            self.stream.close()
+            raise
+        self.offset = 0
+        if not(self.lines):
+            ouverture = '<teiCorpus>\n'
+            if not(rootTag is None) and rootTag.startswith('{') and rootTag.endswith('}TEI'):
+                ouverture = '<teiCorpus xmlns="'+ET._escape_attrib(rootTag[1:].split('}')[0])+'">\n'
+            self.append(self.prolog + ouverture.encode('utf-8'))
+
+    def append(self, morceau):
+        '''
+        Ecrit à la suite du corpus.
+
+        :param morceau: octets à écrire
+            :type: bytes
+        '''
+        self.stream.write(morceau)
+        self.offset = self.offset + len(morceau)
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        Ajoute un document produit par buildXMLDocument au corpus, et son entrée à l'index.
+
+        (paramètres: voir DirectorySink.write)
+        :returns: cote, None si le document n'a pu être écrit
+            :type: str
+        '''
+        # le document, sans son prologue (écrit une seule fois en tête du teiCorpus) ni blancs autour
+        if document.startswith(self.prolog):
+            document = document[len(self.prolog):]
+        document = document.strip()
+        if self.lines:
+            document = document.replace(b'\r', b'&#13;').replace(b'\n', b'&#10;')
+        debut = statsStart()
+        try:
+            position = self.offset
+            self.append(document + b'\n')
+            self.index.write(json.dumps({'cote': cote, 'offset': position, 'length': len(document)}, ensure_ascii=False)+'\n')
+        except EnvironmentError:
+            writeError(self.filename, numRow)
+            return None
+        statsStop('write', debut)
+        if not(done is None):
+            done()
+
+        return cote
+
+    def flush(self):
+        '''
+        Attend que tous les fichiers soient écrits (rien à attendre ici, voir ThreadedSink).
+        '''
+        return None
+
+    def close(self):
+        '''
+        Termine le corpus (fin du teiCorpus) et ferme le corpus et son index.
+        '''
+        try:
+            if not(self.lines):
+                self.append(b'</teiCorpus>\n')
+            self.stream.close()
+            self.index.close()
+        except EnvironmentError:
+            writeError(self.filename)
+
+        return None
+
+#--------------------------------------------------------------
+class CorpusReader(object):
+    '''
+    Lecture d'un corpus écrit par CorpusSink: le corpus est projeté en mémoire (mmap) et un document est lu, d'après
+    l'index, sans lire ni analyser le reste du corpus.
+
+    >> with CorpusReader('output/corpus.xml') as corpus:
+    >>     document = corpus.get('JMG-AA1-1924-01-00')
+    '''
+
+    def __init__(self, filename, index=None):
+        '''
+        :param filename: chemin du corpus
+            :type: str
+        :param index: chemin de l'index (None: nom du corpus + corpusIndexSuffix)
+            :type: str
+        '''
+        self.filename = filename
+        self.entries = {}    # cote -> (position, longueur)
+        with open(filename+corpusIndexSuffix if index is None else index, encoding='utf-8') as fichier:
+            for ligne in fichier:
+                try:
+                    entree = json.loads(ligne)
+                    self.entries[entree['cote']] = (entree['offset'], entree['length'])
+                except (ValueError, KeyError, TypeError):
+                    # entrée illisible (corpus interrompu par ex.): ignorée
+                    continue
+        self.stream = open(filename, 'rb')
+        self.data = b''
+        if os.fstat(self.stream.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, cote, default=None):
+        '''
+        Lit un document du corpus.
+
+        :param cote: nom du fichier, sans extension (valeur de la colonne refColumn)
+            :type: str
+        :param default: valeur renvoyée si la cote n'est pas dans l'index
+        :returns: le document (sans prologue), encodé en UTF-8
+            :type: bytes
+        '''
+        entree = self.entries.get(cote)
+        if entree is None:
+            return default
+
+        return self.data[entree[0]:entree[0]+entree[1]]
+
+    def __getitem__(self, cote):
+        document = self.get(cote)
+        if document is None:
+            raise KeyError(cote)
+        return document
+
+    def __contains__(self, cote):
+        return cote in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def close(self):
+        '''
+        Ferme le corpus.
+        '''
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = b''
+        self.stream.close()
+
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+#--------------------------------------------------------------
+class ThreadedSink(object):
+    '''
+    Ecriture des fichiers XML en arrière-plan, par quelques processus légers (threads), pendant que les lignes
+    suivantes sont converties. Chaque processus léger a sa file d'attente, de taille limitée (writerQueueDepth):
+    si l'écriture prend du retard, la conversion attend (la mémoire reste bornée). Un même nom de fichier est
+    toujours confié au même processus léger: les fichiers de même nom sont écrits dans l'ordre des lignes,
+    comme sans écriture en arrière-plan.
+    '''
+
+    def __init__(self, sink, writers):
+        '''
+        :param sink: destination des fichiers (DirectorySink, ZipSink, TarSink ou CorpusSink)
+            :type: object
+        :param writers: nombre de processus légers d'écriture
+            :type: int
+        '''
+        self.sink = sink
+        self.lock = threading.Lock()    # les actions "done" (manifeste) sont faites une à une
+        self.queues = [queue.Queue(writerQueueDepth) for n in range(max(1, writers))]
+        self.threads = [threading.Thread(target=self.run, args=(file,), daemon=True) for file in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def write(self, cote, document, numRow=None, done=None):
+        '''
+        Confie un fichier XML produit par buildXMLDocument à un processus léger d'écriture (attend s'il a
+        déjà writerQueueDepth fichiers en attente). Les erreurs d'écriture sont signalées avec le numéro de ligne.
+
+        (paramètres: voir DirectorySink.write)
+        :returns: nom du fichier, sans extension (écriture en attente)
+            :type: str
+        '''
+        self.queues[hash(cote) % len(self.queues)].put((cote, document, numRow, done))
+
+        return cote
+
+    def run(self, file):
+        '''
+        Processus léger d'écriture: écrit les fichiers de sa file d'attente, jusqu'à recevoir None.
+        '''
+        while True:
+            travail = file.get()
+            try:
+                if travail is None:
+                    return None
+                cote, document, numRow, done = travail
+                try:
+                    if not(self.sink.write(cote, document, numRow) is None) and not(done is None):
+                        with self.lock:
+                            done()
+                except Exception as e:
+                    print('Line '+str(numRow)+' -> failed to write file '+cote+'.xml: '+str(e))
+            finally:
+                file.task_done()
+
+    def flush(self):
+        '''
+        Attend que tous les fichiers en attente soient écrits.
+        '''
+        for file in self.queues:
+            file.join()
+
+        return None
+
+    def close(self):
+        '''
+        Ecrit les fichiers en attente, arrête les processus légers et termine la destination.
+        '''
+        for file in self.queues:
+            file.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.sink.close()
+
+        return None
+
+#--------------------------------------------------------------
+def openOutputSink(outPath, archive=None, writers=0, corpus=None, prolog='', rootTag=None, layout=None, progress=None):
+    """
+    Ouvre la destination des fichiers XML créés: le dossier outPath, une archive créée dans ce dossier,
+    dont le format est donné par l'extension de son nom (voir archiveFormats), ou un corpus en un seul fichier
+    (voir CorpusSink).
+
+    :param outPath: dossier pour stocker le fichiers créés
+        :type: str
+    :param archive: nom de l'archive (None: un fichier par ligne dans outPath)
+        :type: str
+    :param writers: nombre de processus légers écrivant les fichiers en arrière-plan (voir ThreadedSink),
+        un seul pour une archive ou un corpus (écrits en un seul flux); 0: écriture au fil de la conversion
+        :type: int
+    :param corpus: nom du corpus à créer dans outPath (None: pas de corpus)
+        :type: str
+    :param prolog: déclarations et commentaires du fichier XML de base, en tête du corpus (voir CorpusSink)
+        :type: str
+    :param rootTag: balise de la racine de l'arbre XML de base (espace de nommage du teiCorpus)
+        :type: str
+    :param layout: répartition des fichiers en sous-dossiers de outPath (voir OutputLayout; None: pas de sous-dossier)
+        :type: OutputLayout
+    :param progress: suivi de la conversion, qui compte les fichiers écrits (voir ProgressSink; None: pas de suivi)
+        :type: ConversionProgress
+    :returns: destination (DirectorySink, ZipSink, TarSink, CorpusSink, ProgressSink ou ThreadedSink), None en
+        cas d'erreur
+        :type: object
+    """
+
+    threads = 1    # un seul processus léger d'écriture pour une archive ou un corpus (écrits en un seul flux)
+    if not(corpus is None):
+        filename = os.path.join(outPath, corpus)
+        try:
+            sink = CorpusSink(filename, prolog, rootTag)
+        except EnvironmentError:
+            writeError(filename)
+            return None
+    elif archive is None:
+        sink = DirectorySink(outPath, layout)
+        threads = writers
+    else:
+        filename = os.path.join(outPath, archive)
+        sink = None
+        for extension, mode in archiveFormats:
+            if filename.lower().endswith(extension):
+                try:
+                    if mode is None:
+                        sink = ZipSink(filename)
+                    else:
+                        sink = TarSink(filename, mode)
+                except EnvironmentError:
+                    writeError(filename)
+                    return None
+                break
+        if sink is None:
+            print('Unknown archive format for '+filename+' (expected: '+', '.join([extension for extension, mode in archiveFormats])+')')
+            return None
+    if not(progress is None):
+        # les fichiers sont comptés une fois écrits, dans les processus légers d'écriture s'il y en a
+        sink = ProgressSink(sink, progress)
+
+    return ThreadedSink(sink, threads) if writers > 0 else sink
+
+#--------------------------------------------------------------
+class ColumnPlan(object):
+    '''
+    Colonnes d'un fichier de données, résolues une fois pour toutes d'après la ligne d'entêtes et le mapping: les
+    lignes sont lues comme de simples listes (csv.reader), et seules les données des colonnes mappées, et de la
+    colonne du nom de fichier, sont consultées.
+
+    Comme avec csv.DictReader, une colonne dont l'entête est répété prend la donnée de sa dernière occurrence,
+    à la place de la première.
+    '''
+
+    def __init__(self, header, TEIMapping, nameColumn):
+        '''
+        :param header: entêtes des colonnes du fichier de données
+            :type: list
+        :param TEIMapping: dictionnaire ordonné contenant les couples "entête de colonne"->"balises TEI"
+            :type: orderedDict
+        :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
+            :type: str
+        '''
+        self.header = header
+        self.positions = {}    # entête -> position de la donnée (la dernière l'emporte)
+        for position, colonne in enumerate(header):
+            self.positions[colonne] = position
+        self.mapped = []       # (position, entête de colonne, balises TEI) des colonnes mappées, dans l'ordre
+        self.unmapped = []     # entêtes des colonnes sans mapping
+        for colonne, position in self.positions.items():
+            newclef = TEIMapping.get(colonne,None)
+            if newclef is None:
+                self.unmapped.append(colonne)
+            else:
+                self.mapped.append((position, colonne, newclef))
+        self.namePosition = self.positions.get(nameColumn,None)
+
+    def fields(self, values):
+        '''
+        Champs à convertir d'une ligne de données: ceux des colonnes mappées qui ont une valeur (les données
+        manquantes d'une ligne trop courte n'en ont pas).
+
+        :param values: données de la ligne, dans l'ordre des colonnes
+            :type: list
+        :returns: nom du fichier ('' si la ligne n'en a pas) et triplets ("entête de colonne", "données",
+            "balises TEI"), voir buildRowTree
+            :type: tuple (str, list)
+        '''
+
+        cote = self.fileName(values)
+        nombre = len(values)
+        champs = []
+        for position, colonne, newclef in self.mapped:
+            if position < nombre:
+                valeur = values[position]
+                if not(valeur.strip().lower() == 'none'):
+                    champs.append((colonne, valeur, newclef))
+
+        return cote, champs
+
+    def fileName(self, values):
+        '''
+        Nom du fichier XML d'une ligne de données (voir rowFileName).
+
+        :param values: données de la ligne, dans l'ordre des colonnes
+            :type: list
+        :returns: nom du fichier, sans extension ('' si la ligne n'en a pas)
+            :type: str
+        '''
+
+        if not(self.namePosition is None) and (self.namePosition < len(values)):
+            valeur = values[self.namePosition]
+            if not(valeur.strip().lower() == 'none'):
+                return valeur
+
+        return ''
+
+    def row(self, values):
+        '''
+        Ligne de données sous forme de dictionnaire, comme la donnerait csv.DictReader (conversion incrémentale,
+        voir Manifest.rowDigest).
+
+        :param values: données de la ligne, dans l'ordre des colonnes
+            :type: list
+        :returns: dictionnaire ordonné contenant les couples "entête de colonne"->"données"
+            :type: dict
+        '''
+
+        nombre = len(values)
+        ligne = {colonne: (values[position] if position < nombre else None) for colonne, position in self.positions.items()}
+        if nombre > len(self.header):
+            ligne[None] = values[len(self.header):]
+
+        return ligne
+
+#--------------------------------------------------------------
+class ColumnarPlan(ColumnPlan):
+    '''
+    Colonnes d'un fichier de données Arrow/Parquet (voir ColumnarReader): seules les colonnes mappées, et celle
+    du nom de fichier, sont lues, dans l'ordre de self.header. Leurs données sont déjà du texte, et une donnée
+    absente (nulle, ou "none") vaut None: elle est écartée sans autre test.
+    '''
+
+    def __init__(self, header, TEIMapping, nameColumn):
+        '''
+        (paramètres: voir ColumnPlan)
+        '''
+        ColumnPlan.__init__(self, header, TEIMapping, nameColumn)
+        # positions des colonnes à lire dans le fichier, et leurs positions dans les lignes lues
+        utiles = sorted(set([position for position, colonne, newclef in self.mapped] + ([] if self.namePosition is None else [self.namePosition])))
+        lues = {position: n for n, position in enumerate(utiles)}
+        self.projection = utiles
+        self.header = [header[position] for position in utiles]
+        self.positions = {colonne: lues[position] for colonne, position in self.positions.items() if position in lues}
+        self.mapped = [(lues[position], colonne, newclef) for position, colonne, newclef in self.mapped]
+        self.namePosition = None if self.namePosition is None else lues[self.namePosition]
+
+    def fields(self, values):
+        '''
+        Champs à convertir d'une ligne de données lue par ColumnarReader (voir ColumnPlan.fields).
+        '''
+        champs = [(colonne, values[position], newclef) for position, colonne, newclef in self.mapped if not(values[position] is None)]
+
+        return self.fileName(values), champs
+
+    def fileName(self, values):
+        '''
+        Nom du fichier XML d'une ligne de données lue par ColumnarReader (voir ColumnPlan.fileName).
+        '''
+        if (self.namePosition is None) or (values[self.namePosition] is None):
+            return ''
+
+        return values[self.namePosition]
+
+#--------------------------------------------------------------
+def isColumnarSource(filename):
+    '''
+    Indique si un fichier de données est un fichier Arrow ou Parquet, d'après son extension (voir columnarFormats).
+
+    :param filename: chemin du fichier
+        :type: str
+    :returns: format du fichier ("parquet", "file" ou "stream" pour Arrow), None pour un fichier CSV
+        :type: str
+    '''
+
+    for extension, format in columnarFormats:
+        if filename.lower().endswith(extension):
+            return format
+
+    return None
+
+#--------------------------------------------------------------
+class ColumnarReader(object):
+    '''
+    Lecture d'un fichier de données Arrow (IPC, fichier ou flux) ou Parquet, par paquets de lignes (record
+    batches). Seules les colonnes utiles à la conversion sont lues (voir ColumnarPlan), et le travail fait cellule
+    par cellule pour un fichier CSV l'est ici colonne par colonne, pour tout un paquet: conversion en texte et
+    écart des données absentes (nulles, ou "none" aux blancs et à la casse près). Il ne reste, ligne par ligne,
+    que l'assemblage du fichier XML. Nécessite pyarrow.
+    '''
+
+    def __init__(self, filename, batchSize=columnarBatchSize):
+        '''
+        :param filename: chemin du fichier
+            :type: str
+        :param batchSize: nombre de lignes par paquet (fichiers Parquet)
+            :type: int
+        '''
+        if pyarrow is None:
+            print('pyarrow is not installed: '+filename+' cannot be read')
+            raise OSError('pyarrow is not installed')
+        self.filename = filename
+        self.format = isColumnarSource(filename)
+        self.batchSize = batchSize
+        self.columns = None
+        self.source = None
+        try:
+            if self.format == 'parquet':
+                self.reader = pyarrow.parquet.ParquetFile(filename)
+                self.header = self.reader.schema_arrow.names
+            elif self.format == 'file':
+                self.source = pyarrow.memory_map(filename, 'r')
+                self.reader = pyarrow.ipc.open_file(self.source)
+                self.header = self.reader.schema.names
+            else:
+                self.source = pyarrow.OSFile(filename, 'rb')
+                self.reader = pyarrow.ipc.open_stream(self.source)
+                self.header = self.reader.schema.names
+        except pyarrow.ArrowException as e:
+            if not(self.source is None):
+                self.source.close()
+            print('->', e)
+            raise OSError(str(e))
+
+    def plan(self, TEIMapping, nameColumn):
+        '''
+        Résout les colonnes du fichier d'après le mapping: seules celles-ci seront lues.
+
+        :returns: colonnes du fichier de données
+            :type: ColumnarPlan
+        '''
+        self.columns = ColumnarPlan(self.header, TEIMapping, nameColumn)
+
+        return self.columns
+
+    def batches(self):
+        '''
+        Paquets de lignes du fichier, avec les seules colonnes lues (dans l'ordre de ColumnarPlan.projection).
+        '''
+        if self.format == 'parquet':
+            # colonnes lues par leur nom, sans lire les autres
+            for batch in self.reader.iter_batches(self.batchSize, columns=self.columns.header):
+                yield [batch.column(batch.schema.get_field_index(colonne)) for colonne in self.columns.header]
+        elif self.format == 'file':
+            for n in range(self.reader.num_record_batches):
+                batch = self.reader.get_batch(n)
+                yield [batch.column(position) for position in self.columns.projection]
+        else:
+            for batch in self.reader:
+                yield [batch.column(position) for position in self.columns.projection]
+
+    def __iter__(self):
+        '''
+        Lignes de données, listes des données des colonnes lues (None pour une donnée absente, voir ColumnarPlan).
+        '''
+        try:
+            for colonnes in self.batches():
+                listes = []
+                for colonne in colonnes:
+                    texte = pyarrow.compute.cast(colonne, pyarrow.string())
+                    absente = pyarrow.compute.equal(pyarrow.compute.utf8_lower(pyarrow.compute.utf8_trim_whitespace(texte)), 'none')
+                    absente = pyarrow.compute.fill_null(absente, True)
+                    listes.append(pyarrow.compute.if_else(absente, pyarrow.scalar(None, pyarrow.string()), texte).to_pylist())
+                for values in zip(*listes):
+                    yield list(values)
+        except pyarrow.ArrowException as e:
+            print('->', e)
+            raise OSError(str(e))
+
+    def close(self):
+        '''
+        Ferme le fichier.
+        '''
+        if hasattr(self.reader, 'close'):
+            self.reader.close()
+        if not(self.source is None):
+            self.source.close()
+
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+#--------------------------------------------------------------
+def rowFileName(row, nameColumn):
+    """
+    Nom du fichier XML d'une ligne de données, avant sa conversion (même règle que buildXMLDocument).
+
+    :param row : dictionnaire ordonné contenant les couples "entête de colonne"->"données"
+        :type orderedDict
+    :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
+        : type: str
+    :returns: nom du fichier, sans extension ('' si la ligne n'en a pas: un nom sera fabriqué, voir buildXMLDocument)
+        :type: str
+    """
+
+    valeur = row.get(nameColumn,None)
+    if (valeur is None) or (valeur.strip().lower() == 'none'):
+        return ''
+
+    return valeur
+
+#--------------------------------------------------------------
+def fileDigest(filename, extra=b''):
+    """
+    Empreinte du contenu d'un fichier.
+
+    :param filename: chemin du fichier
+        :type: str
+    :param extra: données ajoutées au contenu du fichier (options de conversion, par ex.)
+        :type: bytes
+    :returns: empreinte (hexadécimal), None si le fichier n'a pu être lu
+        :type: str
+    """
+
+    empreinte = hashlib.blake2b(digest_size=16)
+    try:
+        with open(filename, 'rb') as fichier:
+            empreinte.update(fichier.read())
+    except EnvironmentError:
+        readError(filename)
+        return None
+    empreinte.update(extra)
+
+    return empreinte.hexdigest()
+
+#--------------------------------------------------------------
+def rowShard(cote, numRow, shards):
+    """
+    Lot d'une ligne de données (option --shard), tiré d'une empreinte stable du nom de son fichier XML (ou, s'il
+    n'y en a pas, de son numéro de ligne): le même sur toutes les machines et pour toutes les conversions, et
+    deux lignes qui produisent le même fichier sont toujours dans le même lot.
+
+    :param cote: nom du fichier, sans extension (voir rowFileName)
+        :type: str
+    :param numRow: numéro de la ligne
+        :type: int
+    :param shards: nombre de lots
+        :type: int
+    :returns: numéro du lot, de 1 à shards
+        :type: int
+    """
+
+    clef = ('#'+str(numRow)) if cote == '' else ('='+cote)
+
+    return 1 + int.from_bytes(hashlib.blake2b(clef.encode('utf-8'), digest_size=8).digest(), 'big') % shards
+
+#--------------------------------------------------------------
+def shardManifestName(shard):
+    """
+    Nom du manifeste d'un lot de lignes (voir shardManifestPattern).
+
+    :param shard: numéro du lot et nombre de lots
+        :type: tuple (int, int)
+    :returns: nom du fichier
+        :type: str
+    """
+
+    return 'XMLify-manifest.shard-'+str(shard[0])+'-of-'+str(shard[1])+'.jsonl'
+
+#--------------------------------------------------------------
+def readManifest(filename):
+    """
+    Lit un manifeste (une entrée illisible, la dernière d'une conversion interrompue par ex., est ignorée).
+
+    :param filename: chemin du manifeste
+        :type: str
+    :returns: cote -> (empreintes de la ligne, du mapping et de l'arbre de base), None si le manifeste n'a
+        pu être lu
+        :type: dict
+    """
+
+    entrees = {}
+    try:
+        with open(filename, encoding='utf-8') as fichier:
+            for ligne in fichier:
+                try:
+                    entree = json.loads(ligne)
+                    cote = entree['file'][:-len('.xml')]
+                    entrees[cote] = (entree['row'], entree['mapping'], entree['template'])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except EnvironmentError:
+        readError(filename)
+        return None
+
+    return entrees
+
+#--------------------------------------------------------------
+def manifestEntry(cote, entree):
+    """
+    Entrée du manifeste pour un fichier (une ligne JSON).
+    """
+    return json.dumps({'file': cote+'.xml', 'row': entree[0], 'mapping': entree[1], 'template': entree[2]}, ensure_ascii=False) + '\n'
+
+#--------------------------------------------------------------
+class Manifest(object):
+    '''
+    Manifeste de la conversion incrémentale, rangé dans le dossier des fichiers créés (manifestName): pour
+    chaque fichier XML, les empreintes de la ligne de données, du fichier de mapping et de l'arbre XML de base
+    qui l'ont produit. Une ligne dont les trois empreintes n'ont pas changé (et dont le fichier existe) n'est
+    pas reconvertie.
+
+    Chaque fichier écrit est ajouté aussitôt à la fin du manifeste (une entrée JSON par ligne, la dernière
+    entrée d'un fichier l'emporte): une conversion interrompue reprend là où elle s'est arrêtée. A la fin
+    d'une conversion complète, le manifeste est réécrit avec une seule entrée par fichier et, si demandé,
+    les fichiers dont la ligne a disparu du fichier de données sont supprimés.
+
+    Chaque lot de lignes (option --shard) a son propre manifeste (voir shardManifestName), tenu même sans
+    conversion incrémentale; mergeManifests les réunit ensuite en un seul.
+    '''
+
+    def __init__(self, outPath, mappingDigest, templateDigest, prune=False, shard=None, incremental=True, layout=None):
+        '''
+        :param outPath: dossier des fichiers créés
+            :type: str
+        :param mappingDigest: empreinte du fichier de mapping (voir fileDigest)
+            :type: str
+        :param templateDigest: empreinte de l'arbre XML de base et des options de conversion (voir fileDigest)
+            :type: str
+        :param prune: supprimer, en fin de conversion, les fichiers dont la ligne a disparu
+            :type: bool
+        :param shard: numéro du lot et nombre de lots (None: toutes les lignes)
+            :type: tuple (int, int)
+        :param incremental: sauter les lignes inchangées (sinon, le manifeste est seulement tenu à jour)
+            :type: bool
+        :param layout: répartition des fichiers en sous-dossiers (voir OutputLayout; None: pas de sous-dossier)
+            :type: OutputLayout
+        '''
+        self.outPath = outPath
+        self.layout = OutputLayout() if layout is None else layout
+        self.filename = outPath + (manifestName if shard is None else shardManifestName(shard))
+        self.shard = shard
+        self.incremental = incremental
+        self.mappingDigest = mappingDigest
+        self.templateDigest = templateDigest
+        self.prune = prune
+        self.entries = {}    # entrées du manifeste existant: cote -> (ligne, mapping, arbre de base)
+        self.current = {}    # entrées de cette conversion
+        self.seen = set()    # fichiers déjà attribués à une ligne pendant cette conversion
+        self.skipped = 0
+        self.written = 0
+        self.load()
+        try:
+            self.journal = open(self.filename, 'a', encoding='utf-8')
+        except EnvironmentError:
+            writeError(self.filename)
+            self.journal = None
+
+    def load(self):
+        '''
+        Lit le manifeste existant (une entrée illisible, la dernière d'une conversion interrompue par ex.,
+        est ignorée: son fichier sera reconverti).
+        '''
+        if not(os.path.isfile(self.filename)):
+            return None
+        entrees = readManifest(self.filename)
+        if not(entrees is None):
+            self.entries = entrees
+
+        return None
+
+    def rowDigest(self, row):
+        '''
+        Empreinte d'une ligne de données (entêtes de colonne et valeurs, dans l'ordre).
+        '''
+        return hashlib.blake2b(json.dumps(list(row.items()), ensure_ascii=False).encode('utf-8'), digest_size=16).hexdigest()
+
+    def skip(self, cote, rowDigest):
+        '''
+        Indique si la ligne peut être sautée: même empreintes que dans le manifeste, fichier présent et
+        pas déjà produit par une autre ligne de cette conversion (cote en double).
+
+        :param cote: nom du fichier, sans extension (voir rowFileName)
+            :type: str
+        :param rowDigest: empreinte de la ligne (voir rowDigest)
+            :type: str
+        :returns: la ligne est inchangée
+            :type: bool
+        '''
+        if (cote == '') or not(self.incremental):
+            return False
+        entree = (rowDigest, self.mappingDigest, self.templateDigest)
+        inchange = (not(cote in self.seen)) and (self.entries.get(cote,None) == entree) and os.path.isfile(self.outPath+self.layout.path(cote)+'.xml')
+        self.seen.add(cote)
+        if inchange:
+            self.current[cote] = entree
+            self.skipped = self.skipped + 1
+
+        return inchange
+
+    def record(self, cote, rowDigest):
+        '''
+        Ajoute au manifeste le fichier qui vient d'être écrit.
+
+        :param cote: nom du fichier, sans extension
+            :type: str
+        :param rowDigest: empreinte de la ligne (voir rowDigest)
+            :type: str
+        '''
+        entree = (rowDigest, self.mappingDigest, self.templateDigest)
+        self.seen.add(cote)
+        self.current[cote] = entree
+        self.written = self.written + 1
+        if not(self.journal is None):
+            self.journal.write(manifestEntry(cote, entree))
+
+        return None
+
+    def pruneDirectories(self, dossier):
+        '''
+        Supprime les sous-dossiers de outPath laissés vides par la suppression d'un fichier, du plus profond
+        jusqu'à outPath (exclu).
+
+        :param dossier: sous-dossier du fichier supprimé, tel que donné par OutputLayout.directory
+            :type: str
+        '''
+        while dossier:
+            try:
+                os.rmdir(self.outPath+dossier)
+            except EnvironmentError:
+                # pas vide (ou déjà supprimé): les dossiers parents ne le sont pas non plus
+                return None
+            dossier = dossier[:dossier.rstrip('/').rfind('/')+1]
+        return None
+
+    def close(self, complete):
+        '''
+        Termine le manifeste. Après une conversion complète, il est réécrit avec une entrée par fichier, et les
+        fichiers dont la ligne a disparu sont supprimés (si demandé), ou gardés dans le manifeste.
+
+        :param complete: toutes les lignes du fichier de données ont été traitées
+            :type: bool
+        '''
+        if not(self.journal is None):
+            self.journal.close()
+            self.journal = None
+        if not(complete):
+            return None
+
+        supprimes = 0
+        for cote, entree in self.entries.items():
+            if not(cote in self.current):
+                if self.prune:
+                    chemin = self.outPath+self.layout.path(cote)+'.xml'
+                    try:
+                        if os.path.isfile(chemin):
+                            os.remove(chemin)
+                            supprimes = supprimes + 1
+                    except EnvironmentError:
+                        print('Failed to delete file '+chemin)
+                        self.current[cote] = entree
+                    else:
+                        self.pruneDirectories(self.layout.directory(cote))
+                else:
+                    self.current[cote] = entree
+        try:
+            with open(self.filename+'.tmp', 'w', encoding='utf-8') as fichier:
+                for cote, entree in self.current.items():
+                    fichier.write(manifestEntry(cote, entree))
+            os.replace(self.filename+'.tmp', self.filename)
+        except EnvironmentError:
+            writeError(self.filename)
+        titre = 'Incremental conversion' if self.shard is None else ('Shard '+str(self.shard[0])+'/'+str(self.shard[1]))
+        print(titre+': '+str(self.written)+' file(s) written, '+str(self.skipped)+' unchanged, '+str(supprimes)+' deleted')
+
+        return None
+
+#--------------------------------------------------------------
+def mergeManifests(outPath, filenames=None):
+    """
+    Réunit les manifestes des lots de lignes (option --shard) en un seul manifeste (manifestName, dans outPath),
+    utilisable ensuite par une conversion incrémentale. Un fichier XML produit par plusieurs lots (collision de
+    noms de fichiers) est signalé, et le manifeste n'est alors pas écrit; un lot manquant est signalé.
+
+    :param outPath: dossier du manifeste réuni
+        :type: str
+    :param filenames: manifestes des lots (None: ceux du dossier outPath, voir shardManifestPattern)
+        :type: list
+    :returns: le manifeste a été écrit
+        :type: bool
+    """
+
+    if filenames is None:
+        try:
+            filenames = [outPath+nom for nom in sorted(os.listdir(outPath or '.')) if not(shardManifestPattern.match(nom) is None)]
+        except EnvironmentError:
+            readError(outPath)
+            return False
+    if len(filenames) == 0:
+        print('No shard manifest found in '+outPath)
+        return False
+
+    fusion = {}      # cote -> entrée
+    origines = {}    # cote -> manifeste du lot qui l'a produite
+    lots = {}        # nombre de lots -> numéros des lots présents
+    collisions = 0
+    for filename in filenames:
+        numero = shardManifestPattern.match(os.path.basename(filename))
+        if not(numero is None):
+            lots.setdefault(int(numero.group(2)), set()).add(int(numero.group(1)))
+        entrees = readManifest(filename)
+        if entrees is None:
+            return False
+        for cote, entree in entrees.items():
+            if cote in origines:
+                collisions = collisions + 1
+                print('Filename collision: '+cote+'.xml is produced by '+origines[cote]+' and '+filename)
+            else:
+                fusion[cote] = entree
+                origines[cote] = filename
+    for nombre, numeros in sorted(lots.items()):
+        manquants = [str(numero)+'/'+str(nombre) for numero in range(1, nombre+1) if not(numero in numeros)]
+        if len(manquants) > 0:
+            print('Warning: missing shard manifest(s) '+', '.join(manquants))
+    if collisions > 0:
+        print(str(collisions)+' filename collision(s): the merged manifest is not written')
+        return False
+
+    filename = outPath + manifestName
+    try:
+        with open(filename+'.tmp', 'w', encoding='utf-8') as fichier:
+            for cote, entree in fusion.items():
+                fichier.write(manifestEntry(cote, entree))
+        os.replace(filename+'.tmp', filename)
+    except EnvironmentError:
+        writeError(filename)
+        return False
+    print('Merged '+str(len(filenames))+' shard manifest(s): '+str(len(fusion))+' file(s) in '+filename)
+
+    return True
+
+#--------------------------------------------------------------
+def schemaFromProlog(prolog, XmlBase):
+    """
+    Cherche le schéma RelaxNG déclaré dans le prologue de l'arbre XML de base
+    (<?xml-model href="teiHeader.rng" schematypens="http://relaxng.org/ns/structure/1.0"?>). Un chemin relatif
+    part du dossier du fichier XML de base.
+
+    :param prolog: déclarations et commentaires du fichier XML de base (voir getXMLProlog)
+        :type: str
+    :param XmlBase: fichier contenant l'arbre XML de base (ou son contenu, voir openSource)
+        :type: str
+    :returns: chemin d'accès (ou URL) du schéma, None si aucun schéma RelaxNG n'est déclaré
+        :type: str
+    """
+
+    for declaration in xmlModelPattern.findall(prolog):
+        href = xmlModelHref.search(declaration)
+        if href is None:
+            continue
+        # schéma RelaxNG d'après son espace de nommage, ou à défaut d'après son extension
+        if (declaration.find(relaxNGNamespace) > -1) or href.group(1).endswith('.rng'):
+            schema = href.group(1)
+            if (schema.find('://') == -1) and not(os.path.isabs(schema)) and not(isInlineSource(XmlBase)):
+                schema = os.path.join(os.path.dirname(XmlBase), schema)
+            return schema
+
+    return None
+
+#--------------------------------------------------------------
+class SchemaValidator(object):
+    '''
+    Validation RelaxNG des fichiers produits, en mémoire, avant leur écriture (option --validate). Le schéma
+    est compilé une seule fois par processus: le validateur recopié dans un processus de conversion (voir
+    initConversionWorker) ne garde que le nom du schéma, le schéma compilé par lxml ne pouvant pas être recopié.
+    '''
+
+    def __init__(self, schema):
+        '''
+        :param schema: chemin d'accès (ou URL) du schéma RelaxNG, en syntaxe XML (.rng)
+            :type: str
+        '''
+        self.schema = schema
+        self.relaxng = None
+
+    def __getstate__(self):
+        return {'schema': self.schema, 'relaxng': None}
+
+    def compile(self):
+        '''
+        Compile le schéma (s'il ne l'est pas déjà). Les erreurs sont affichées.
+
+        :returns: True si le schéma est compilé
+            :type: bool
+        '''
+        if not(self.relaxng is None):
+            return True
+        if lxmlET is None:
+            print('lxml is not installed: RelaxNG validation is not available')
+            return False
+        debut = statsStart()
+        try:
+            self.relaxng = lxmlET.RelaxNG(lxmlET.parse(self.schema))
+        except (EnvironmentError, lxmlET.XMLSyntaxError, lxmlET.RelaxNGParseError) as e:
+            print('Schema '+self.schema+' cannot be used for validation')
+            print('->', e)
+            return False
+        finally:
+            statsStop('schema', debut)
+
+        return True
+
+    def errors(self, document):
+        '''
+        Valide un fichier produit par buildXMLDocument.
+
+        :param document: contenu du fichier XML
+            :type: bytes
+        :returns: erreurs de validation, "ligne:colonne: message" (liste vide si le fichier est valide)
+            :type: list
+        '''
+        if not(self.compile()):
+            return ['schema '+self.schema+' cannot be used']
+        debut = statsStart()
+        try:
+            if self.relaxng.validate(lxmlET.fromstring(document)):
+                return []
+            return [str(e.line)+':'+str(e.column)+': '+e.message for e in self.relaxng.error_log]
+        except lxmlET.XMLSyntaxError as e:
+            return [str(e)]
+        finally:
+            statsStop('validate', debut)
+
+#--------------------------------------------------------------
+class ValidationReport(object):
+    '''
+    Rapport de validation des fichiers produits, rangé dans le dossier des fichiers créés (validationReportName,
+    un par lot de lignes avec --shard): une entrée JSON par ligne de données dont le fichier n'est pas valide
+    (numéro de ligne, fichier, erreurs). Un fichier invalide est tout de même écrit: la conversion continue.
+    '''
+
+    def __init__(self, outPath, validator, shard=None):
+        '''
+        :param outPath: dossier des fichiers créés
+            :type: str
+        :param validator: validateur des fichiers produits
+            :type: SchemaValidator
+        :param shard: numéro du lot et nombre de lots (None: toutes les lignes)
+            :type: tuple (int, int)
+        '''
+        self.validator = validator
+        self.filename = outPath + validationReportName
+        if not(shard is None):
+            self.filename = outPath + 'XMLify-validation.shard-'+str(shard[0])+'-of-'+str(shard[1])+'.jsonl'
+        self.valid = 0
+        self.invalid = 0
+        try:
+            self.report = open(self.filename, 'w', encoding='utf-8')
+        except EnvironmentError:
+            writeError(self.filename)
+            self.report = None
+
+    def check(self, numRow, cote, document):
+        '''
+        Valide un fichier produit dans ce processus et l'ajoute au rapport (voir add).
+        '''
+        return self.add(numRow, cote, self.validator.errors(document))
+
+    def add(self, numRow, cote, errors):
+        '''
+        Ajoute au rapport le résultat de la validation d'un fichier.
+
+        :param numRow: numéro de la ligne de données
+            :type: int
+        :param cote: nom du fichier, sans extension (voir buildXMLDocument)
+            :type: str
+        :param errors: erreurs de validation (voir SchemaValidator.errors)
+            :type: list
+        :returns: True si le fichier est valide
+            :type: bool
+        '''
+        if len(errors) == 0:
+            self.valid = self.valid + 1
+            return True
+        self.invalid = self.invalid + 1
+        statsCount('invalid-files')
+        if not(self.report is None):
+            self.report.write(json.dumps({'row': numRow, 'file': cote+'.xml', 'errors': errors}, ensure_ascii=False)+'\n')
+
+        return False
+
+    def close(self):
+        '''
+        Termine le rapport et affiche le résultat de la validation.
+        '''
+        if not(self.report is None):
+            self.report.close()
+            self.report = None
+        message = 'Validation: '+str(self.valid)+' valid file(s), '+str(self.invalid)+' invalid'
+        if self.invalid > 0:
+            message = message + ' (see '+self.filename+')'
+        print(message)
+
+        return None
+
+#--------------------------------------------------------------
+class MappingCache(object):
+    '''
+    Cache sur disque de tout ce qui est préparé avant la conversion des lignes (voir prepareMapping): espaces de
+    nommage, prologue, mapping vérifié, plans d'insertion compilés et squelette de l'arbre XML de base. Pour de
+    petits fichiers de données convertis très souvent avec les mêmes arbre de base et mapping, la lecture, la
+    vérification et la compilation ne sont faites qu'une fois.
+
+    Chaque entrée est un fichier (pickle) du dossier du cache, nommé d'après l'empreinte des contenus de l'arbre
+    XML de base, du fichier de mapping et de ce programme (les objets rangés en dépendent): toute modification
+    de l'un des trois donne une autre entrée. Les entrées qui ne servent plus peuvent être supprimées sans risque.
+    '''
+
+    # clefs d'une entrée (voir prepareMapping)
+    entryKeys = ('namespaces', 'declarations', 'prolog', 'mapping', 'plans', 'skeleton')
+
+    def __init__(self, cacheDir):
+        '''
+        :param cacheDir: dossier du cache (créé s'il n'existe pas)
+            :type: str
+        '''
+        self.cacheDir = cacheDir
+
+    def key(self, XmlBase, CSV_mapFile):
+        '''
+        Clef de l'entrée du cache pour un arbre XML de base et un fichier de mapping.
+
+        :param XmlBase: fichier contenant l'arbre XML de base
+            :type: str
+        :param CSV_mapFile: fichier CSV de mapping
+            :type: str
+        :returns: clef (hexadécimal), None si l'un des fichiers n'a pu être lu
+            :type: str
+        '''
+
+        empreintes = [fileDigest(XmlBase), fileDigest(CSV_mapFile), fileDigest(__file__)]
+        if None in empreintes:
+            return None
+        # les objets sont rangés avec le nom du module (script ou bibliothèque) et la version de Python
+        empreintes.append(__name__+' '+'.'.join(str(n) for n in sys.version_info[:2]))
+
+        return hashlib.blake2b(' '.join(empreintes).encode('utf-8'), digest_size=16).hexdigest()
+
+    def filename(self, key):
+        '''
+        Fichier de l'entrée du cache.
+        '''
+        return os.path.join(self.cacheDir, 'XMLify-'+key+'.pickle')
+
+    def load(self, key):
+        '''
+        Lit une entrée du cache (une entrée absente, illisible ou incomplète est ignorée: tout sera préparé à
+        nouveau).
+
+        :param key: clef de l'entrée (voir key)
+            :type: str
+        :returns: entrée (voir prepareMapping), None si elle n'est pas dans le cache
+            :type: dict
+        '''
+
+        try:
+            with open(self.filename(key), 'rb') as fichier:
+                entree = pickle.load(fichier)
+        except (EnvironmentError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+            return None
+        if not(isinstance(entree, dict)) or not(all(clef in entree for clef in self.entryKeys)):
+            return None
+        if not(isinstance(entree['namespaces'], dict)):
+            return None
+        # les préfixes des espaces de nommage servent à l'écriture des fichiers XML (voir retrieveNamespaces)
+        for prefix, uri in entree['namespaces'].items():
+            ET.register_namespace(prefix, uri)
+
+        return entree
+
+    def store(self, key, entry):
+        '''
+        Range une entrée dans le cache (écrite à côté, puis renommée: un cache lu en même temps par une autre
+        conversion n'est jamais incomplet).
+
+        :param key: clef de l'entrée (voir key)
+            :type: str
+        :param entry: entrée (voir prepareMapping)
+            :type: dict
+        '''
+
+        filename = self.filename(key)
+        temporaire = filename+'.'+str(os.getpid())+'.tmp'
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            with open(temporaire, 'wb') as fichier:
+                pickle.dump(entry, fichier, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporaire, filename)
+        except EnvironmentError:
+            writeError(filename)
+
+        return None
+
+#--------------------------------------------------------------
+def newTemplateEngine(engine, XMLTree, plans, serializer):
+    """
+    Prépare le moteur "template" si c'est le moteur demandé (il a besoin des plans d'insertion compilés).
+
+    :param engine: moteur de conversion, "tree" ou "template"
+        :type str
+    :param XMLTree: squelette de l'arbre XML de base
+        :type Skeleton
+    :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+        :type: dict
+    :param serializer: sérialisation des arbres XML (voir selectXMLBackend)
+        :type: TreeSerializer ou LxmlBackend
+    :returns: moteur "template", ou None pour le moteur "tree"
+        :type: TemplateEngine
+    """
+
+    if (engine == 'template') and not(plans is None):
+        return TemplateEngine(XMLTree, plans, serializer)
+
+    return None
+
+#--------------------------------------------------------------
+def initConversionWorker(XMLTree, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, namespaces, engine='tree', withStats=False, backend=None, columns=None, fragments=fragmentCacheSize, validator=None):
+    """
+    Initialisation d'un processus de conversion (conversion en parallèle): l'arbre XML de base, le mapping
+    vérifié et compilé et les espaces de nommage sont reçus une seule fois et gardés pour tous les paquets
+    de lignes confiés au processus (voir convertRowsChunk).
+
+    :param namespaces: dictionnaire contenant les couples "TAG":"URI" (voir retrieveNamespaces)
+        :type dict
+    :param engine: moteur de conversion, "tree" ou "template" (chaque processus a ses propres gabarits)
+        :type str
+    :param withStats: mesurer la conversion de chaque paquet (voir ConversionStats)
+        :type bool
+    :param backend: sérialisation XML (voir selectXMLBackend; None: TreeSerializer, d'après cleanEmptyLeaf)
+        :type TreeSerializer ou LxmlBackend
+    :param columns: colonnes du fichier de données (les lignes sont alors des listes de données)
+        :type ColumnPlan
+    :param fragments: taille du cache des mini-arbres des champs de ce processus (voir FragmentCache)
+        :type int
+    :param validator: validation des fichiers produits (le schéma est compilé par ce processus; None: pas de
+        validation)
+        :type SchemaValidator
+    (autres paramètres: voir buildXMLDocument)
+    :returns: None
+    """
+
+    global workerContext, conversionStats
+    # les mesures du processus principal ne sont pas celles de ce processus
+    conversionStats = None
+    if not(namespaces is None):
+        for prefix, uri in namespaces.items():
+            ET.register_namespace(prefix, uri)
+    if backend is None:
+        backend = TreeSerializer(cleanEmptyLeaf)
+    fragmentCache.resize(fragments)
+    templates = newTemplateEngine(engine, XMLTree, plans, backend)
+    workerContext = (XMLTree, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates, withStats, backend, columns, validator)
+
+    return None
+
+#--------------------------------------------------------------
+def convertRowsChunk(chunk):
+    """
+    Convertit un paquet de lignes dans un processus de conversion. Les messages (print) de chaque ligne
+    sont capturés pour être affichés par le processus principal, dans l'ordre des lignes.
+
+    :param chunk: liste de couples (numéro de ligne, ligne de données)
+        :type list
+    :returns: liste de tuples (numéro de ligne, cote, contenu du fichier, messages, erreurs de validation ou
+        None), et mesures du paquet (voir ConversionStats.toDict; None si elles ne sont pas demandées)
+        :type tuple (list, dict)
+    """
+
+    global conversionStats
+    XMLTree, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates, withStats, backend, columns, validator = workerContext
+    if withStats:
+        conversionStats = ConversionStats()
+    results = []
+    for numRow, row in chunk:
+        messages = io.StringIO()
+        with redirect_stdout(messages):
+            cote, document = buildXMLDocument(XMLTree, row, numRow, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates, backend, columns)
+        erreurs = None if validator is None else validator.errors(document)
+        results.append((numRow, cote, document, messages.getvalue(), erreurs))
+    mesures = None
+    if withStats:
+        mesures = conversionStats.toDict()
+        conversionStats = None
+
+    return results, mesures
+
+#--------------------------------------------------------------
+def processRowsInParallel(readerSource, XMLTree, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf, plans, prolog, jobs, namespaces, engine='tree', manifest=None, sink=None, backend=None, columns=None, shard=None, report=None):
+    """
+    Répartit les lignes de données, par paquets, entre plusieurs processus de conversion. Les fichiers sont
+    écrits, et les messages affichés, par le processus principal dans l'ordre des lignes: le résultat est
+    le même qu'avec un traitement ligne par ligne.
+
+    :param readerSource: lecteur des lignes de données (listes de données si "columns" est fourni)
+        :type csv.reader ou csv.DictReader
+    :param jobs: nombre de processus de conversion
+        :type int
+    :param namespaces: dictionnaire contenant les couples "TAG":"URI" (voir retrieveNamespaces)
+        :type dict
+    :param engine: moteur de conversion, "tree" ou "template"
+        :type str
+    :param manifest: manifeste de la conversion incrémentale (les lignes inchangées ne sont pas envoyées)
+        :type Manifest
+    :param sink: destination des fichiers (voir openOutputSink; None: un fichier par ligne dans outPath)
+        :type DirectorySink, ZipSink, TarSink ou ThreadedSink
+    :param backend: sérialisation XML (voir selectXMLBackend), recopiée dans chaque processus de conversion
+        :type TreeSerializer ou LxmlBackend
+    :param columns: colonnes du fichier de données (voir ColumnPlan), recopiées dans chaque processus de conversion
+        :type ColumnPlan
+    :param shard: numéro du lot de lignes à convertir et nombre de lots (voir rowShard; None: toutes les lignes)
+        :type tuple (int, int)
+    :param report: rapport de validation (les fichiers sont validés par les processus de conversion)
+        :type ValidationReport
+    (autres paramètres: voir doMap_aRow)
+    :returns: None
+    """
+
+    rowDigests = {}    # empreintes des lignes en cours de conversion (conversion incrémentale)
+    if sink is None:
+        sink = DirectorySink(outPath)
+
+    def chunks():
+        # découpe la lecture des lignes en paquets de jobsChunkSize lignes
+        chunk = []
+        numRow = 1    # la ligne 0 n'est pas comptée car c'est la ligne d'entêtes de colonnes
+        for row in readerSource:
+            if not(columns is None) and (len(row) == 0):
+                # ligne vide, ignorée (comme par csv.DictReader)
+                continue
+            numRow = numRow + 1
+            if not(shard is None):
+                # ligne d'un autre lot
+                cote = rowFileName(row, nameColumn) if columns is None else columns.fileName(row)
+                if not(rowShard(cote, numRow, shard[1]) == shard[0]):
+                    continue
+            if not(manifest is None):
+                ligne = row if columns is None else columns.row(row)
+                rowDigests[numRow] = manifest.rowDigest(ligne)
+                if manifest.skip(rowFileName(ligne, nameColumn), rowDigests[numRow]):
+                    del(rowDigests[numRow])
+                    continue
+            chunk.append((numRow, row))
+            if len(chunk) == jobsChunkSize:
+                yield chunk
+                chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def flush(pending):
+        # écrit les fichiers du plus ancien paquet en attente (attend sa conversion si nécessaire)
+        debut = statsStart()
+        results, mesures = pending.popleft().get()
+        statsStop('wait', debut)
+        if not(mesures is None) and not(conversionStats is None):
+            conversionStats.merge(mesures)
+        for numRow, cote, document, messages, erreurs in results:
+            sys.stdout.write(messages)
+            if not(report is None):
+                report.add(numRow, cote, erreurs)
+            done = None if manifest is None else partial(manifest.record, cote, rowDigests.pop(numRow))
+            sink.write(cote, document, numRow, done)
+
+    initargs = (XMLTree, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, namespaces, engine, not(conversionStats is None), backend, columns, fragmentCache.size, None if report is None else report.validator)
+    with multiprocessing.Pool(jobs, initializer=initConversionWorker, initargs=initargs) as pool:
+        pending = deque()
+        for chunk in chunks():
+            pending.append(pool.apply_async(convertRowsChunk, (chunk,)))
+            # pas plus de jobsQueueDepth paquets en attente par processus
+            if len(pending) >= jobs*jobsQueueDepth:
+                flush(pending)
+        while len(pending) > 0:
+            flush(pending)
+
+    return None
        
 #--------------------------------------------------------------
-def processCSVSource(XMLTree, XmlBase, TEIMapping, pathFileCSV_Source, nameColumn, outPath, verbose, cleanEmptyLeaf):
+def processCSVSource(XMLTree, XmlBase, TEIMapping, pathFileCSV_Source, nameColumn, outPath, verbose, cleanEmptyLeaf, plans=None, prolog=None, jobs=1, namespaces=None, engine='tree', manifest=None, sink=None, backend=None, shard=None, report=None, encoding='utf-8', delimiter=';', progress=None):
     """
     Charge le fichier CSV contenant les champs personnalisés et le converti en série de balises XML.
     Créé un fichier XML par ligne de données. La règle de conversion est dans le dico "TEImapping".
@@ -483,36 +4104,128 @@ def processCSVSource(XMLTree, XmlBase, TEIMapping, pathFileCSV_Source, nameColum
     :param XmlBase: fichier contenant l'arbre XML de base   
         :type: str
     :param TEIMapping: dictonnaire contenant le mapping métadonnée -> balises XML
-    :param pathFileCSV_toMap: le chemin vers le fichier csv contenant la table des données
+    :param pathFileCSV_toMap: le chemin vers le fichier csv contenant la table des données, éventuellement
+        compressé, ou "-" pour l'entrée standard (voir openCSVFile), ou un fichier Arrow/Parquet (voir
+        ColumnarReader); les lignes sont lues au fur et à mesure
          :type: str  
     :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
         :type: str     
     :param outPath: dossier pour stocker le fichiers créés
         :type: str
+    :param plans: plans d'insertion compilés par check_TEIMapping ("entête de colonne"->plan)
+        :type: dict
+    :param prolog: déclarations et commentaires du fichier XML de base; lus dans XmlBase si absents
+        :type: str
+    :param jobs: nombre de processus de conversion (1: conversion ligne par ligne, sans processus supplémentaire)
+        :type: int
+    :param namespaces: dictionnaire contenant les couples "TAG":"URI", à déclarer dans les processus de conversion
+        :type: dict
+    :param engine: moteur de conversion, "tree" (arbre XML) ou "template" (gabarits, voir TemplateEngine)
+        :type: str
+    :param manifest: manifeste de la conversion incrémentale (None: toutes les lignes sont converties)
+        :type: Manifest
+    :param sink: destination des fichiers (voir openOutputSink; None: un fichier par ligne dans outPath)
+        :type: DirectorySink, ZipSink, TarSink ou ThreadedSink
+    :param backend: sérialisation XML (voir selectXMLBackend; None: TreeSerializer, d'après cleanEmptyLeaf)
+        :type: TreeSerializer ou LxmlBackend
+    :param shard: numéro du lot de lignes à convertir et nombre de lots (voir rowShard; None: toutes les lignes)
+        :type: tuple (int, int)
+    :param report: validation de chaque fichier avant son écriture, erreurs dans ce rapport (None: pas de validation)
+        :type: ValidationReport
+    :param encoding: encodage du fichier de données
+        :type: str
+    :param delimiter: séparateur des colonnes du fichier de données
+        :type: str
+    :param progress: suivi de la conversion, qui suit aussi la lecture du fichier de données (None: pas de suivi)
+        :type: ConversionProgress
     : returns: none
     """
     
+    if prolog is None:
+        prolog = getXMLProlog(XmlBase)
+        if prolog is None:
+            print(msgFinDuJeu)
+            return None
+    if sink is None:
+        sink = DirectorySink(outPath)
+    if backend is None:
+        backend = TreeSerializer(cleanEmptyLeaf)
+    # l'arbre de base n'est préparé qu'une fois pour toutes les lignes
+    if not(isinstance(XMLTree, Skeleton)):
+        debut = statsStart()
+        XMLTree = compileSkeleton(XMLTree)
+        statsStop('skeleton', debut)
+    csvfileSource = None
     try:
-        with open(pathFileCSV_Source, encoding='utf-8') as csvfileSource:
-            readerSource = csv.DictReader(csvfileSource, delimiter=';') 
+        with (ColumnarReader(pathFileCSV_Source) if isColumnarSource(pathFileCSV_Source) else openCSVFile(pathFileCSV_Source, encoding)) as csvfileSource:
+            if not(progress is None):
+                progress.watch(csvfileSource)
+            if isinstance(csvfileSource, ColumnarReader):
+                # fichier Arrow/Parquet: seules les colonnes utiles sont lues, par paquets de lignes
+                columns = csvfileSource.plan(TEIMapping, nameColumn)
+                readerSource = iter(csvfileSource)
+            else:
+                readerSource = csv.reader(csvfileSource, delimiter=delimiter)
+                # la ligne d'entêtes est résolue une fois pour toutes d'après le mapping (voir ColumnPlan)
+                header = next(readerSource, None)
+                columns = ColumnPlan([] if header is None else header, TEIMapping, nameColumn)
+            if verbose:
+                for colonne in columns.unmapped:
+                    print('No mapping for column "'+colonne+'": it is not converted')
+            if not(conversionStats is None):
+                # mesure du temps de lecture des lignes
+                readerSource = timedRows(readerSource)
+            if jobs > 1:
+                processRowsInParallel(readerSource, XMLTree, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf, plans, prolog, jobs, namespaces, engine, manifest, sink, backend, columns, shard, report)
+                if not(manifest is None):
+                    # les fichiers en attente d'écriture doivent être dans le manifeste
+                    sink.flush()
+                    manifest.close(True)
+                return None
+            templates = newTemplateEngine(engine, XMLTree, plans, backend)
              # on boucle sur chaque ligne du dico source
             numRow = 1    # la ligne 0 n'est pas comptée car c'est la ligne d'entêtes de colonnes 
             for row in readerSource:
+                if len(row) == 0:
+                    # ligne vide, ignorée (comme par csv.DictReader)
+                    continue
                 numRow = numRow + 1
-                # traite la ligne et créé un fichier temporaire (fName)
-                fName = doMap_aRow(XMLTree, row, numRow, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf)
-                              
-                if not(fName==None):
-                    '''
-                    Compléter le fichier fName avec les déclarations XML du fichier XML de base qui ont
-                    été supprimées lors du parsing (XMLTree gère très mal les déclarations XML). 
-                    '''
-                    completeXMLheader(fName, XmlBase)  
-    except EnvironmentError:
+                if not(shard is None) and not(rowShard(columns.fileName(row), numRow, shard[1]) == shard[0]):
+                    # ligne d'un autre lot
+                    continue
+                '''
+                traite la ligne et créé le fichier XML, complété avec les déclarations XML du fichier XML de base
+                qui ont été supprimées lors du parsing (XMLTree gère très mal les déclarations XML).
+                '''
+                if manifest is None:
+                    doMap_aRow(XMLTree, row, numRow, TEIMapping, nameColumn, outPath, verbose, cleanEmptyLeaf, plans, prolog, templates, sink, backend, columns, report)
+                else:
+                    # conversion incrémentale: on saute les lignes inchangées depuis la dernière conversion
+                    ligne = columns.row(row)
+                    rowDigest = manifest.rowDigest(ligne)
+                    if manifest.skip(rowFileName(ligne, nameColumn), rowDigest):
+                        continue
+                    cote, document = buildXMLDocument(XMLTree, row, numRow, TEIMapping, nameColumn, verbose, cleanEmptyLeaf, plans, prolog, templates, backend, columns)
+                    if not(report is None):
+                        report.check(numRow, cote, document)
+                    sink.write(cote, document, numRow, partial(manifest.record, cote, rowDigest))
+            if not(manifest is None):
+                # les fichiers en attente d'écriture doivent être dans le manifeste
+                sink.flush()
+                manifest.close(True)
+    except (EnvironmentError, UnicodeDecodeError) + compressedErrors as e:
         readError(pathFileCSV_Source)
+        if isinstance(e, UnicodeDecodeError):
+            print('-> it is not encoded in '+encoding+': '+str(e))
         print(msgFinDuJeu)
+        if not(manifest is None):
+            sink.flush()
+            manifest.close(False)
     finally:
-        csvfileSource.close()     
+        if not(progress is None):
+            progress.watch(None)
+        if not(csvfileSource is None):
+            csvfileSource.close()     
         
     return None
 
@@ -523,7 +4236,7 @@ def retrieveNamespaces(XmlBase, namespaces, declarations):
     un dictionnaire qui les contient sous la forme "tag:URI" et une liste contenant les balises
     complètes.
        
-    :param XmlBase: nom du fichier XML "minimal" de base
+    :param XmlBase: nom du fichier XML "minimal" de base (ou son contenu, voir openSource)
         :type str
     :param namespaces : dictionnaire contenant les couples "TAG":"URI"
         :type dict
@@ -538,7 +4251,7 @@ def retrieveNamespaces(XmlBase, namespaces, declarations):
     try:
         nsStart = False
         nsStop = False
-        with open(XmlBase,encoding='utf-8') as xmlfileTemp:
+        with openSource(XmlBase) as xmlfileTemp:
            for ligne in xmlfileTemp:     
                 if (ligne==''):
                     break
@@ -591,8 +4304,156 @@ def retrieveNamespaces(XmlBase, namespaces, declarations):
     
     return True
 
+#--------------------------------------------------------------
+def prepareMapping(XmlBase, CSV_mapFile):
+    """
+    Prépare la conversion: lit les espaces de nommage et le prologue de l'arbre XML de base, charge et
+    vérifie le mapping, compile les plans d'insertion et le squelette de l'arbre de base. Les erreurs sont
+    affichées.
+
+    :param XmlBase: fichier contenant l'arbre XML de base
+        :type: str
+    :param CSV_mapFile: fichier CSV de mapping métadonnées - balises XML
+        :type: str
+    :returns: "namespaces", "declarations", "prolog", "mapping", "plans" et "skeleton" (voir MappingCache),
+        None si l'arbre de base ou le mapping ne sont pas valides
+        :type: dict
+    """
+
+    namespaces = {}   # dictionnaire pour stocker les paires prefix, uri
+    declarations =[]  # liste contenant la reconstitution des balises de déclaration des namespaces
+    plans = {}        # plans d'insertion compilés, par entête de colonne
+
+    debut = statsStart()
+    if (retrieveNamespaces(XmlBase,namespaces,declarations) == False):
+        return None
+    try:
+         # charger l'arbre de base ("minimal") XML
+        XMLTree = ET.parse(XmlBase)
+    except ET.ParseError as e:
+        linenum, colnum = e.position
+        print('File '+XmlBase+' has a mistake (line '+str(linenum)+';column '+str(colnum)+')')
+        print ('->',e.msg)
+        print(msgFinDuJeu)
+        return None
+    # charger le fichier de mapping dans un dico
+    TEIMapping = loadCSVtoTEIMapping(CSV_mapFile)
+    statsStop('load', debut)
+    # déclarations et commentaires du fichier XML de base, à reprendre dans chaque fichier créé
+    debut = statsStart()
+    prolog = getXMLProlog(XmlBase)
+    statsStop('prolog', debut)
+    debut = statsStart()
+    checked = (not(prolog==None)) and (not(TEIMapping==None)) and (check_TEIMapping(TEIMapping, declarations, plans) == True)
+    statsStop('check', debut)
+    if not(checked):
+        print(msgFinDuJeu)
+        return None
+    # l'arbre de base n'est préparé qu'une fois pour toutes les lignes
+    debut = statsStart()
+    skeleton = compileSkeleton(XMLTree)
+    statsStop('skeleton', debut)
+
+    return {'namespaces': namespaces, 'declarations': declarations, 'prolog': prolog, 'mapping': TEIMapping, 'plans': plans, 'skeleton': skeleton}
+
+#--------------------------------------------------------------
+class XMLConverter(object):
+    '''
+    Convertisseur en mémoire, pour utiliser XMLify comme bibliothèque: l'arbre XML de base et le mapping sont
+    chargés et vérifiés une seule fois, puis chaque ligne de données (un dictionnaire "entête de colonne"->"donnée",
+    venant de n'importe quelle source) est convertie en un fichier XML rendu en mémoire, sans rien lire ni écrire
+    sur disque.
+
+    exemple:
+        converter = XMLConverter('TeiHeader.xml', 'mapping.csv', 'Cote')
+        for filename, document in converter.convert_rows(lignes):
+            ...
+    '''
+
+    def __init__(self, XmlBase, CSV_mapFile, nameColumn, verbose=False, cleanEmptyLeaf=True, engine='tree', backend='etree', compact=False):
+        '''
+        :param XmlBase: fichier contenant l'arbre XML de base, ou son contenu (voir openSource)
+            :type: str
+        :param CSV_mapFile: fichier CSV de mapping métadonnées - balises XML, ou son contenu
+            :type: str
+        :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
+            :type: str
+        :param verbose: signaler les colonnes sans mapping
+            :type: bool
+        :param cleanEmptyLeaf: suppression des feuilles vides: False, True (1er niveau) ou 'all' (voir TreeSerializer)
+            :type: bool ou str
+        :param engine: moteur de conversion, "tree" (arbre XML) ou "template" (gabarits, voir TemplateEngine)
+            :type: str
+        :param backend: sérialisation XML, "etree" ou "lxml" (voir selectXMLBackend)
+            :type: str
+        :param compact: pas de mise en forme des fichiers XML (voir TreeSerializer)
+            :type: bool
+        :raises ValueError: si l'arbre de base ou le mapping ne peuvent être lus ou ne sont pas valides
+            (le détail est affiché, comme pour convertCSVToXML)
+        '''
+
+        if not(engine in ('tree', 'template')):
+            raise ValueError('Unknown conversion engine "'+str(engine)+'" (expected "tree" or "template")')
+        self.namespaces = {}
+        declarations = []
+        self.plans = {}
+        if (retrieveNamespaces(XmlBase, self.namespaces, declarations) == False):
+            raise ValueError('Cannot read XML base')
+        try:
+            XMLTree = ET.parse(io.StringIO(XmlBase) if isInlineSource(XmlBase) else XmlBase)
+        except ET.ParseError as e:
+            linenum, colnum = e.position
+            raise ValueError('XML base has a mistake (line '+str(linenum)+';column '+str(colnum)+'): '+e.msg)
+        self.TEIMapping = loadCSVtoTEIMapping(CSV_mapFile)
+        self.prolog = getXMLProlog(XmlBase)
+        if (self.prolog is None) or (self.TEIMapping is None) or not(check_TEIMapping(self.TEIMapping, declarations, self.plans) == True):
+            raise ValueError('Invalid XML base or mapping')
+        self.XMLTree = compileSkeleton(XMLTree)
+        self.backend = selectXMLBackend(backend, cleanEmptyLeaf, compact)
+        self.templates = newTemplateEngine(engine, self.XMLTree, self.plans, self.backend)
+        self.nameColumn = nameColumn
+        self.verbose = verbose
+        self.cleanEmptyLeaf = cleanEmptyLeaf
+        self.numRow = 1    # numérotation des lignes comme dans un fichier CSV (la ligne 1 est celle des entêtes)
+
+    def convert_row(self, row, numRow=None):
+        '''
+        Convertit une ligne de données en fichier XML, en mémoire.
+
+        :param row: dictionnaire "entête de colonne"->"donnée"; une donnée None est traitée comme "none"
+            (pas de donnée), les autres sont converties en texte
+            :type: dict
+        :param numRow: numéro de la ligne, pour les messages (None: ligne suivant la précédente)
+            :type: int
+        :returns: nom du fichier (avec l'extension .xml) et contenu du fichier, encodé en UTF-8
+            :type: tuple (str, bytes)
+        '''
+
+        if numRow is None:
+            numRow = self.numRow + 1
+        self.numRow = numRow
+        donnees = {}
+        for colonne, valeur in row.items():
+            donnees[colonne] = 'none' if valeur is None else (valeur if isinstance(valeur, str) else str(valeur))
+        cote, document = buildXMLDocument(self.XMLTree, donnees, numRow, self.TEIMapping, self.nameColumn, self.verbose, self.cleanEmptyLeaf, self.plans, self.prolog, self.templates, self.backend)
+
+        return cote+'.xml', document
+
+    def convert_rows(self, rows):
+        '''
+        Convertit une série de lignes de données au fur et à mesure qu'elles sont lues (générateur).
+
+        :param rows: lignes de données (voir convert_row), par ex. un csv.DictReader
+            :type: iterable
+        :returns: pour chaque ligne, nom du fichier et contenu du fichier (voir convert_row)
+            :type: generator de tuple (str, bytes)
+        '''
+
+        for row in rows:
+            yield self.convert_row(row)
+
 #--------------------------------------------------------------    
-def convertCSVToXML(XmlBase, CSV_mapFile, CSV_dataFile, nameColumn, outPath, verbose = False, cleanEmptyLeaf = True):
+def convertCSVToXML(XmlBase, CSV_mapFile, CSV_dataFile, nameColumn, outPath, verbose = False, cleanEmptyLeaf = True, jobs = 1, engine = 'tree', incremental = False, prune = False, archive = None, stats = False, writers = 0, backend = 'etree', compact = False, cache = None, fragments = None, shard = None, validate = None, corpus = None, encoding = 'utf-8', delimiter = ';', layout = None, progress = None, metrics = None):
     """
     Converti un fichier de données CSV en une série de fichiers XML
     
@@ -600,37 +4461,180 @@ def convertCSVToXML(XmlBase, CSV_mapFile, CSV_dataFile, nameColumn, outPath, ver
         :type: str
     :param CSV_mapFile: chemin du fichier CSV de mapping métadonnées - balises XML
         : type: str
-    :param CSV_dataFile: chemin du fichier CSV de métadonnées
+    :param CSV_dataFile: chemin du fichier CSV de métadonnées, éventuellement compressé, ou "-" pour l'entrée
+        standard (voir openCSVFile), ou d'un fichier Arrow/Parquet (voir ColumnarReader)
         : type: str
     :param nameColumn: nom de la colonne dont la donnée sert à fabriquer le nom du fichier XML créé
         : type: str
     :param outPath: dossier de destination des fichiers XML
         : type: str
+    :param cleanEmptyLeaf: suppression des feuilles vides: False, True (1er niveau) ou 'all' (toute profondeur,
+        voir TreeSerializer)
+        : type: bool ou str
+    :param jobs: nombre de processus de conversion en parallèle (0: autant que de processeurs)
+        : type: int
+    :param engine: moteur de conversion, "tree" (arbre XML) ou "template" (gabarits, voir TemplateEngine)
+        : type: str
+    :param incremental: ne reconvertir que les lignes modifiées depuis la dernière conversion (voir Manifest)
+        : type: bool
+    :param prune: en conversion incrémentale, supprimer les fichiers dont la ligne a disparu
+        : type: bool
+    :param archive: nom d'une archive (zip, tar...) à créer dans outPath à la place d'un fichier par ligne
+        (voir openOutputSink)
+        : type: str
+    :param stats: mesurer la conversion (voir ConversionStats): True pour afficher les mesures à la fin,
+        ou nom du fichier JSON où les enregistrer
+        : type: bool ou str
+    :param writers: nombre de processus légers écrivant les fichiers en arrière-plan (0: écriture au fil
+        de la conversion, voir ThreadedSink)
+        : type: int
+    :param backend: sérialisation XML, "etree" (voir TreeSerializer) ou "lxml" (voir LxmlBackend)
+        : type: str
+    :param compact: pas de mise en forme des fichiers XML (voir TreeSerializer)
+        : type: bool
+    :param cache: dossier du cache du mapping préparé (voir MappingCache; None: pas de cache)
+        : type: str
+    :param fragments: nombre de mini-arbres des champs gardés en cache (voir FragmentCache; 0: pas de cache,
+        None: fragmentCacheSize)
+        : type: int
+    :param shard: ne convertir que le lot de lignes i sur N (voir rowShard), avec son propre manifeste (voir
+        Manifest et mergeManifests), qui décrit un fichier par ligne: pas d'archive ni de corpus; None: toutes
+        les lignes
+        : type: tuple (int, int)
+    :param validate: valider chaque fichier produit avec un schéma RelaxNG (voir SchemaValidator): True pour le
+        schéma déclaré par <?xml-model?> dans XmlBase, ou chemin d'accès du schéma; les fichiers invalides sont
+        écrits et signalés dans un rapport (voir ValidationReport). None: pas de validation
+        : type: bool ou str
+    :param corpus: nom d'un corpus en un seul fichier (teiCorpus, ou un document par ligne avec l'extension
+        corpusLinesExtension), avec son index, à créer dans outPath à la place d'un fichier par ligne (voir
+        CorpusSink et CorpusReader)
+        : type: str
+    :param encoding: encodage du fichier de données
+        : type: str
+    :param delimiter: séparateur des colonnes du fichier de données
+        : type: str
+    :param layout: répartition des fichiers en sous-dossiers de outPath (voir OutputLayout), enregistrée dans
+        outPath; None: celle déjà enregistrée dans outPath, s'il y en a une, sinon pas de sous-dossier
+        : type: str
+    :param progress: afficher l'avancement de la conversion toutes les "progress" secondes (voir
+        ConversionProgress); None: pas d'affichage
+        : type: float
+    :param metrics: fichier de mesures de l'avancement (".prom": format Prometheus, sinon JSON, une entrée par
+        ligne), mis à jour toutes les "progress" secondes (progressInterval par défaut); None: pas de fichier
+        : type: str
     : returns: none
     """
+
+    if not(engine in ('tree', 'template')):
+        print('Unknown conversion engine "'+str(engine)+'" (expected "tree" or "template")')
+        print(msgFinDuJeu)
+        return None
+    if incremental and not(archive is None and corpus is None):
+        print('Incremental conversion needs one file per row: it cannot be used with an archive or a corpus')
+        print(msgFinDuJeu)
+        return None
+    if not(shard is None) and not(archive is None and corpus is None):
+        # le manifeste du lot décrirait des fichiers absents de outPath, et les lots écriraient tous la même archive
+        print('A shard conversion needs one file per row: it cannot be used with an archive or a corpus')
+        print(msgFinDuJeu)
+        return None
+    if not(archive is None) and not(corpus is None):
+        print('An archive and a corpus cannot be written together: choose one of them')
+        print(msgFinDuJeu)
+        return None
+    # répartition des fichiers en sous-dossiers: celle de outPath, s'il y en a une, doit être gardée
+    enregistree = readOutputLayout(outPath)
+    if layout is None:
+        layout = enregistree
+    else:
+        try:
+            layout = OutputLayout(layout)
+        except ValueError as e:
+            print('Unknown output layout '+str(e))
+            print(msgFinDuJeu)
+            return None
+        if not(enregistree is None) and not(enregistree.spec == layout.spec):
+            print('Files in '+outPath+' are laid out with "'+enregistree.spec+'": use the same layout, or another folder')
+            print(msgFinDuJeu)
+            return None
+    if not(layout is None) and not(archive is None and corpus is None):
+        print('An output layout needs one file per row: it cannot be used with an archive or a corpus')
+        print(msgFinDuJeu)
+        return None
+
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    fragmentCache.resize(fragmentCacheSize if fragments is None else fragments)
        
-    namespaces = {}   # dictionnaire pour stocker les paires prefix, uri
-    declarations =[]  # liste contenant la reconstitution des balises de déclaration des namespaces
-    
-    if (retrieveNamespaces(XmlBase,namespaces,declarations) == False):
-        return None    
+    global conversionStats
+    if not(stats is None) and not(stats is False):
+        conversionStats = ConversionStats()
+    suivi = None
     try:
-         # charger l'arbre de base ("minimal") XML
-        XMLTree = ET.parse(XmlBase)
-    except ET.ParseError as e:
-        linenum, colnum = e.position
-        print('File '+XmlBase+' has a mistake (line '+str(linenum)+';column '+str(colnum)+')')
-        print ('->',e.msg)
-        print(msgFinDuJeu)
-    else:   
-        # charger le fichier de mapping dans un dico
-        TEIMapping = loadCSVtoTEIMapping(CSV_mapFile)
-        # si il est valide, on procède aux conversions    
-        if (not(TEIMapping==None)) and (check_TEIMapping(TEIMapping, declarations) == True):
-            processCSVSource(XMLTree, XmlBase, TEIMapping, CSV_dataFile, nameColumn, outPath, verbose, cleanEmptyLeaf)    
-        else:
+        preparation = None
+        if not(cache is None):
+            # mapping déjà préparé par une conversion précédente, avec les mêmes fichiers
+            debut = statsStart()
+            mappingCache = MappingCache(cache)
+            cle = mappingCache.key(XmlBase, CSV_mapFile)
+            if not(cle is None):
+                preparation = mappingCache.load(cle)
+            statsStop('cache', debut)
+        if preparation is None:
+            preparation = prepareMapping(XmlBase, CSV_mapFile)
+            if preparation is None:
+                return None
+            if not(cache is None) and not(cle is None):
+                mappingCache.store(cle, preparation)
+        manifest = None
+        if incremental or not(shard is None):
+            # empreintes du mapping et de l'arbre de base (avec l'option qui change le contenu des fichiers)
+            mappingDigest = fileDigest(CSV_mapFile)
+            mise = b'cleanall' if cleanEmptyLeaf == 'all' else (b'clean' if cleanEmptyLeaf else b'noclean')
+            templateDigest = fileDigest(XmlBase, mise + (b'compact' if compact else b''))
+            if (mappingDigest is None) or (templateDigest is None):
+                print(msgFinDuJeu)
+                return None
+            manifest = Manifest(outPath, mappingDigest, templateDigest, prune, shard, incremental, layout)
+        report = None
+        if not(validate is None) and not(validate is False):
+            # le schéma est compilé une fois, avant la conversion, pour signaler aussitôt un schéma inutilisable
+            schema = validate if isinstance(validate, str) else schemaFromProlog(preparation['prolog'], XmlBase)
+            if schema is None:
+                print('No RelaxNG schema declared (<?xml-model href="...rng"?>) in '+XmlBase+': give it to --schema')
+                print(msgFinDuJeu)
+                return None
+            validator = SchemaValidator(schema)
+            if not(validator.compile()):
+                print(msgFinDuJeu)
+                return None
+            report = ValidationReport(outPath, validator, shard)
+        if not(layout is None) and (enregistree is None) and not(layout.store(outPath)):
             print(msgFinDuJeu)
-            
+            return None
+        if not(progress is None) or not(metrics is None):
+            # suivi de la conversion: seuls les fichiers écrits sont comptés au fil de la conversion
+            suivi = ConversionProgress(progressInterval if progress is None else progress, not(progress is None), metrics, os.path.basename(CSV_dataFile))
+            suivi.manifest = manifest
+            suivi.report = report
+        sink = openOutputSink(outPath, archive, writers, corpus, preparation['prolog'], preparation['skeleton'].root.tag, layout, suivi)
+        if sink is None:
+            suivi = None
+            print(msgFinDuJeu)
+            return None
+        if not(suivi is None):
+            suivi.start()
+        processCSVSource(preparation['skeleton'], XmlBase, preparation['mapping'], CSV_dataFile, nameColumn, outPath, verbose, cleanEmptyLeaf, preparation['plans'], preparation['prolog'], jobs, preparation['namespaces'], engine, manifest, sink, selectXMLBackend(backend, cleanEmptyLeaf, compact), shard, report, encoding, delimiter, suivi)
+        sink.close()
+        if not(report is None):
+            report.close()
+    finally:
+        if not(suivi is None):
+            suivi.close()
+        if not(conversionStats is None):
+            conversionStats.report(stats if isinstance(stats, str) else None)
+            conversionStats = None
+
     return None    
 
 
@@ -669,6 +4673,411 @@ def is_valid_file(parser, arg):
         return arg
     return None
 
+#--------------------------------------------------------------
+def is_valid_input(parser, arg):
+    """
+    Check if arg is a valid data input: "-" (standard input), or a file that already exists on the file system,
+    possibly compressed (a .zst file needs the zstandard module), or an Arrow/Parquet file (needs the pyarrow module).
+
+    :param parser : argparse object
+        type: ??
+    :param arg: file path name, or "-"
+        type: str
+    :Returns:
+        type: str
+    """
+    if arg == '-':
+        return arg
+    if arg.lower().endswith('.zst') and (zstandard is None):
+        parser.error("The file %s needs the zstandard module!" % arg)
+    if not(isColumnarSource(arg) is None) and (pyarrow is None):
+        parser.error("The file %s needs the pyarrow module!" % arg)
+    return is_valid_file(parser, arg)
+
+#--------------------------------------------------------------
+def is_valid_encoding(parser, arg):
+    """
+    Check if arg is a known text encoding.
+
+    :param parser : argparse object
+        type: ??
+    :param arg: encoding name
+        type: str
+    :Returns:
+        type: str
+    """
+    try:
+        codecs.lookup(arg)
+    except LookupError:
+        parser.error("The encoding %s is unknown!" % arg)
+    return arg
+
+#--------------------------------------------------------------
+def is_valid_delimiter(parser, arg):
+    """
+    Check if arg is a valid CSV delimiter: one character, or "\\t" (or "tab") for a tabulation.
+
+    :param parser : argparse object
+        type: ??
+    :param arg: delimiter
+        type: str
+    :Returns:
+        type: str
+    """
+    if arg in ('\\t', 'tab'):
+        return '\t'
+    if len(arg) != 1:
+        parser.error("The delimiter %s is not a single character!" % arg)
+    return arg
+
+#--------------------------------------------------------------
+def is_valid_layout(parser, arg):
+    """
+    Check if arg is a valid output layout (see OutputLayout).
+
+    :param parser : argparse object
+        type: ??
+    :param arg: layout
+        type: str
+    :Returns:
+        type: str
+    """
+    try:
+        OutputLayout(arg)
+    except ValueError as e:
+        parser.error("The output layout %s is not valid!" % str(e))
+    return arg
+
+#--------------------------------------------------------------
+def is_valid_interval(parser, arg):
+    """
+    Check if arg is a valid progress interval: a positive number of seconds.
+
+    :param parser : argparse object
+        type: ??
+    :param arg: number of seconds
+        type: str
+    :Returns:
+        type: float
+    """
+    try:
+        secondes = float(arg)
+    except ValueError:
+        secondes = 0.0
+    if not(secondes > 0):
+        parser.error("The interval %s is not a positive number of seconds!" % arg)
+    return secondes
+
+#--------------------------------------------------------------
+def is_valid_jobs(parser, arg):
+    """
+    Check if arg is a valid number of conversion processes (0 means one per CPU) or of writer threads.
+
+    :param parser : argparse object
+        type: ??
+    :param arg: number of processes
+        type: str
+    :Returns:
+        type: int
+    """
+    if not arg.isdigit():
+        parser.error("The number %s is not a positive integer!" % arg)
+    else:
+        return int(arg)
+    return None
+
+#--------------------------------------------------------------
+def is_valid_shard(parser, arg):
+    """
+    Check if arg is a valid shard "i/N": shard number i (from 1 to N) out of N shards.
+
+    :param parser : argparse object
+        type: ??
+    :param arg: shard
+        type: str
+    :Returns:
+        type: tuple (int, int)
+    """
+    morceaux = arg.split('/')
+    if (len(morceaux) != 2) or not(morceaux[0].isdigit()) or not(morceaux[1].isdigit()) or not(1 <= int(morceaux[0]) <= int(morceaux[1])):
+        parser.error("The shard %s is not i/N with 1 <= i <= N!" % arg)
+    else:
+        return (int(morceaux[0]), int(morceaux[1]))
+    return None
+
+#--------------------------------------------------------------
+def initServerWorker(converters):
+    """
+    Initialisation d'un processus du serveur de conversion (voir serveConversions): les convertisseurs,
+    avec leur arbre XML de base et leur mapping déjà vérifiés et compilés, sont reçus une seule fois et
+    gardés pour toutes les requêtes.
+
+    :param converters: convertisseurs, par nom
+        :type: dict
+    :returns: None
+    """
+
+    global serverConverters, conversionStats
+    conversionStats = None
+    # les préfixes des espaces de nommage servent à l'écriture des fichiers XML (voir retrieveNamespaces)
+    for converter in converters.values():
+        for prefix, uri in converter.namespaces.items():
+            ET.register_namespace(prefix, uri)
+    serverConverters = converters
+
+    return None
+
+#--------------------------------------------------------------
+def convertServerRows(name, rows):
+    """
+    Convertit les lignes d'une requête dans un processus du serveur de conversion. Les messages (print)
+    de chaque ligne sont capturés pour être renvoyés avec son fichier.
+
+    :param name: nom du convertisseur
+        :type: str
+    :param rows: lignes de données (voir XMLConverter.convert_row), numérotées comme dans un fichier CSV
+        :type: list
+    :returns: liste de tuples (nom du fichier, contenu du fichier, messages)
+        :type: list
+    """
+
+    converter = serverConverters[name]
+    results = []
+    numRow = 1    # la ligne 1 est celle des entêtes de colonnes
+    for row in rows:
+        numRow = numRow + 1
+        messages = io.StringIO()
+        with redirect_stdout(messages):
+            filename, document = converter.convert_row(row, numRow)
+        results.append((filename, document, messages.getvalue()))
+
+    return results
+
+#--------------------------------------------------------------
+class ConversionRequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    Requêtes HTTP du serveur de conversion (voir serveConversions):
+    - GET /: noms des convertisseurs chargés (JSON);
+    - POST /<nom>: convertit les lignes envoyées avec le convertisseur <nom> (qui peut être omis s'il n'y en a
+      qu'un). Le corps est un objet JSON "entête de colonne"->"donnée" (une ligne: la réponse est le fichier XML,
+      son nom et les messages de conversion sont dans les entêtes X-XMLify-File et X-XMLify-Messages), une liste
+      de tels objets, ou un fichier CSV (Content-Type: text/csv; entêtes de colonnes puis lignes, séparées par
+      des ";"): la réponse est alors une liste JSON d'objets "file", "xml" et "messages", dans l'ordre des lignes.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # une socket Unix n'a pas d'adresse de client
+        return self.client_address[0] if isinstance(self.client_address, tuple) else str(self.server.server_address)
+
+    def log_message(self, format, *args):
+        # pas de journal des requêtes
+        return None
+
+    def reply(self, status, body, contentType, headers=None):
+        '''
+        Envoie la réponse.
+
+        :param status: code de la réponse HTTP
+            :type: int
+        :param body: corps de la réponse
+            :type: bytes
+        :param contentType: type du corps
+            :type: str
+        :param headers: entêtes supplémentaires
+            :type: dict
+        '''
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        for nom, valeur in (headers or {}).items():
+            self.send_header(nom, valeur)
+        self.end_headers()
+        self.wfile.write(body)
+
+        return None
+
+    def replyError(self, status, message):
+        '''
+        Envoie une réponse d'erreur (objet JSON "error").
+        '''
+        return self.reply(status, json.dumps({'error': message}, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/':
+            return self.replyError(404, 'Unknown path '+self.path)
+        return self.reply(200, json.dumps({'converters': self.server.names}, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+    def do_POST(self):
+        nom = self.path.split('?')[0].strip('/')
+        if (nom == '') and (len(self.server.names) == 1):
+            nom = self.server.names[0]
+        try:
+            longueur = int(self.headers.get('Content-Length', '0'))
+        except ValueError:
+            longueur = -1
+        if longueur < 0:
+            self.close_connection = True
+            return self.replyError(400, 'Invalid Content-Length')
+        corps = self.rfile.read(longueur)
+        if not(nom in self.server.names):
+            return self.replyError(404, 'Unknown converter "'+nom+'" (expected one of: '+', '.join(self.server.names)+')')
+        typeContenu = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        try:
+            texte = corps.decode('utf-8-sig')
+            if typeContenu in ('text/csv', 'application/csv'):
+                lignes = list(csv.DictReader(io.StringIO(texte, newline=''), delimiter=';'))
+                unique = False
+            else:
+                lignes = json.loads(texte)
+                unique = isinstance(lignes, dict)
+                if unique:
+                    lignes = [lignes]
+                if not(isinstance(lignes, list)) or not(all(isinstance(ligne, dict) for ligne in lignes)):
+                    return self.replyError(400, 'Body must be a JSON object, a JSON list of objects or CSV (text/csv)')
+        except (ValueError, csv.Error) as e:
+            return self.replyError(400, 'Invalid request body: '+str(e))
+        try:
+            results = self.server.pool.apply(convertServerRows, (nom, lignes))
+        except Exception as e:
+            # une ligne qui ne peut être convertie ne doit pas arrêter le serveur
+            return self.replyError(500, 'Conversion failed: '+type(e).__name__+': '+str(e))
+        if unique:
+            filename, document, messages = results[0]
+            return self.reply(200, document, 'application/xml; charset=utf-8', {'X-XMLify-File': quote(filename), 'X-XMLify-Messages': quote(messages)})
+        reponse = [{'file': filename, 'xml': document.decode('utf-8'), 'messages': messages} for filename, document, messages in results]
+
+        return self.reply(200, json.dumps(reponse, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8')
+
+#--------------------------------------------------------------
+if hasattr(socketserver, 'UnixStreamServer'):
+    class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        '''
+        Serveur HTTP sur une socket Unix, une requête par processus léger (comme http.server.ThreadingHTTPServer).
+        '''
+        daemon_threads = True
+
+#--------------------------------------------------------------
+def serveConversions(converters, host='127.0.0.1', port=8000, socketPath=None, jobs=0):
+    """
+    Serveur de conversion: les convertisseurs restent chargés et convertissent à la demande les lignes reçues
+    par HTTP, sur un port local ou sur une socket Unix (voir ConversionRequestHandler). Les requêtes simultanées
+    sont réparties entre plusieurs processus de conversion. S'arrête par Ctrl-C.
+
+    :param converters: convertisseurs, par nom (voir XMLConverter)
+        :type: dict
+    :param host: adresse d'écoute
+        :type: str
+    :param port: port d'écoute (0: un port libre, affiché au démarrage)
+        :type: int
+    :param socketPath: chemin d'une socket Unix, à la place de host et port
+        :type: str
+    :param jobs: nombre de processus de conversion (0: autant que de processeurs)
+        :type: int
+    :returns: None
+    """
+
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    try:
+        if socketPath is None:
+            serveur = http.server.ThreadingHTTPServer((host, port), ConversionRequestHandler)
+            adresse = 'http://'+host+':'+str(serveur.server_address[1])+'/'
+        else:
+            if not(hasattr(socketserver, 'UnixStreamServer')):
+                print('Unix sockets are not available on this system')
+                print(msgFinDuJeu)
+                return None
+            # une socket restée d'un serveur précédent
+            if os.path.exists(socketPath) and stat.S_ISSOCK(os.stat(socketPath).st_mode):
+                os.remove(socketPath)
+            serveur = ThreadingUnixHTTPServer(socketPath, ConversionRequestHandler)
+            adresse = 'unix:'+socketPath
+    except EnvironmentError as e:
+        print('Cannot listen on '+(host+':'+str(port) if socketPath is None else socketPath)+': '+str(e))
+        print(msgFinDuJeu)
+        return None
+    serveur.names = list(converters)
+    try:
+        with multiprocessing.Pool(jobs, initializer=initServerWorker, initargs=(converters,)) as pool:
+            serveur.pool = pool
+            print('Serving '+', '.join(serveur.names)+' on '+adresse+' ('+str(jobs)+' conversion processes)', flush=True)
+            try:
+                serveur.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        serveur.server_close()
+        if not(socketPath is None) and os.path.exists(socketPath):
+            os.remove(socketPath)
+
+    return None
+
+#--------------------------------------------------------------
+def serveCommand(arguments):
+    """
+    Ligne de commande du serveur de conversion ("XMLify.py serve ...", voir serveConversions).
+
+    :param arguments: arguments qui suivent "serve"
+        :type: list
+    :returns: None
+    """
+
+    import argparse                            # pour traiter les arguments en ligne de commande
+    parser = argparse.ArgumentParser(prog='XMLify.py serve', description='Keep base XML trees and mappings loaded and convert rows sent over HTTP (GET / lists converters; POST /NAME with a JSON object returns the XML file, with a JSON list of objects or a CSV body (text/csv) returns a JSON list of {"file", "xml", "messages"}).')
+    parser.add_argument("-m", "--mapping", nargs=4, action='append', required=True, metavar=('NAME', 'XMLBASE', 'MAPFILE', 'REFCOLUMN'), help='converter served at /NAME: minimum XML tree file, CSV mapping file and header of the column used to forge file names. Repeat the option to serve several converters.')
+    parser.add_argument("--host", default='127.0.0.1', help='address to listen on. Default is "127.0.0.1".')
+    parser.add_argument("--port", type=lambda x: is_valid_jobs(parser, x), default=8000, help="port to listen on (0: any free port). Default is 8000.")
+    parser.add_argument("-u", "--socket", help="listen on this Unix socket instead of a TCP port.")
+    parser.add_argument("-j", "--jobs", type=lambda x: is_valid_jobs(parser, x), default=0, help="number of processes converting requests (0: one per CPU). Default is 0.")
+    parser.add_argument("-v", "--verbose", help="report data columns not mapped to XML in conversion messages. Default is False.", action="store_true")
+    parser.add_argument("-n", "--noclean", help="set this option if you do not want empty XML tag be remove from the XML tree. Default is True.", action="store_false")
+    parser.add_argument("--clean-all", help="remove empty XML tags at any depth. Default is False.", action="store_true")
+    parser.add_argument("-c", "--compact", help="do not indent XML files. Default is False.", action="store_true")
+    parser.add_argument("-e", "--engine", choices=['tree', 'template'], default='tree', help='conversion engine (see XMLify.py -h). Default is "tree".')
+    parser.add_argument("-b", "--backend", choices=xmlBackends, default='etree', help='XML serialization (see XMLify.py -h). Default is "etree".')
+    args = parser.parse_args(arguments)
+    if args.clean_all and not(args.noclean):
+        parser.error("--clean-all and --noclean cannot be used together")
+    cleanEmptyLeaf = 'all' if args.clean_all else args.noclean
+    converters = {}
+    for nom, XmlBase, mapFile, refColumn in args.mapping:
+        if nom in converters:
+            parser.error("The converter name %s is used twice!" % nom)
+        is_valid_file(parser, XmlBase)
+        is_valid_file(parser, mapFile)
+        try:
+            converters[nom] = XMLConverter(XmlBase, mapFile, refColumn, args.verbose, cleanEmptyLeaf, args.engine, args.backend, args.compact)
+        except ValueError as e:
+            print(str(e))
+            print(msgFinDuJeu)
+            return None
+    serveConversions(converters, args.host, args.port, args.socket, args.jobs)
+
+    return None
+
+#--------------------------------------------------------------
+def mergeCommand(arguments):
+    """
+    Ligne de commande de la réunion des manifestes des lots ("XMLify.py merge ...", voir mergeManifests).
+
+    :param arguments: arguments qui suivent "merge"
+        :type: list
+    :returns: None
+    """
+
+    import argparse                            # pour traiter les arguments en ligne de commande
+    parser = argparse.ArgumentParser(prog='XMLify.py merge', description='Merge the manifests of shards converted with --shard into a single manifest, usable by later incremental conversions. Filename collisions between shards and missing shards are reported.')
+    parser.add_argument("outFolder", type=lambda x: is_valid_directory(parser, x), help='folder where the merged manifest is written (and where shard manifests are searched for, if none is given). Ex: "./output/".')
+    parser.add_argument("manifests", nargs='*', type=lambda x: is_valid_file(parser, x), help='shard manifests to merge. Default is all shard manifests in outFolder.')
+    args = parser.parse_args(arguments)
+    if not(mergeManifests(args.outFolder, args.manifests if len(args.manifests) > 0 else None)):
+        print(msgFinDuJeu)
+        sys.exit(1)
+
+    return None
+
 #--------------------------------------------------------------
 # les tests
 #--------------------------------------------------------------
@@ -700,20 +5109,55 @@ def convertCSVToXML_test(isTEI):
 if __name__ == '__main__':
     
     import argparse                            # pour traiter les arguments en ligne de commande
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(epilog='Run "XMLify.py serve -h" to keep base XML trees and mappings loaded and convert rows sent over HTTP, and "XMLify.py merge -h" to merge shard manifests.')
     parser.add_argument("XmlBase", type=lambda x: is_valid_file(parser, x), help='minimum XML tree file. Set path and name. ex: "./input/teiHeader.xml".')
-    parser.add_argument("mapFile", type=lambda x: is_valid_file(parser, x),help='CSV text file containing column headers and mapping to XML tags. Set file path and name. ex: "./input/mapping.csv".')
-    parser.add_argument("dataFile", type=lambda x: is_valid_file(parser, x),help='CSV text file containing column headers and data. Set file path and name. ex: "./input/datasample.csv".')
+    parser.add_argument("mapFile", type=lambda x: is_valid_file(parser, x),help='CSV text file containing column headers and mapping to XML tags, possibly compressed (.gz, .bz2, .xz, .zst). Set file path and name. ex: "./input/mapping.csv".')
+    parser.add_argument("dataFile", type=lambda x: is_valid_input(parser, x),help='CSV text file containing column headers and data, possibly compressed (.gz, .bz2, .xz, or .zst if the zstandard module is installed), or "-" for standard input, or an Arrow/Parquet file (.parquet, .pq, .arrow, .feather, .ipc, .arrows; needs pyarrow) of which only mapped columns are read. Rows are read as they are converted. Set file path and name. ex: "./input/datasample.csv".')
     parser.add_argument("outFolder", type=lambda x: is_valid_directory(parser, x),help='set folder path to store resulting XML files. Ex: "./output/".')
     parser.add_argument("refColumn", help='header of column containing unique value that will be used to forge resulting XML file name. Ex: "cote".')
                         
     parser.add_argument("-v", "--verbose", help="option verbose: set this option to be informed of data column not mapped to XML. Default is False.", action="store_true")
     parser.add_argument("-n", "--noclean", help="set this option if you do not want empty XML tag be remove from the XML tree. Default is True.", action="store_false")
+    parser.add_argument("--clean-all", help="remove empty XML tags at any depth (tags without attribute, child or text once their own empty tags are removed), not only directly under the root. Default is False.", action="store_true")
+    parser.add_argument("-c", "--compact", help="do not indent XML files (no whitespace between tags), for machine consumers. Default is False.", action="store_true")
+    parser.add_argument("-e", "--engine", choices=['tree', 'template'], default='tree', help='conversion engine: "tree" builds an XML tree for each row, "template" assembles each row from pre-rendered string templates (rows it cannot render exactly go through the tree engine). Output is the same. Default is "tree".')
+    parser.add_argument("-i", "--incremental", help="set this option to convert only rows changed since the last incremental conversion into outFolder (a manifest of row, mapping and base XML hashes is kept in outFolder). An interrupted conversion resumes where it stopped. Default is False.", action="store_true")
+    parser.add_argument("-p", "--prune", help="with --incremental, delete output files whose rows are no longer in dataFile. Default is False.", action="store_true")
+    parser.add_argument("-a", "--archive", help='write all XML files into a single archive created in outFolder, instead of one file per row. The format is given by the archive name extension: .zip, .tar, .tar.gz (.tgz), .tar.bz2 or .tar.xz. Ex: "output.tar.gz".')
+    parser.add_argument("--encoding", type=lambda x: is_valid_encoding(parser, x), default='utf-8', help='text encoding of dataFile. Default is "utf-8".')
+    parser.add_argument("-d", "--delimiter", type=lambda x: is_valid_delimiter(parser, x), default=';', help='column delimiter of dataFile (one character, "\\t" for a tabulation). Default is ";".')
+    parser.add_argument("--progress", help="print progress on standard error at regular intervals (see --progress-interval): rows converted, rows/s, share of dataFile read and estimated time left, bytes written and error count. Default is False.", action="store_true")
+    parser.add_argument("--progress-interval", type=lambda x: is_valid_interval(parser, x), metavar='SECONDS', help="interval between two progress reports (and --metrics updates), in seconds (implies --progress). Default is %g." % progressInterval)
+    parser.add_argument("--metrics", metavar='FILE', help="write progress metrics to FILE at each progress interval, for monitoring: Prometheus text format if FILE ends with .prom (atomically replaced, for the node_exporter textfile collector), JSON lines otherwise (one object appended per interval). Default is no metrics file.")
+    parser.add_argument("-s", "--stats", help="print time and call count of each conversion stage, and merge cost of each mapped column, at the end of the conversion. Default is False.", action="store_true")
+    parser.add_argument("--stats-json", metavar='JSONFILE', help="store the statistics of --stats in JSONFILE, in JSON, instead of printing them (implies --stats).")
+    parser.add_argument("-b", "--backend", choices=xmlBackends, default='etree', help='XML serialization: "etree" (ElementTree) or "lxml" (libxml2, for compatibility only: not faster, each row tree being copied into lxml elements first; falls back to ElementTree if lxml is not installed; see LxmlBackend for the few characters escaped differently). Default is "etree".')
+    parser.add_argument("-o", "--corpus", help='write all XML documents into a single file created in outFolder, instead of one file per row: a teiCorpus wrapped once in the XmlBase prolog, or one document per line if the name ends with %s. A sidecar index (name + "%s") gives the byte offset and length of each document by refColumn value, so that XMLify.CorpusReader reads one document without parsing the rest. Ex: "corpus.xml".' % (corpusLinesExtension, corpusIndexSuffix))
+    parser.add_argument("-l", "--layout", type=lambda x: is_valid_layout(parser, x), metavar='LAYOUT', help='spread output files into subdirectories of outFolder, created when needed: "hash:2/2" (hexadecimal hash of the file name, 2 characters per level), "prefix:7" (first characters of the file name per level), "pattern:REGEX" (one level per group of REGEX matched at the start of the file name, e.g. "pattern:([^-]+-[^-]+)-([0-9]{4})" gives JMG-AA1/1924/) or "flat". The layout is recorded in outFolder (%s) and reused by later conversions into it. Default is the recorded layout, or "flat".' % layoutName)
+    parser.add_argument("-w", "--writers", type=lambda x: is_valid_jobs(parser, x), default=0, help="number of background threads writing output files while next rows are converted (one for an archive or a corpus). Default is 0: files are written as rows are converted.")
+    parser.add_argument("--shard", type=lambda x: is_valid_shard(parser, x), metavar='i/N', help="convert only shard i out of N (1 <= i <= N): rows are assigned to shards by a stable hash of their refColumn value (or of their row number), so that N machines can share one data file. Each shard keeps its own manifest in outFolder; merge them with \"XMLify.py merge outFolder\". Needs one file per row: cannot be used with --archive or --corpus. Default is all rows.")
+    parser.add_argument("--validate", help="validate each XML file in memory, before it is written, against the RelaxNG schema (XML syntax, .rng) declared by <?xml-model?> in XmlBase, or against --schema if given. The schema is compiled once (once per process with --jobs). Invalid files are still written and listed, with their errors, in XMLify-validation.jsonl in outFolder. Requires lxml. Default is no validation.", action="store_true")
+    parser.add_argument("--schema", metavar='FILE', help="RelaxNG schema (XML syntax, .rng) used by --validate instead of the one declared in XmlBase (implies --validate).")
+    parser.add_argument("--fragment-cache", type=lambda x: is_valid_jobs(parser, x), default=fragmentCacheSize, metavar='SIZE', help="number of field subtrees kept in memory, by column and value, so that repeated values are built only once (0: no cache). Default is %d." % fragmentCacheSize)
+    parser.add_argument("-k", "--cache", metavar='CACHEDIR', help="keep the checked and compiled mapping and base XML tree in CACHEDIR (created if needed), so that next conversions with the same base XML and mapping files start without reading and checking them again. Any change to either file is detected. Default is no cache.")
+    parser.add_argument("-j", "--jobs", type=lambda x: is_valid_jobs(parser, x), default=1, help="number of processes converting rows in parallel (0: one per CPU). Output is the same as with a single process. Default is 1.")
     
+    # mode serveur de conversion
+    if (len(sys.argv)>1) and (sys.argv[1] == 'serve'):
+        serveCommand(sys.argv[2:])
+    # réunion des manifestes des lots de lignes
+    elif (len(sys.argv)>1) and (sys.argv[1] == 'merge'):
+        mergeCommand(sys.argv[2:])
     # si on a au moins un paramètre en ligne de commande
-    if len(sys.argv)>1:   
+    elif len(sys.argv)>1:   
         args = parser.parse_args()
-        convertCSVToXML(args.XmlBase ,args.mapFile, args.dataFile, args.refColumn, args.outFolder, args.verbose, args.noclean)
+        if args.clean_all and not(args.noclean):
+            parser.error("--clean-all and --noclean cannot be used together")
+        cleanEmptyLeaf = 'all' if args.clean_all else args.noclean
+        stats = args.stats_json if args.stats_json else args.stats
+        validate = args.schema if args.schema else (True if args.validate else None)
+        progress = args.progress_interval if args.progress_interval else (progressInterval if args.progress else None)
+        convertCSVToXML(args.XmlBase ,args.mapFile, args.dataFile, args.refColumn, args.outFolder, args.verbose, cleanEmptyLeaf, args.jobs, args.engine, args.incremental, args.prune, args.archive, stats, args.writers, args.backend, args.compact, args.cache, args.fragment_cache, args.shard, validate, args.corpus, args.encoding, args.delimiter, args.layout, progress, args.metrics)
     else:
         parser.print_help()
        
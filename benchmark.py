@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#python 3
+
+'''
+description : banc d'essai de XMLify.
+   Génère des fichiers de test synthétiques (arbre XML de base, mapping et données CSV), dont on choisit
+   le nombre de lignes et de colonnes, la profondeur des balises, le nombre de valeurs par champ ("|")
+   et les déclarations d'espaces de nommage (à la manière de Nakala). Mesure ensuite convertCSVToXML de
+   bout en bout, puis étape par étape, et range les résultats (lignes/s) dans un fichier JSON pour comparer
+   les versions entre elles.
+'''
+
+import csv                                 # écriture des fichiers CSV de test
+import json                                # résultats du banc d'essai
+import os                                  # chemins des fichiers de test
+import io                                  # messages de XMLify, mis de côté pendant les mesures
+import shutil                              # suppression des fichiers de test
+import tempfile                            # dossier des fichiers de test
+import platform                            # version de Python, pour les résultats
+import subprocess                          # version de XMLify (commit git), pour les résultats
+from random import Random                  # générateur aléatoire (graine fixe: fichiers reproductibles)
+from time import perf_counter              # chronomètre
+from contextlib import redirect_stdout     # redirection temporaire des messages (print)
+
+import XMLify
+
+
+# Constantes
+# mots utilisés pour les valeurs des champs (accents, apostrophes, espaces...)
+benchWords = ['Alpha', 'beta gamma', 'Villeneuve d\'Ascq', 'é à ü', '1924', 'Montevideo', 'Presse', 'Papier',
+              'Littérature argentine', 'Mora Guarnido, José', 'El cosmopolitismo', 'CC-BY-NC-SA']
+# préfixes des espaces de nommage générés (ElementTree réserve les préfixes "ns0", "ns1"...)
+benchPrefixes = ['dcterms', 'foaf', 'skos', 'bibo', 'rdfs', 'owl']
+
+# étapes mesurées: nom de l'étape -> fonctions de XMLify (ou méthodes "Classe.méthode") qui la composent
+benchStages = [('load', ['loadCSVtoTEIMapping', 'retrieveNamespaces']),
+               ('check', ['check_TEIMapping']),
+               ('prolog', ['getXMLProlog']),
+               ('skeleton', ['compileSkeleton']),
+               ('dispatch', ['dispatchValues', 'dispatchPlanValues']),
+               ('merge', ['AddToTree', 'mergeFragment', 'mergePlan', 'mergeFragmentPath']),
+               ('template', ['TemplateEngine.render']),
+               ('serialize', ['TreeSerializer.serializeText', 'LxmlBackend.serializeText']),
+               ('write', ['writeXMLDocument', 'ZipSink.write', 'TarSink.write'])]
+
+
+#--------------------------------------------------------------
+def namespacePrefix(n):
+    """
+    Préfixe du n-ième espace de nommage généré.
+
+    :param n: numéro de l'espace de nommage (à partir de 0)
+        :type: int
+    :returns: préfixe
+        :type: str
+    """
+
+    if n < len(benchPrefixes):
+        return benchPrefixes[n]
+
+    return 'ext'+str(n)
+
+#--------------------------------------------------------------
+def generateBaseXML(filename, namespaces):
+    """
+    Ecrit l'arbre XML de base: un en-tête TEI, ou un arbre à la manière de Nakala s'il y a des espaces
+    de nommage (une déclaration par ligne, comme le lit retrieveNamespaces).
+
+    :param filename: chemin du fichier
+        :type: str
+    :param namespaces: nombre d'espaces de nommage (0: en-tête TEI sans espace de nommage)
+        :type: int
+    :returns: None
+    """
+
+    with open(filename, 'w', encoding='utf-8') as fichier:
+        fichier.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fichier.write('<!-- arbre XML de base généré par benchmark.py -->\n')
+        if namespaces == 0:
+            fichier.write('<TEI>\n  <teiHeader>\n    <fileDesc>\n      <titleStmt></titleStmt>\n    </fileDesc>\n')
+            fichier.write('    <profileDesc></profileDesc>\n  </teiHeader>\n  <text>\n    <body>\n    </body>\n  </text>\n</TEI>\n')
+        else:
+            fichier.write('<nkl:Data xmlns:nkl="http://nakala.fr/schema#"\n')
+            for n in range(namespaces):
+                fichier.write('   xmlns:'+namespacePrefix(n)+'="http://example.org/'+namespacePrefix(n)+'#"\n')
+            fichier.write('   xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n')
+            fichier.write('  <nkl:title></nkl:title>\n</nkl:Data>\n')
+
+    return None
+
+#--------------------------------------------------------------
+def generateMapping(filename, columns, depth, fanout, namespaces):
+    """
+    Ecrit le fichier de mapping: pour chaque colonne, un chemin de "depth" balises (les premiers niveaux
+    sont partagés entre colonnes), terminé par une balise portant "fanout" '?' (le premier dans le texte,
+    les autres dans des attributs). Une colonne sur cinq remplit une même balise "note", ce qui fait jouer
+    la répétition des balises.
+
+    :param filename: chemin du fichier
+        :type: str
+    :param columns: nombre de colonnes
+        :type: int
+    :param depth: nombre de balises entre la racine et la balise qui reçoit les valeurs
+        :type: int
+    :param fanout: nombre de '?' par colonne
+        :type: int
+    :param namespaces: nombre d'espaces de nommage (0: balises TEI sans préfixe)
+        :type: int
+    :returns: entêtes des colonnes mappées
+        :type: list
+    """
+
+    entetes = []
+    mappings = []
+    for colonne in range(columns):
+        balises = []
+        for niveau in range(depth):
+            # quelques branches seulement à chaque niveau: les chemins se recouvrent
+            balises.append('sec'+str(niveau)+chr(ord('a') + (colonne // (niveau+1)) % 3))
+        balises.append('note' if colonne % 5 == 0 else 'field'+str(colonne))
+        if namespaces > 0:
+            balises = [namespacePrefix(n % namespaces)+':'+balise for n, balise in enumerate(balises)]
+        else:
+            balises = ['teiHeader'] + balises
+        attributs = ''.join([' n'+str(n)+'="?"' for n in range(1, fanout)])
+        chaine = '?'
+        for n, balise in enumerate(reversed(balises)):
+            chaine = '<'+balise+(attributs if n == 0 else '')+'>'+chaine+'</'+balise+'>'
+        entetes.append('Col'+str(colonne))
+        mappings.append(chaine)
+
+    with open(filename, 'w', encoding='utf-8', newline='') as fichier:
+        writer = csv.writer(fichier, delimiter=';', quoting=csv.QUOTE_ALL)
+        writer.writerow(entetes + ['Cote'])
+        writer.writerow(mappings + ['none'])
+
+    return entetes
+
+#--------------------------------------------------------------
+def generateData(filename, entetes, rows, fanout, noneRatio, seed):
+    """
+    Ecrit le fichier de données: une colonne "Cote" (nom des fichiers créés), les colonnes mappées et une
+    colonne non mappée. Chaque valeur est faite de "fanout" morceaux séparés par '|'.
+
+    :param filename: chemin du fichier
+        :type: str
+    :param entetes: entêtes des colonnes mappées
+        :type: list
+    :param rows: nombre de lignes
+        :type: int
+    :param fanout: nombre de morceaux par valeur
+        :type: int
+    :param noneRatio: proportion de champs sans valeur ("none")
+        :type: float
+    :param seed: graine du générateur aléatoire
+        :type: int
+    :returns: None
+    """
+
+    hasard = Random(seed)
+    with open(filename, 'w', encoding='utf-8', newline='') as fichier:
+        writer = csv.writer(fichier, delimiter=';', quoting=csv.QUOTE_ALL)
+        writer.writerow(['Cote'] + entetes + ['Extra'])
+        for numRow in range(rows):
+            ligne = ['BENCH-'+str(numRow).zfill(7)]
+            for entete in entetes:
+                if hasard.random() < noneRatio:
+                    ligne.append('none')
+                else:
+                    ligne.append('|'.join([hasard.choice(benchWords) for n in range(fanout)]))
+            ligne.append('not mapped')
+            writer.writerow(ligne)
+
+    return None
+
+#--------------------------------------------------------------
+class StageTimer(object):
+    '''
+    Chronométrage des étapes de la conversion: les fonctions de XMLify sont remplacées, le temps d'une
+    mesure, par des fonctions qui les chronomètrent. Le temps passé dans une fonction chronométrée appelée
+    par une autre n'est compté que pour la première (temps "propre" de chaque étape).
+    '''
+
+    def __init__(self):
+        self.totals = {}    # étape -> temps propre (s)
+        self.stack = []     # temps des fonctions chronométrées appelées par celles en cours
+        self.saved = []     # fonctions d'origine, remises en place par uninstall
+
+    def wrap(self, stage, func):
+        '''
+        Fonction chronométrée, comptée dans l'étape "stage".
+        '''
+        def timed(*args, **kwargs):
+            self.stack.append(0.0)
+            debut = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duree = perf_counter() - debut
+                appels = self.stack.pop()
+                self.totals[stage] = self.totals.get(stage, 0.0) + duree - appels
+                if len(self.stack) > 0:
+                    self.stack[-1] = self.stack[-1] + duree
+        return timed
+
+    def install(self):
+        '''
+        Remplace les fonctions des étapes (voir benchStages) par leur version chronométrée.
+        '''
+        for stage, noms in benchStages:
+            for nom in noms:
+                cible = XMLify
+                if nom.find('.') > -1:
+                    classe, nom = nom.split('.')
+                    cible = getattr(XMLify, classe)
+                if hasattr(cible, nom):
+                    func = getattr(cible, nom)
+                    self.saved.append((cible, nom, func))
+                    setattr(cible, nom, self.wrap(stage, func))
+
+        return None
+
+    def uninstall(self):
+        '''
+        Remet en place les fonctions d'origine.
+        '''
+        for cible, nom, func in reversed(self.saved):
+            setattr(cible, nom, func)
+        self.saved = []
+
+        return None
+
+#--------------------------------------------------------------
+def runConversion(files, outPath, options):
+    """
+    Lance une conversion complète (messages de XMLify mis de côté) et la chronomètre.
+
+    :param files: fichiers de test (arbre de base, mapping, données)
+        :type: tuple
+    :param outPath: dossier des fichiers créés
+        :type: str
+    :param options: options de convertCSVToXML (jobs, engine, archive...)
+        :type: dict
+    :returns: durée (s)
+        :type: float
+    """
+
+    XmlBase, mapFile, dataFile = files
+    messages = io.StringIO()
+    debut = perf_counter()
+    with redirect_stdout(messages):
+        XMLify.convertCSVToXML(XmlBase, mapFile, dataFile, 'Cote', outPath, **options)
+
+    return perf_counter() - debut
+
+#--------------------------------------------------------------
+def xmlifyRevision():
+    """
+    Version de XMLify mesurée: commit git du dossier de XMLify, s'il y en a un.
+
+    :returns: identifiant du commit, ou None
+        :type: str
+    """
+
+    try:
+        sortie = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(XMLify.__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+    return sortie.stdout.decode('ascii').strip()
+
+#--------------------------------------------------------------
+def runBenchmark(params, options, repeat, workDir):
+    """
+    Génère les fichiers de test et mesure la conversion: de bout en bout (meilleur temps sur "repeat"
+    conversions) puis étape par étape (une conversion chronométrée, dans un seul processus).
+
+    :param params: paramètres des fichiers de test (rows, columns, depth, fanout, namespaces, none, seed)
+        :type: dict
+    :param options: options de convertCSVToXML (jobs, engine, archive...)
+        :type: dict
+    :param repeat: nombre de conversions de bout en bout
+        :type: int
+    :param workDir: dossier des fichiers de test et des fichiers créés
+        :type: str
+    :returns: résultats
+        :type: dict
+    """
+
+    XmlBase = os.path.join(workDir, 'base.xml')
+    mapFile = os.path.join(workDir, 'mapping.csv')
+    dataFile = os.path.join(workDir, 'data.csv')
+    outPath = os.path.join(workDir, 'output', '')
+    os.makedirs(outPath, exist_ok=True)
+    generateBaseXML(XmlBase, params['namespaces'])
+    entetes = generateMapping(mapFile, params['columns'], params['depth'], params['fanout'], params['namespaces'])
+    generateData(dataFile, entetes, params['rows'], params['fanout'], params['none'], params['seed'])
+    files = (XmlBase, mapFile, dataFile)
+
+    durees = [runConversion(files, outPath, options) for n in range(repeat)]
+    meilleur = min(durees)
+
+    # étape par étape: un seul processus, pour que les fonctions chronométrées soient bien celles appelées
+    timer = StageTimer()
+    timer.install()
+    try:
+        total = runConversion(files, outPath, dict(options, jobs=1))
+    finally:
+        timer.uninstall()
+    stages = dict([(stage, timer.totals.get(stage, 0.0)) for stage, noms in benchStages])
+    stages['other'] = max(0.0, total - sum(stages.values()))
+
+    return {'revision': xmlifyRevision(),
+            'python': platform.python_version(),
+            'params': params,
+            'options': options,
+            'end_to_end': {'seconds': meilleur, 'runs': durees, 'rows_per_s': params['rows'] / meilleur},
+            'stages': {'seconds': total, 'rows_per_s': params['rows'] / total, 'detail': stages}}
+
+#--------------------------------------------------------------
+def printResults(results, previous=None):
+    """
+    Affiche les résultats, comparés à ceux d'une mesure précédente s'il y en a.
+
+    :param results: résultats (voir runBenchmark)
+        :type: dict
+    :param previous: résultats précédents
+        :type: dict
+    :returns: None
+    """
+
+    def compare(avant, apres, plusEstMieux):
+        # rapport entre deux mesures, présenté comme un gain (> 1) ou une perte (< 1)
+        if (avant is None) or (avant == 0) or (apres == 0):
+            return ''
+        rapport = (apres / avant) if plusEstMieux else (avant / apres)
+        return '   x'+format(rapport, '.2f')+' vs '+str(previous.get('revision', '?'))
+
+    params = results['params']
+    print('XMLify '+str(results['revision'])+' (Python '+results['python']+')')
+    print('rows: '+str(params['rows'])+', columns: '+str(params['columns'])+', depth: '+str(params['depth'])
+          +', fan-out: '+str(params['fanout'])+', namespaces: '+str(params['namespaces'])+', options: '+json.dumps(results['options']))
+    avant = None if previous is None else previous['end_to_end']['rows_per_s']
+    print('end to end: '+format(results['end_to_end']['seconds'], '.3f')+' s, '
+          +format(results['end_to_end']['rows_per_s'], '.0f')+' rows/s'+compare(avant, results['end_to_end']['rows_per_s'], True))
+    print('per stage (one process, timed run: '+format(results['stages']['rows_per_s'], '.0f')+' rows/s):')
+    total = results['stages']['seconds']
+    for stage, duree in results['stages']['detail'].items():
+        avant = None if previous is None else previous['stages']['detail'].get(stage, None)
+        print('  '+stage.ljust(10)+format(duree, '8.3f')+' s '+format(100*duree/total, '5.1f')+' %'+compare(avant, duree, False))
+
+    return None
+
+#--------------------------------------------------------------
+#--------------------------------------------------------------
+
+if __name__ == '__main__':
+
+    import argparse                            # pour traiter les arguments en ligne de commande
+    parser = argparse.ArgumentParser(description='XMLify benchmark on synthetic CSV data and mapping files.')
+    parser.add_argument("-r", "--rows", type=int, default=2000, help="number of data rows. Default is 2000.")
+    parser.add_argument("-c", "--columns", type=int, default=30, help="number of mapped columns. Default is 30.")
+    parser.add_argument("-d", "--depth", type=int, default=3, help="number of tags between the root and the tag receiving values. Default is 3.")
+    parser.add_argument("-f", "--fanout", type=int, default=1, help="number of '|' separated values (and of '?') per field. Default is 1.")
+    parser.add_argument("-s", "--namespaces", type=int, default=0, help="number of namespace declarations (Nakala-like base XML). Default is 0 (TEI header).")
+    parser.add_argument("--none", type=float, default=0.3, help='ratio of "none" fields. Default is 0.3.')
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the generated data. Default is 1.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of conversion processes (end to end measure). Default is 1.")
+    parser.add_argument("-e", "--engine", choices=['tree', 'template'], default='tree', help='conversion engine. Default is "tree".')
+    parser.add_argument("-a", "--archive", help='write output files into this archive (ex: "output.tar.gz").')
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="number of end to end conversions (best time is kept). Default is 3.")
+    parser.add_argument("-o", "--output", help="JSON file to store results.")
+    parser.add_argument("--compare", help="JSON file of previous results to compare with.")
+    parser.add_argument("--keep", help="folder where generated files are kept (default: temporary folder, removed).")
+    args = parser.parse_args()
+
+    params = {'rows': args.rows, 'columns': args.columns, 'depth': args.depth, 'fanout': args.fanout,
+              'namespaces': args.namespaces, 'none': args.none, 'seed': args.seed}
+    options = {'jobs': args.jobs, 'engine': args.engine, 'archive': args.archive}
+    previous = None
+    if not(args.compare is None):
+        with open(args.compare, encoding='utf-8') as fichier:
+            previous = json.load(fichier)
+
+    workDir = args.keep if not(args.keep is None) else tempfile.mkdtemp(prefix='xmlify-bench-')
+    try:
+        results = runBenchmark(params, options, max(1, args.repeat), workDir)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    printResults(results, previous)
+    if not(args.output is None):
+        with open(args.output, 'w', encoding='utf-8') as fichier:
+            json.dump(results, fichier, indent=2)